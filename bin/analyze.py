@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+from berlin import Config, debug, Berlin
+from berlin.analyze import Analyzer, packet_classes, routing, report, differences, \
+        saved_ruleset
+from berlin.snapshot import default_file
+from berlin.addresses import AddressSet, default_cache_dir
+import sys
+
+# Work out how many rules every kind of packet passes, for the rules
+# rules.py would generate with the same options, or for a saved ruleset.
+
+debug( 0, "Detecting configuration... ", False )
+AddressSet.cache_dir = default_cache_dir()
+C = Config( snapshot_file=default_file() )
+debug( 0, "done." )
+
+def option( name, default=None ):
+    """Return the argument following {name} on the command line."""
+    
+    if name in sys.argv:
+        return sys.argv[ sys.argv.index(name)+1 ]
+    return default
+
+V = Berlin()
+if '--rules' in sys.argv:
+    V = saved_ruleset( option('--rules'), option('--sets') )
+else:
+    V.use_ipset = '--ipset' in sys.argv
+    V.subnet_sets = '--subnet-sets' in sys.argv
+    V.classify_flows = '--classify' in sys.argv
+    V.fast_path = '--fast-path' in sys.argv
+    if '--tree' in sys.argv:
+        V.tree_fanout = int( sys.argv[ sys.argv.index('--tree')+1 ] )
+    V.import_config( C )
+    if '--no-optimize' not in sys.argv:
+        V.optimize()
+    if '--interface-chains' in sys.argv:
+        V.split_interfaces()
+
+top = 5
+if '--top' in sys.argv:
+    top = int( sys.argv[ sys.argv.index('--top')+1 ] )
+
+local, routes = routing( C )
+A = Analyzer( V, local, routes )
+for line in report( V, [ A.trace(P) for P in packet_classes(C) ], top ):
+    print line
+
+if '--compare' in sys.argv:
+    filename = sys.argv[ sys.argv.index('--compare')+1 ]
+    D = differences( Analyzer( saved_ruleset( filename, option('--compare-sets') ),
+            local, routes ), A, packet_classes(C) )
+    print ''
+    print '{0} packet classes would be treated differently than by {1}.'.format(
+            len(D), filename )
+    for P, a, b in D:
+        print '  {0}: {1} instead of {2}'.format( P.name, b.verdict, a.verdict )
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+from berlin import Config, Berlin
+import berlin.addresses, berlin.network_config
+from berlin.network_config import unparse_file
+import json, os, random, resource, shutil, subprocess, sys, tempfile, time, traceback
+
+# Preset scales. Every internal interface gets {subnets} subnets of {hosts}
+# hosts each; {blocklist} is the number of addresses in ad-hosts.
+scales = dict({
+    'small':  dict( wans=1, lans=2, subnets=2, hosts=10,
+            ports=5, forwards=5, blocklist=1000 ),
+    'medium': dict( wans=1, lans=4, subnets=8, hosts=50,
+            ports=20, forwards=20, blocklist=50000 ),
+    'large':  dict( wans=2, lans=8, subnets=16, hosts=200,
+            ports=100, forwards=100, blocklist=1000000 ),
+    'huge':   dict( wans=2, lans=12, subnets=20, hosts=250,
+            ports=200, forwards=200, blocklist=4000000 ),
+})
+
+# The paths being measured, in the order they run.
+phases = [ 'config', 'create_filter', 'create_filter_cached', 'import_config',
+        'output_chains', 'dhcp_conf', 'interfaces_file' ]
+
+usage = """Usage: benchmark.py [options]
+       benchmark.py --compare <old.json> [--output <new.json>]
+
+Time every step of generating the firewall, on synthetic configurations.
+
+    --scale <names>     Comma separated scales to run: small, medium, large
+                        and huge. Default: small,medium.
+    --repeat <n>        Run every case n times, and keep the best. Default: 3.
+    --output <file>     Where to write the results (or, with --compare, the
+                        results to compare). Default: /tmp/berlin-benchmark.json.
+    --compare <file>    Print the time of every step in --output, relative to
+                        the results in <file>, instead of running anything.
+    --seed <n>          Seed for the random host lists. Default: 2011.
+
+    --wans, --lans, --subnets, --hosts, --ports, --forwards, --blocklist <n>
+                        Override that dimension of every scale.
+
+    --ipset, --subnet-sets, --classify, --fast-path, --interface-chains,
+    --tree <fan-out>    Passed on to the ruleset, as with rules.py.
+
+    --help              Show this message."""
+
+# Options taking a value, and options that don't.
+value_options = set([ '--scale', '--repeat', '--output', '--compare', '--seed',
+        '--tree' ] + [ '--' + k for k in scales['small'] ])
+flag_options = set([ '--ipset', '--subnet-sets', '--classify', '--fast-path',
+        '--interface-chains', '--help', '-h' ])
+
+
+def option( name, default=None ):
+    """Return the argument following {name} on the command line."""
+    
+    if name in sys.argv:
+        return sys.argv[ sys.argv.index(name)+1 ]
+    return default
+
+def check_options( args ):
+    """Return a message about the first thing wrong with the command line
+    {args}, or None if there is nothing wrong with it."""
+    
+    i = 0
+    while i < len(args):
+        t = args[i]
+        if t in flag_options:
+            i += 1
+            continue
+        if t not in value_options:
+            return 'Unknown option: {0}.'.format( t )
+        if i + 1 >= len(args):
+            return '{0} needs a value.'.format( t )
+        value = args[i+1]
+        if t == '--scale':
+            for name in value.split(','):
+                if name not in scales:
+                    return 'Unknown scale: {0}.'.format( name )
+        elif t not in ('--output', '--compare') and not value.isdigit():
+            return '{0} needs a number.'.format( t )
+        i += 2
+    return None
+
+def put( filename, data ):
+    """Write {data} to {filename}, creating directories as needed."""
+    
+    if not os.path.isdir( os.path.dirname(filename) ):
+        os.makedirs( os.path.dirname(filename) )
+    f = open( filename, 'w' )
+    f.write( data )
+    f.close()
+
+def host_list( R, count ):
+    """Return {count} random addresses, one per line.
+    
+    Addresses come in short runs, like real block lists, so that some of
+    them can be merged into larger prefixes."""
+    
+    lines = []
+    while len(lines) < count:
+        base = R.getrandbits( 32 )
+        for n in xrange( min( R.randint(1, 16), count - len(lines) ) ):
+            ip = ( base + n ) & 0xffffffff
+            lines.append( '{0}.{1}.{2}.{3}'.format( ip >> 24, (ip >> 16) & 255,
+                    (ip >> 8) & 255, ip & 255 ) )
+    return '\n'.join( lines ) + '\n'
+
+def write_config( root, scale, seed=2011 ):
+    """Write a synthetic configuration of size {scale} into {root}, with
+    host lists made up from the random {seed}.
+    
+    Returns the names of the network devices, as Config() expects them."""
+    
+    nets = scale['lans'] * scale['subnets']
+    if nets > 254 or scale['hosts'] > 250:
+        raise Exception( "At most 254 subnets of 250 hosts fit in 192.168.0.0/16." )
+    
+    R = random.Random( seed )
+    wans = [ 'wan{0}'.format(i) for i in range(scale['wans']) ]
+    lans = [ 'lan{0}'.format(i) for i in range(scale['lans']) ]
+    
+    put( root + 'if-config', unparse_file( dict({
+        'external interface': wans,
+        'internal interface': lans,
+        'wan address': ['1.2.3.4'],
+        'local services': ['22'],
+    }) ) )
+    
+    for p in range( scale['ports'] ):
+        put( root + 'ports/{0}'.format( 10000 + p ), '' )
+    for p in range( scale['forwards'] ):
+        put( root + 'ports/{0}'.format( 20000 + p ), '192.168.{0}.{1}:80'.format(
+                1 + p % nets, 2 + p % scale['hosts'] ) )
+    
+    policies = [ ['adblock'], ['malware'], [] ]
+    for n in range( nets ):
+        net = str( n + 1 )
+        put( root + 'networks/' + net + '/netconf', unparse_file( dict({
+                'friendly name': [ 'Subnet ' + net ],
+                'interface': [ lans[ n // scale['subnets'] ] ],
+                'policies': policies[ n % len(policies) ],
+            }) ) )
+        for h in range( scale['hosts'] ):
+            put( root + 'networks/{0}/hosts/host{1}'.format( net, h ), unparse_file( dict({
+                    'hardware ethernet': [ '02:00:00:00:{0:02x}:{1:02x}'.format(n, h) ],
+                    'fixed address': [ str( h + 2 ) ],
+                    'comment': [ 'Host {0} in subnet {1}'.format( h, net ) ],
+                }) ) )
+    
+    put( root + 'ad-hosts', host_list( R, scale['blocklist'] ) )
+    put( root + 'malware-hosts', host_list( R, scale['blocklist'] // 4 ) )
+    put( root + 'smtp-hosts', host_list( R, 16 ) )
+    put( root + 'apache/whitelist.conf', ''.join([ 'ServerAlias ' + t + '\n'
+            for t in host_list( R, 16 ).split() ]) )
+    
+    return '\n'.join( wans + lans ) + '\n'
+
+
+def run_case( root, devices ):
+    """Run every phase once, against the configuration in {root}.
+    
+    Returns the wall clock time, CPU time and growth of the peak resident
+    set of each phase. This runs in a child process of its own, so no two
+    cases share any memory or caches."""
+    
+    berlin.network_config.locations[:] = [ root ]
+    berlin.addresses.locations[:] = [ root ]
+    berlin.addresses.AddressSet.cache_dir = root + 'cache/'
+    
+    rv = dict()
+    def measure( phase, f, *args ):
+        r0 = resource.getrusage( resource.RUSAGE_SELF )
+        t0 = time.time()
+        result = f( *args )
+        t1 = time.time()
+        r1 = resource.getrusage( resource.RUSAGE_SELF )
+        rv[ phase ] = dict({
+            'seconds': t1 - t0,
+            'cpu': ( r1.ru_utime + r1.ru_stime ) - ( r0.ru_utime + r0.ru_stime ),
+            'maxrss_kb': r1.ru_maxrss - r0.ru_maxrss,
+        })
+        return result
+    
+    C = measure( 'config', Config, devices )
+    # There are no real interfaces, so make up their addresses.
+    for i, I in enumerate( C.Interfaces ):
+        I.address = '10.0.{0}.2'.format(i) if I.wan_interface else '192.168.0.1'
+    
+    filter_args = ( 'ad_filter', ['ad-hosts','malware-hosts'], 'nat',
+            '-g to_gateway', ['apache/whitelist.conf'] )
+    measure( 'create_filter', Berlin().create_filter, *filter_args )
+    # The same again, but reading the compiled host lists from disk.
+    berlin.addresses.compiled.clear()
+    measure( 'create_filter_cached', Berlin().create_filter, *filter_args )
+    
+    V = Berlin()
+    V.use_ipset = '--ipset' in sys.argv
+    V.subnet_sets = '--subnet-sets' in sys.argv
+    V.classify_flows = '--classify' in sys.argv
+    V.fast_path = '--fast-path' in sys.argv
+    V.tree_fanout = int( option( '--tree', 0 ) )
+    measure( 'import_config', V.import_config, C )
+    if '--interface-chains' in sys.argv:
+        V.split_interfaces()
+    measure( 'output_chains', V.output_chains, root + 'rules' )
+    measure( 'dhcp_conf', C.dhcp_conf )
+    measure( 'interfaces_file', C.interfaces_file )
+    
+    rv['totals'] = dict({
+        'rules': sum([ 1 for t in open( root + 'rules' ) if t.startswith('-A') ]),
+        'maxrss_kb': resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss,
+    })
+    return rv
+
+def fork_case( root, devices ):
+    """Run run_case() in a child process, and return its results."""
+    
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close( r )
+        try:
+            data = json.dumps( run_case( root, devices ) )
+            status = 0
+        except Exception:
+            data = json.dumps( dict( error=traceback.format_exc() ) )
+            status = 1
+        f = os.fdopen( w, 'w' )
+        f.write( data )
+        f.close()
+        os._exit( status )
+    
+    os.close( w )
+    f = os.fdopen( r, 'r' )
+    rv = json.loads( f.read() )
+    f.close()
+    os.waitpid( pid, 0 )
+    if 'error' in rv:
+        raise Exception( "Benchmark failed:\n" + rv['error'] )
+    return rv
+
+def best_of( runs ):
+    """Combine several runs of a case, keeping the best result of each."""
+    
+    rv = dict( totals=runs[0]['totals'] )
+    for phase in phases:
+        rv[ phase ] = dict([ ( k, min([ t[phase][k] for t in runs ]) )
+                for k in runs[0][phase] ])
+    return rv
+
+def revision():
+    """Return the git revision of this tree, if it is one."""
+    
+    try:
+        P = subprocess.Popen( ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname( os.path.abspath(__file__) ),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+        return P.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def compare( old, new ):
+    """Print the time of every phase in {new}, relative to {old}."""
+    
+    print '{0:<10s} {1:<22s} {2:>10s} {3:>10s} {4:>8s}'.format(
+            'scale', 'phase', 'old (s)', 'new (s)', 'ratio' )
+    for name in sorted( new['cases'] ):
+        if name not in old['cases']: continue
+        for phase in phases:
+            a = old['cases'][name]['results'].get( phase )
+            b = new['cases'][name]['results'].get( phase )
+            if not a or not b: continue
+            print '{0:<10s} {1:<22s} {2:>10.4f} {3:>10.4f} {4:>7.2f}x'.format(
+                    name, phase, a['seconds'], b['seconds'],
+                    b['seconds'] / a['seconds'] if a['seconds'] else 0 )
+
+
+if __name__ == '__main__':
+    
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print usage
+        sys.exit( 0 )
+    error = check_options( sys.argv[1:] )
+    if error:
+        sys.stderr.write( '{0}\n\n{1}\n'.format( error, usage ) )
+        sys.exit( 2 )
+    
+    if '--compare' in sys.argv:
+        old = json.load( open( option('--compare') ) )
+        new = json.load( open( option('--output', '/tmp/berlin-benchmark.json') ) )
+        compare( old, new )
+        sys.exit( 0 )
+    
+    names = option( '--scale', 'small,medium' ).split(',')
+    repeat = int( option( '--repeat', 3 ) )
+    seed = int( option( '--seed', 2011 ) )
+    output = option( '--output', '/tmp/berlin-benchmark.json' )
+    
+    rv = dict({
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'time': time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+        'options': sys.argv[1:],
+        'cases': dict(),
+    })
+    
+    for name in names:
+        scale = dict( scales[name] )
+        for k in scale:
+            scale[k] = int( option( '--' + k, scale[k] ) )
+        
+        root = tempfile.mkdtemp( prefix='berlin-benchmark-' ) + '/'
+        try:
+            sys.stdout.write( 'Benchmarking {0}... '.format( name ) )
+            sys.stdout.flush()
+            devices = write_config( root, scale, seed )
+            runs = []
+            for i in range( repeat ):
+                # Every run starts without a compiled cache.
+                shutil.rmtree( root + 'cache', True )
+                runs.append( fork_case( root, devices ) )
+        finally:
+            shutil.rmtree( root )
+        
+        rv['cases'][name] = dict( scale=scale, results=best_of( runs ) )
+        print '{0} rules, {1:.2f}s.'.format( runs[0]['totals']['rules'],
+                sum([ rv['cases'][name]['results'][t]['seconds'] for t in phases ]) )
+    
+    f = open( output, 'w' )
+    json.dump( rv, f, indent=1, sort_keys=True, separators=(',', ': ') )
+    f.write( '\n' )
+    f.close()
+    print 'Results written to {0}.'.format( output )
@@ -21,3 +21,4 @@ from network_config import Config
 from config_ui import ConfigUI
 from berlin import Berlin
 from output import debug
+from addresses import AddressSet
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import re, socket, struct, sys, os, stat, mmap, hashlib
+from loader import private
+from array import array
+from bisect import bisect_left
+
+# Anything that looks like a dotted quad, but not part of a longer number.
+octet = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+ip_pattern = re.compile(
+        r'(?<![0-9.])((?:{0}\.){{3}}{0})(?!\.?[0-9])'.format(octet) )
+
+# Places to look for relative filenames, in order.
+locations = ['/etc/berlin/','/etc/vuurmuur/','/etc/firewall.d/config/','']
+
+# The header of a compiled host list: magic, source size, source mtime,
+# source SHA-1 and number of addresses. Everything is in native byte order.
+cache_header = struct.Struct( '=4sQd20sI' )
+cache_magic = 'BRL' + sys.byteorder[0]
+
+# Host lists already compiled during this run, by filename.
+compiled = dict()
+
+
+def ip_to_int( ip ):
+    """Convert a dotted quad to an integer.
+    
+    Examples:
+    
+    >>> ip_to_int('192.168.1.1')
+    3232235777
+    
+    """
+    
+    return struct.unpack( '!I', socket.inet_aton(ip) )[0]
+
+def int_to_ip( n ):
+    """Convert an integer to a dotted quad.
+    
+    Examples:
+    
+    >>> int_to_ip(3232235777)
+    '192.168.1.1'
+    
+    """
+    
+    return socket.inet_ntoa( struct.pack('!I', n) )
+
+
+def prefix_to_string( prefix ):
+    """Format a (network, length) tuple in CIDR notation.
+    
+    Examples:
+    
+    >>> prefix_to_string( (3232235776, 24) )
+    '192.168.1.0/24'
+    
+    """
+    
+    return '{0}/{1}'.format( int_to_ip(prefix[0]), prefix[1] )
+
+def parse_file( filename ):
+    """Return every valid IPv4 address in {filename}, as a sorted array
+    without duplicates.
+    
+    Examples:
+    
+    >>> f = open('/tmp/doctest_parse_file','w')
+    >>> f.write('10.0.0.2 10.0.0.1\\n10.0.0.2\\n')
+    >>> f.close()
+    >>> parse_file('/tmp/doctest_parse_file')
+    array('I', [167772161L, 167772162L])
+    
+    """
+    
+    rv = array( 'I' )
+    f = open( filename, 'r' )
+    while True:
+        # Read in large blocks, without cutting lines in half.
+        block = f.read( 1 << 20 ) + f.readline()
+        if not block: break
+        rv.extend( AddressSet.parse(block) )
+    f.close()
+    
+    rv = list(set( rv.tolist() ))
+    rv.sort()
+    return array( 'I', rv )
+
+def default_cache_dir():
+    """Return where the tools keep compiled host lists between runs: in
+    /var/cache/berlin where that can be written, and in ~/.cache/berlin
+    otherwise."""
+    
+    return '/var/cache/berlin/' if os.access( '/var/cache', os.W_OK ) \
+            else os.path.expanduser( '~/.cache/berlin/compiled/' )
+
+def cache_ready():
+    """Return whether AddressSet.cache_dir can be used, creating it if it
+    doesn't exist yet. It has to belong to the current user, and nobody else
+    may even look inside, since its contents are used as they are.
+    
+    Examples:
+    
+    >>> cache_ready()
+    True
+    >>> os.chmod( AddressSet.cache_dir, 0755 )
+    >>> cache_ready()
+    False
+    >>> os.chmod( AddressSet.cache_dir, 0700 )
+    
+    """
+    
+    try:
+        if not os.path.isdir( AddressSet.cache_dir ):
+            os.makedirs( AddressSet.cache_dir, 0700 )
+        st = os.lstat( AddressSet.cache_dir.rstrip('/') )
+    except OSError:
+        return False
+    return stat.S_ISDIR( st.st_mode ) and private( st ) and not st.st_mode & 077
+
+def cache_file( filename ):
+    """Return where the compiled version of {filename} is kept."""
+    
+    return AddressSet.cache_dir + hashlib.sha1( os.path.abspath(filename) ).hexdigest()
+
+def load_compiled( filename, st ):
+    """Load the compiled version of {filename}, whose os.stat() is {st}.
+    
+    The addresses are copied straight out of a memory map of the cache
+    file. It is only used if it was compiled from the same contents as
+    {filename} has now: if the size and modification time it recorded still
+    match, that is taken for granted, since nobody else can write to the
+    cache; if only the modification time changed, the SHA-1 of {filename}
+    has to match the recorded one. Returns None if there is no valid
+    compiled version.
+    
+    """
+    
+    try:
+        fd = os.open( cache_file(filename), os.O_RDWR | os.O_NOFOLLOW )
+        f = os.fdopen( fd, 'r+b' )
+    except OSError:
+        return None
+    if not private( os.fstat(fd) ):
+        f.close()
+        return None
+    
+    try:
+        M = mmap.mmap( f.fileno(), 0 )
+    except (mmap.error, ValueError):
+        f.close()
+        return None
+    
+    rv = None
+    if len(M) >= cache_header.size:
+        magic, size, mtime, digest, count = cache_header.unpack_from( M )
+        end = cache_header.size + 4*count
+        
+        valid = magic == cache_magic and len(M) == end and size == st.st_size
+        if valid and mtime != st.st_mtime:
+            valid = digest == hashlib.sha1( open(filename, 'rb').read() ).digest()
+            if valid:
+                # Touched, but not changed.
+                M[0:cache_header.size] = cache_header.pack( magic, size,
+                        st.st_mtime, digest, count )
+        if valid:
+            rv = array( 'I' )
+            rv.fromstring( M[cache_header.size:end] )
+    
+    M.close()
+    f.close()
+    return rv
+
+def save_compiled( filename, st, addresses ):
+    """Write the compiled version of {filename}, if the cache is writable."""
+    
+    try:
+        digest = hashlib.sha1( open(filename, 'rb').read() ).digest()
+        fn = cache_file( filename )
+        if os.path.lexists( fn + '.new' ):
+            os.unlink( fn + '.new' )
+        f = os.fdopen( os.open( fn + '.new',
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600 ), 'wb' )
+        f.write( cache_header.pack( cache_magic, st.st_size, st.st_mtime,
+                digest, len(addresses) ) )
+        addresses.tofile( f )
+        f.close()
+        os.rename( fn + '.new', fn )
+    except (IOError, OSError):
+        pass
+
+def compile_file( filename ):
+    """Return every valid IPv4 address in {filename}, as a sorted array
+    without duplicates, using the compiled version if it is up to date.
+    
+    Compiled host lists are shared by every filter in a run, and are cached
+    in AddressSet.cache_dir between runs, so a host list is only parsed
+    again when it changed. Raises an IOError if {filename} can't be read.
+    
+    Examples:
+    
+    >>> f = open('/tmp/doctest_compile_file_list','w')
+    >>> f.write('10.0.0.2 10.0.0.1\\n')
+    >>> f.close()
+    
+    >>> compile_file('/tmp/doctest_compile_file_list')
+    array('I', [167772161L, 167772162L])
+    >>> compiled.clear()
+    >>> load_compiled( '/tmp/doctest_compile_file_list',
+    ...     os.stat('/tmp/doctest_compile_file_list') )
+    array('I', [167772161L, 167772162L])
+    
+    Touching the file without changing it keeps the compiled version.
+    
+    >>> os.utime( '/tmp/doctest_compile_file_list', (1, 1) )
+    >>> load_compiled( '/tmp/doctest_compile_file_list',
+    ...     os.stat('/tmp/doctest_compile_file_list') )
+    array('I', [167772161L, 167772162L])
+    
+    >>> f = open('/tmp/doctest_compile_file_list','w')
+    >>> f.write('10.0.0.3\\n')
+    >>> f.close()
+    >>> compile_file('/tmp/doctest_compile_file_list')
+    array('I', [167772163L])
+    
+    """
+    
+    st = os.stat( filename )
+    stamp = ( st.st_size, st.st_mtime )
+    
+    if filename in compiled and compiled[filename][0] == stamp:
+        return compiled[filename][1]
+    
+    cache = AddressSet.cache_dir and cache_ready()
+    rv = load_compiled( filename, st ) if cache else None
+    if rv is None:
+        rv = parse_file( filename )
+        if cache:
+            save_compiled( filename, st, rv )
+    
+    compiled[filename] = ( stamp, rv )
+    return rv
+
+
+
+class PrefixTrie:
+    """A binary radix trie of IPv4 prefixes.
+    
+    Addresses have to be inserted in ascending order. A subtree can no longer
+    change once an address to its right has been inserted, so only the right-
+    most path of the trie is kept; everything to its left has already been
+    collapsed into the largest prefixes that are completely filled."""
+    
+    spine = None
+    
+    def __init__( self ):
+        # Prefixes on the rightmost path, as (network, length), root first.
+        self.spine = []
+    
+    def insert( self, address ):
+        """Add a single address, merging every pair of full siblings.
+        
+        Examples:
+        
+        >>> T = PrefixTrie()
+        >>> for a in [4, 5, 6, 7, 9]: T.insert(a)
+        >>> T.spine
+        [(4, 30), (9, 32)]
+        
+        """
+        
+        net, length = address, 32
+        while self.spine:
+            n, l = self.spine[-1]
+            if l != length or n & (1 << (32-l)) or n | (1 << (32-l)) != net:
+                break
+            # The left sibling is full as well, so their parent is.
+            self.spine.pop()
+            net, length = n, l-1
+        self.spine.append( (net, length) )
+    
+    def prefixes( self ):
+        """Return all prefixes in the trie, in ascending order."""
+        
+        return list( self.spine )
+
+
+class AddressSet:
+    """A set of IPv4 addresses.
+    
+    The addresses are stored as a sorted array of unsigned 32-bit integers,
+    which keeps large host lists compact, and makes set operations cheap."""
+    
+    addresses = None
+    
+    # Where compiled host lists are kept between runs; None, the default,
+    # disables that. The tools set it to default_cache_dir().
+    cache_dir = None
+    
+    def __init__( self, addresses=(), presorted=False ):
+        """Create a new AddressSet from an iterable of integers.
+        
+        If {presorted} is set, {addresses} must already be a sorted array
+        without duplicates, and is used as it is.
+        
+        Examples:
+        
+        >>> A = AddressSet([3, 1, 2, 3])
+        >>> len(A)
+        3
+        >>> list(A.addresses)
+        [1L, 2L, 3L]
+        
+        """
+        
+        if presorted:
+            self.addresses = addresses
+            return
+        
+        if not isinstance( addresses, array ):
+            addresses = array( 'I', addresses )
+        addresses = list(set( addresses.tolist() ))
+        addresses.sort()
+        self.addresses = array( 'I', addresses )
+    
+    @staticmethod
+    def parse( text ):
+        """Return every valid IPv4 address found in {text} as an array.
+        
+        Examples:
+        
+        >>> list(AddressSet.parse('10.0.0.1 and 999.1.1.1 (1.2.3.4)'))
+        [167772161L, 16909060L]
+        >>> list(AddressSet.parse('1.2.3.4.5 010.0.0.1 11.2.3.4/32'))
+        [184681220L]
+        
+        """
+        
+        packed = ''.join([ socket.inet_aton(t) for t in ip_pattern.findall(text) ])
+        rv = array( 'I' )
+        rv.fromstring( packed )
+        if sys.byteorder == 'little':
+            rv.byteswap()
+        return rv
+    
+    @staticmethod
+    def from_strings( addresses ):
+        """Create an AddressSet from a list of dotted quads.
+        
+        Examples:
+        
+        >>> AddressSet.from_strings(['10.0.0.2','10.0.0.1']).strings()
+        ['10.0.0.1', '10.0.0.2']
+        
+        """
+        
+        return AddressSet( AddressSet.parse('\n'.join(addresses)) )
+    
+    @staticmethod
+    def from_files( filenames ):
+        """Return all valid IPv4 addresses from every file in {filenames}.
+        
+        Relative filenames are looked up in every configuration directory,
+        and the addresses from all of them are combined. Every file is only
+        parsed once; see compile_file().
+        
+        Examples:
+        
+        >>> f = open('/tmp/doctest_from_files','w')
+        >>> f.write('127.0.0.1\\n10.0.0.1 127.0.0.1\\n256.0.0.1\\n')
+        >>> f.close()
+        
+        >>> AddressSet.from_files(['/tmp/doctest_from_files']).strings()
+        ['10.0.0.1', '127.0.0.1']
+        >>> len(AddressSet.from_files(['/tmp/nonexistent_file']))
+        0
+        
+        """
+        
+        parts = []
+        for F in filenames:
+            for L in locations if F[0] != '/' else ['']:
+                try:
+                    parts.append( compile_file( L + F ) )
+                except (IOError, OSError):
+                    continue
+        
+        if len(parts) == 1:
+            # Already sorted; copy it, so the compiled version can't change.
+            return AddressSet( parts[0][:], True )
+        
+        rv = array( 'I' )
+        for A in parts:
+            rv.extend( A )
+        return AddressSet( rv )
+    
+    def __len__( self ):
+        return len(self.addresses)
+    
+    def __iter__( self ):
+        return iter(self.addresses)
+    
+    def __contains__( self, ip ):
+        """Check whether {ip} is in this set.
+        
+        Examples:
+        
+        >>> A = AddressSet.from_strings(['10.0.0.1','10.0.0.3'])
+        >>> '10.0.0.3' in A
+        True
+        >>> ip_to_int('10.0.0.2') in A
+        False
+        
+        """
+        
+        if isinstance( ip, basestring ):
+            ip = ip_to_int(ip)
+        i = bisect_left( self.addresses, ip )
+        return i < len(self.addresses) and self.addresses[i] == ip
+    
+    def __repr__( self ):
+        return "AddressSet({0} addresses)".format( len(self) )
+    
+    def strings( self ):
+        """Return all addresses as a sorted list of dotted quads."""
+        
+        return [ int_to_ip(t) for t in self.addresses ]
+    
+    def union( self, other ):
+        """Return all addresses in either set.
+        
+        Examples:
+        
+        >>> A = AddressSet([1,2])
+        >>> B = AddressSet([2,3])
+        >>> list((A | B).addresses)
+        [1L, 2L, 3L]
+        
+        """
+        
+        return AddressSet( self.addresses + other.addresses )
+    
+    def intersection( self, other ):
+        """Return all addresses in both sets.
+        
+        Examples:
+        
+        >>> A = AddressSet([1,2])
+        >>> B = AddressSet([2,3])
+        >>> list((A & B).addresses)
+        [2L]
+        
+        """
+        
+        keep = set( other.addresses.tolist() )
+        return AddressSet( array( 'I',
+                [ t for t in self.addresses.tolist() if t in keep ] ), True )
+    
+    def difference( self, other ):
+        """Return all addresses in this set, but not in {other}.
+        
+        Examples:
+        
+        >>> A = AddressSet([1,2])
+        >>> B = AddressSet([2,3])
+        >>> list((A - B).addresses)
+        [1L]
+        
+        """
+        
+        drop = set( other.addresses.tolist() )
+        return AddressSet( array( 'I',
+                [ t for t in self.addresses.tolist() if t not in drop ] ), True )
+    
+    def aggregate( self ):
+        """Return the smallest list of CIDR prefixes covering exactly this set.
+        
+        The result is a sorted list of (network, length) tuples. No address
+        outside the set is ever covered.
+        
+        Examples:
+        
+        >>> A = AddressSet.from_strings([ '10.0.0.{0}'.format(t) for t in
+        ...     range(0,8) + [9,10,11,12] ])
+        >>> [ prefix_to_string(t) for t in A.aggregate() ]
+        ['10.0.0.0/29', '10.0.0.9/32', '10.0.0.10/31', '10.0.0.12/32']
+        
+        >>> B = AddressSet( range(0, 1024, 3) )
+        >>> len(B.aggregate()) == len(B)
+        True
+        >>> AddressSet.from_prefixes( A.aggregate() ).addresses == A.addresses
+        True
+        
+        """
+        
+        T = PrefixTrie()
+        for a in self.addresses:
+            T.insert( a )
+        return T.prefixes()
+    
+    @staticmethod
+    def from_prefixes( prefixes ):
+        """Create an AddressSet from a list of (network, length) tuples.
+        
+        Examples:
+        
+        >>> AddressSet.from_prefixes([ (8, 30), (1, 32) ]).addresses
+        array('I', [1L, 8L, 9L, 10L, 11L])
+        
+        """
+        
+        rv = array( 'I' )
+        for net, length in prefixes:
+            rv.extend( xrange( net, net + (1 << (32-length)) ) )
+        return AddressSet( rv )
+    
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
+
+if __name__ == '__main__':
+    import doctest, tempfile
+    AddressSet.cache_dir = tempfile.mkdtemp() + '/'
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    
+    import os,sys,shutil
+    os.unlink('/tmp/doctest_from_files')
+    os.unlink('/tmp/doctest_parse_file')
+    os.unlink('/tmp/doctest_compile_file_list')
+    shutil.rmtree( AddressSet.cache_dir )
+    
+    sys.exit( fail )
@@ -0,0 +1,658 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+from collections import defaultdict
+from addresses import ip_to_int
+from rule import Rule, parse_mark
+from optimize import port_range
+from ruleset import Ruleset
+
+# An address on the Internet, for packets coming from or going there
+# (TEST-NET-2, from RFC 5737).
+remote = '198.51.100.7'
+
+# Targets that decide a packet's fate in the table they are in.
+verdicts = set([ 'ACCEPT', 'DROP', 'REJECT' ])
+
+
+def parse_network( net ):
+    """Return a network in CIDR notation as an (address, length) tuple.
+    
+    Examples:
+    
+    >>> parse_network('10.0.0.0/8'), parse_network('10.0.0.1')
+    ((167772160, 8), (167772161, 32))
+    
+    """
+    
+    if '/' in net:
+        address, length = net.split('/')
+        return ( ip_to_int(address), int(length) )
+    return ( ip_to_int(net), 32 )
+
+def in_network( address, net ):
+    """Check whether the dotted quad {address} is inside {net}.
+    
+    Examples:
+    
+    >>> in_network('192.168.1.5', '192.168.1.0/24'), in_network('192.168.2.5', '192.168.1.0/24')
+    (True, False)
+    
+    """
+    
+    network, length = parse_network( net )
+    mask = ( 0xffffffff << (32-length) ) & 0xffffffff
+    return ip_to_int( address ) & mask == network & mask
+
+def iface_matches( pattern, iface ):
+    """Check whether interface {iface} matches {pattern}, which may end in
+    a + as a wildcard."""
+    
+    if iface is None:
+        return False
+    if pattern.endswith('+'):
+        return iface.startswith( pattern[:-1] )
+    return iface == pattern
+
+def port_matches( spec, port ):
+    """Check whether {port} is in {spec}, a comma separated list of ports
+    and port ranges.
+    
+    Examples:
+    
+    >>> port_matches('25,465:587', 500), port_matches('25,465:587', 80)
+    (True, False)
+    
+    """
+    
+    if port is None:
+        return False
+    for p in spec.split(','):
+        first, last = port_range( p )
+        if first <= port <= last:
+            return True
+    return False
+
+def mark_matches( spec, mark ):
+    """Check whether {mark} matches {spec}, of the form value[/mask]."""
+    
+    value, _, mask = spec.partition('/')
+    mask = int( mask, 0 ) if mask else 0xffffffff
+    return mark & mask == int( value, 0 ) & mask
+
+
+class Packet(object):
+    """The first packet of a class of packets: where it comes from, where it
+    goes, and which connection state it is in.
+    
+    {iface_in} is None for packets the firewall sends itself, and
+    {iface_out} is None for packets addressed to the firewall."""
+    
+    __slots__ = ( 'name', 'source', 'destination', 'iface_in', 'iface_out',
+            'protocol', 'sport', 'dport', 'state', 'helper', 'mark', 'ctmark' )
+    
+    def __init__( self, name, source, destination, iface_in=None,
+            iface_out=None, protocol='tcp', sport=None, dport=None,
+            state='NEW', helper=None, mark=0, ctmark=0 ):
+        self.name = name
+        self.source = source
+        self.destination = destination
+        self.iface_in = iface_in
+        self.iface_out = iface_out
+        self.protocol = protocol
+        self.sport = sport
+        self.dport = dport
+        self.state = state
+        self.helper = helper
+        self.mark = mark
+        self.ctmark = ctmark
+    
+    def copy( self, **changes ):
+        """Return a copy of this packet, with some fields replaced."""
+        
+        rv = Packet.__new__( Packet )
+        for f in Packet.__slots__:
+            setattr( rv, f, changes.get( f, getattr(self, f) ) )
+        return rv
+    
+    def __repr__( self ):
+        return 'Packet({0!r})'.format( self.name )
+
+
+class Trace(object):
+    """The way a packet went through the firewall.
+    
+    {chains} holds the number of rules evaluated in every (table, chain),
+    {entered} those chains in the order the packet entered them, {path}
+    every rule that matched, as (table, chain, number, rule) tuples, and
+    {verdict} what became of the packet. {decision} is the entry of {path}
+    that decided it, with number and rule None if a chain policy did."""
+    
+    def __init__( self, packet ):
+        self.packet = packet
+        self.chains = defaultdict( int )
+        self.entered = []
+        self.path = []
+        self.verdict = None
+        self.decision = None
+    
+    def cost( self ):
+        """Return the total number of rules evaluated."""
+        
+        return sum( self.chains.values() )
+
+
+class Analyzer:
+    """Follows packets through a ruleset, the way netfilter would.
+    
+    {local} is a list of the firewall's own addresses, and {routes} a list
+    of (network, interface) tuples, used to find out where a packet goes
+    after its destination was changed."""
+    
+    def __init__( self, ruleset, local=(), routes=() ):
+        self.ruleset = ruleset
+        self.local = set( local ) | set([ '127.0.0.1' ])
+        self.routes = sorted( routes, key=lambda t: -parse_network(t[0])[1] )
+        # The interface to every address looked up so far.
+        self.interfaces = dict()
+        
+        # Index the members of every set by the prefix lengths they use, so
+        # a lookup takes a handful of probes, rather than one per member.
+        self.sets = dict()
+        for name, ipset in ruleset.all_sets.items():
+            index = defaultdict( set )
+            for m in ipset['members']:
+                nets = [ parse_network(t) for t in m.split(',') ]
+                lengths = tuple([ t[1] for t in nets ])
+                index[lengths].add( tuple([ a & ( (0xffffffff << (32-l)) & 0xffffffff )
+                        for a, l in nets ]) )
+            self.sets[name] = index
+    
+    def in_set( self, name, addresses ):
+        """Check whether the tuple {addresses} is in the set called {name}."""
+        
+        addresses = [ ip_to_int(t) for t in addresses ]
+        for lengths, members in self.sets.get( name, dict() ).items():
+            if len(lengths) != len(addresses):
+                continue
+            key = tuple([ a & ( (0xffffffff << (32-l)) & 0xffffffff )
+                    for a, l in zip( addresses, lengths ) ])
+            if key in members:
+                return True
+        return False
+    
+    def module_matches( self, module, options, P ):
+        """Check whether packet {P} passes the match module {module} with
+        {options}. Options that can't be decided statically, such as rate
+        limits, are assumed to match."""
+        
+        i = 0
+        while i < len(options):
+            negate = options[i] == '!'
+            if negate:
+                i += 1
+            option = options[i]
+            value = options[i+1] if i+1 < len(options) else ''
+            i += 2
+            
+            if module == 'set' and option == '--match-set':
+                fields = options[i].split(',')
+                i += 1
+                ok = self.in_set( value, [ P.source if t == 'src' else P.destination
+                        for t in fields ] )
+            elif option in ('--dports', '--destination-ports', '--dport'):
+                ok = port_matches( value, P.dport )
+            elif option in ('--sports', '--source-ports', '--sport'):
+                ok = port_matches( value, P.sport )
+            elif option == '--ports':
+                ok = port_matches( value, P.sport ) or port_matches( value, P.dport )
+            elif option in ('--state', '--ctstate'):
+                ok = P.state in value.split(',')
+            elif module == 'helper' and option == '--helper':
+                ok = P.helper == value
+            elif module == 'mark' and option == '--mark':
+                ok = mark_matches( value, P.mark )
+            elif module == 'connmark' and option == '--mark':
+                ok = mark_matches( value, P.ctmark )
+            else:
+                # Flags without a value, such as --syn, take one token.
+                if value.startswith('-') or value == '!':
+                    i -= 1
+                ok = True
+            
+            if ok == negate:
+                return False
+        return True
+    
+    def matches( self, rule, P ):
+        """Check whether {rule} matches packet {P}.
+        
+        Examples:
+        
+        >>> from ruleset import Ruleset
+        >>> A = Analyzer( Ruleset() )
+        >>> P = Packet( 'web', '192.168.1.5', remote, 'eth1', 'eth0', dport=80 )
+        >>> A.matches( Rule.parse('-s 192.168.1.0/24 -i eth+ -p tcp --dport 80 -j ACCEPT'), P )
+        True
+        >>> A.matches( Rule.parse('-p tcp -m multiport ! --dports 80,443 -j ACCEPT'), P )
+        False
+        >>> A.matches( Rule.parse('! -s 192.168.0.0/16 -j DROP'), P )
+        False
+        
+        """
+        
+        if rule.source and not in_network( P.source, rule.source ):
+            return False
+        if rule.destination and not in_network( P.destination, rule.destination ):
+            return False
+        if rule.iface_in and not iface_matches( rule.iface_in, P.iface_in ):
+            return False
+        if rule.iface_out and not iface_matches( rule.iface_out, P.iface_out ):
+            return False
+        if rule.protocol and rule.protocol not in ( P.protocol, 'all' ):
+            return False
+        if rule.sport and not port_matches( rule.sport, P.sport ):
+            return False
+        if rule.dport and not port_matches( rule.dport, P.dport ):
+            return False
+        if rule.state and P.state not in rule.state:
+            return False
+        
+        for m in rule.matches:
+            if m[0] == '-m':
+                if not self.module_matches( m[1], m[2:], P ):
+                    return False
+            elif m[0] == '!' and len(m) == 3:
+                field = Rule.parse( ' '.join( m[1:] ) )
+                if self.matches( field, P ):
+                    return False
+        return True
+    
+    def interface( self, address ):
+        """Return the interface traffic to {address} leaves through, or None
+        if it is one of the firewall's own addresses, or there is no route."""
+        
+        if address in self.interfaces:
+            return self.interfaces[ address ]
+        
+        rv = None
+        if address not in self.local:
+            for net, iface in self.routes:
+                if in_network( address, net ):
+                    rv = iface
+                    break
+        self.interfaces[ address ] = rv
+        return rv
+    
+    def route( self, P ):
+        """Return the interface packet {P} leaves through, or None if it is
+        for the firewall itself."""
+        
+        if P.destination in self.local:
+            return None
+        return self.interface( P.destination ) or P.iface_out
+    
+    def run_chain( self, table, chain, P, trace, depth=0 ):
+        """Send packet {P} through {chain}. Returns the verdict, or RETURN
+        if the packet fell off the end, and the packet as it is then."""
+        
+        if depth > 64:
+            raise Exception( "Chain {0} in table {1} loops.".format(chain, table) )
+        
+        if (table, chain) not in trace.entered:
+            trace.entered.append( (table, chain) )
+        
+        n = 0
+        for r in self.ruleset.all_chains[table][chain]['rules']:
+            if not isinstance( r, Rule ):
+                continue
+            n += 1
+            trace.chains[ (table, chain) ] += 1
+            if not self.matches( r, P ):
+                continue
+            trace.path.append( (table, chain, n, r) )
+            
+            args = dict( zip( r.target_args[::2], r.target_args[1::2] ) )
+            if r.target in self.ruleset.all_chains[table]:
+                verdict, P = self.run_chain( table, r.target, P, trace, depth+1 )
+                if verdict != 'RETURN' or r.goto:
+                    return verdict, P
+            elif r.target in verdicts or r.target == 'RETURN':
+                # Accepting in the nat table only skips the rest of it.
+                if r.target in verdicts and ( table != 'nat' or r.target != 'ACCEPT' ):
+                    trace.decision = trace.path[-1]
+                return r.target, P
+            elif r.target == 'DNAT':
+                to = ( args.get('--to-destination') or args.get('--to') ).split(':')
+                P = P.copy( destination=to[0],
+                        dport=int(to[1]) if len(to) > 1 else P.dport )
+                return 'ACCEPT', P
+            elif r.target == 'SNAT':
+                return 'ACCEPT', P.copy( source=args['--to-source'].split(':')[0] )
+            elif r.target in ('MASQUERADE', 'REDIRECT'):
+                if r.target == 'REDIRECT':
+                    P = P.copy( destination='127.0.0.1' )
+                return 'ACCEPT', P
+            elif r.target == 'MARK' and '--set-xmark' in args:
+                value, mask = parse_mark( args['--set-xmark'] )
+                P = P.copy( mark=( P.mark & ~mask ) ^ value )
+            elif r.target == 'CONNMARK' and '--set-xmark' in args:
+                value, mask = parse_mark( args['--set-xmark'] )
+                P = P.copy( ctmark=( P.ctmark & ~mask ) ^ value )
+            elif r.target == 'CONNMARK' and '--restore-mark' in r.target_args:
+                P = P.copy( mark=P.ctmark )
+            elif r.target == 'CONNMARK' and '--save-mark' in r.target_args:
+                P = P.copy( ctmark=P.mark )
+            # Anything else, such as LOG, lets the packet carry on.
+        
+        return 'RETURN', P
+    
+    def hook( self, table, chain, P, trace ):
+        """Send {P} through a built-in chain, applying its policy."""
+        
+        verdict, P = self.run_chain( table, chain, P, trace )
+        if verdict == 'RETURN':
+            verdict = self.ruleset.all_chains[table][chain]['policy']
+            if table != 'nat' or verdict != 'ACCEPT':
+                trace.decision = ( table, chain, None, None )
+        return verdict, P
+    
+    def connection_mark( self, P ):
+        """Return the connection mark of {P}, as set when its connection was
+        set up: as if {P} was the first packet of its connection."""
+        
+        if P.ctmark:
+            return P.ctmark
+        verdict, Q = self.hook( 'nat', 'PREROUTING', P.copy( state='NEW' ), Trace(P) )
+        return Q.ctmark
+    
+    def trace( self, P ):
+        """Follow packet {P} through every chain it passes, and return the
+        Trace. The nat table is only consulted for new connections.
+        
+        Examples:
+        
+        >>> from ruleset import Ruleset
+        >>> R = Ruleset()
+        >>> R.new_chain( 'to_gateway', table='nat', policy='-' )
+        >>> R.append_chain( 'to_gateway', '-s 192.168.1.0/24 -j DNAT --to-destination 192.168.1.1', table='nat' )
+        >>> R.append_chain( 'PREROUTING', '-p tcp --dport 22 -j ACCEPT', table='nat' )
+        >>> R.append_chain( 'PREROUTING', '-p tcp --dport 80 -g to_gateway', table='nat' )
+        >>> R.append_chain( 'INPUT', '-i eth1 -p tcp --dport 22 -j ACCEPT' )
+        >>> R.append_chain( 'INPUT', '-i eth1 -p tcp --dport 80 -j ACCEPT' )
+        >>> R.append_chain( 'FORWARD', '-i eth1 -j ACCEPT' )
+        
+        >>> A = Analyzer( R, local=['192.168.1.1'] )
+        >>> T = A.trace( Packet( 'web', '192.168.1.5', remote, 'eth1', 'eth0', dport=80 ) )
+        >>> T.verdict, T.cost(), T.chains[('nat','to_gateway')], T.chains[('filter','INPUT')]
+        ('ACCEPT', 5, 1, 2)
+        
+        >>> T = A.trace( Packet( 'reply', '192.168.1.5', remote, 'eth1', 'eth0',
+        ...     sport=80, state='ESTABLISHED' ) )
+        >>> T.verdict, T.cost(), T.decision
+        ('ACCEPT', 1, ('filter', 'FORWARD', 1, Rule('-i eth1 -j ACCEPT')))
+        
+        Later packets carry the connection mark the first one was given.
+        
+        >>> R.append_chain( 'PREROUTING', '-i eth1 -j CONNMARK --set-mark 0x1000', table='nat' )
+        >>> R.append_chain( 'INPUT', '-m connmark --mark 0x1000 -j ACCEPT' )
+        >>> T = A.trace( Packet( 'ssh', '192.168.1.5', '192.168.1.1', 'eth1', sport=40000,
+        ...     dport=2222, state='ESTABLISHED' ) )
+        >>> T.verdict, T.cost()
+        ('ACCEPT', 3)
+        
+        """
+        
+        trace = Trace( P )
+        new = P.state == 'NEW'
+        verdict = 'ACCEPT'
+        
+        if P.iface_in is None:
+            # Sent by the firewall itself.
+            if new:
+                verdict, P = self.hook( 'nat', 'OUTPUT', P, trace )
+            verdict, P = self.hook( 'filter', 'OUTPUT', P, trace )
+            hooks = [ ('nat','POSTROUTING') ]
+        else:
+            if new:
+                verdict, P = self.hook( 'nat', 'PREROUTING', P, trace )
+            else:
+                P = P.copy( ctmark=self.connection_mark(P) )
+            P = P.copy( iface_out=self.route(P) )
+            if P.iface_out is None:
+                verdict, P = self.hook( 'filter', 'INPUT', P, trace )
+                hooks = []
+            else:
+                verdict, P = self.hook( 'filter', 'FORWARD', P, trace )
+                hooks = [ ('nat','POSTROUTING') ]
+        
+        if verdict == 'ACCEPT' and new:
+            for tb, ch in hooks:
+                verdict, P = self.hook( tb, ch, P, trace )
+        
+        trace.verdict = verdict
+        return trace
+
+
+def routing( C ):
+    """Return the local addresses and routes of the configuration {C}, as
+    Analyzer() expects them."""
+    
+    Ext = [ t for t in C.Interfaces if t.enabled and     t.wan_interface ]
+    Int = [ t for t in C.Interfaces if t.enabled and not t.wan_interface ]
+    
+    local = [ E.address for E in Ext ] + [ N.gw() for I in Int for N in I.subnets ]
+    routes = [ (N.net(), I.name) for I in Int for N in I.subnets ]
+    if Ext:
+        routes.append( ('0.0.0.0/0', Ext[0].name) )
+    return local, routes
+
+def saved_ruleset( filename, sets_file=None ):
+    """Return the ruleset saved in {filename}, with the sets in {sets_file},
+    as Analyzer() expects it. See Ruleset.import_saved()."""
+    
+    R = Ruleset()
+    R.import_saved( filename, sets_file )
+    return R
+
+def packet_classes( C ):
+    """Return a list of representative packets for the configuration {C}.
+    
+    Hosts are taken from the middle of every subnet, and remote hosts from
+    TEST-NET-2, so no packet accidentally matches a host list."""
+    
+    Ext = [ t for t in C.Interfaces if t.enabled and     t.wan_interface ]
+    Int = [ t for t in C.Interfaces if t.enabled and not t.wan_interface ]
+    host = lambda N: N.net().replace( '.0/24', '.150' )
+    closed = max( list(C.local_services) + [ p for p, h in C.network_services ] + [1023] ) + 1
+    
+    rv = []
+    for E in Ext:
+        for P in C.local_services[:1]:
+            rv.append( Packet( 'new WAN TCP to open port {0} on {1}'.format(P, E.name),
+                    remote, E.address, E.name, sport=40000, dport=P ) )
+        for P, target in C.network_services[:1]:
+            rv.append( Packet( 'new WAN TCP to forwarded port {0} on {1}'.format(P, E.name),
+                    remote, E.address, E.name, sport=40000, dport=P ) )
+        rv.append( Packet( 'new WAN TCP to closed port {0} on {1}'.format(closed, E.name),
+                remote, E.address, E.name, sport=40000, dport=closed ) )
+        rv.append( Packet( 'ICMP to {0}'.format(E.name),
+                remote, E.address, E.name, protocol='icmp' ) )
+        rv.append( Packet( 'outgoing from the firewall on {0}'.format(E.name),
+                E.address, remote, None, E.name, sport=40000, dport=80 ) )
+        
+        for I in Int:
+            for N in I.subnets:
+                rv.append( Packet( 'established WAN to LAN {0} on {1}'.format(N.net(), I.name),
+                        remote, host(N), E.name, I.name, sport=443, dport=40000,
+                        state='ESTABLISHED' ) )
+    
+    for I in Int:
+        for N in I.subnets:
+            E = Ext[0].name if Ext else None
+            where = '{0}{1} on {2}'.format( N.net(),
+                    ''.join([ ' ({0})'.format(t) for t in N.policies ]), I.name )
+            rv.append( Packet( 'established LAN to WAN from ' + where,
+                    host(N), remote, I.name, E, sport=40000, dport=443,
+                    state='ESTABLISHED' ) )
+            rv.append( Packet( 'new LAN to WAN port 80 from ' + where,
+                    host(N), remote, I.name, E, sport=40000, dport=80 ) )
+            rv.append( Packet( 'new LAN to WAN port 587 from ' + where,
+                    host(N), remote, I.name, E, sport=40000, dport=587 ) )
+            rv.append( Packet( 'new LAN DNS query to the gateway from ' + where,
+                    host(N), N.gw(), I.name, protocol='udp', sport=40000, dport=53 ) )
+            rv.append( Packet( 'established LAN to the gateway from ' + where,
+                    host(N), N.gw(), I.name, sport=40000, dport=22, state='ESTABLISHED' ) )
+            rv.append( Packet( 'established from the gateway to ' + where,
+                    N.gw(), host(N), None, I.name, sport=22, dport=40000,
+                    state='ESTABLISHED' ) )
+    for E in Ext:
+        rv.append( Packet( 'established WAN to the firewall on {0}'.format(E.name),
+                remote, E.address, E.name, sport=80, dport=40000, state='ESTABLISHED' ) )
+    return rv
+
+def reply( P ):
+    """Return a packet going the other way on the connection of packet {P},
+    leaving address translation aside.
+    
+    Examples:
+    
+    >>> P = reply( Packet( 'web', '192.168.1.5', remote, 'eth1', 'eth0', sport=40000, dport=80 ) )
+    >>> P.source, P.destination, P.iface_in, P.iface_out, P.sport, P.dport
+    ('198.51.100.7', '192.168.1.5', 'eth0', 'eth1', 80, 40000)
+    
+    """
+    
+    return P.copy( source=P.destination, destination=P.source,
+            iface_in=P.iface_out, iface_out=P.iface_in, sport=P.dport, dport=P.sport )
+
+def possible( analyzer, P ):
+    """Check whether the connection of packet {P} can exist at all under the
+    rules of {analyzer}: new packets always can, but established or related
+    ones only if the rules let a new connection through in either direction."""
+    
+    if P.state not in ( 'ESTABLISHED', 'RELATED' ):
+        return True
+    for Q in ( P, reply(P) ):
+        if analyzer.trace( Q.copy( state='NEW' ) ).verdict == 'ACCEPT':
+            return True
+    return False
+
+def differences( reference, analyzer, packets ):
+    """Return the packets in {packets} that {analyzer} treats differently
+    than {reference}, with both traces, as a list of (packet, trace, trace)
+    tuples. Packets of connections {reference} never lets through don't
+    count, since they can't occur.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> R = Ruleset()
+    >>> R.append_chain( 'INPUT', '-i eth1 -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i eth0 -p tcp --sport 80 -m state --state RELATED,ESTABLISHED -j ACCEPT' )
+    >>> F = Ruleset()
+    >>> F.append_chain( 'INPUT', '-m state --state RELATED,ESTABLISHED -j ACCEPT' )
+    >>> F.append_chain( 'INPUT', '-i eth1 -j ACCEPT' )
+    >>> P = [ Packet( 'ssh', '192.168.1.5', '192.168.1.1', 'eth1', dport=22 ),
+    ...     Packet( 'spoofed', '192.168.1.5', '192.168.1.1', 'eth0', dport=22, state='ESTABLISHED' ),
+    ...     Packet( 'new', remote, '192.168.1.1', 'eth0', dport=22 ) ]
+    >>> Analyzer( R ).trace( P[1] ).verdict, Analyzer( F ).trace( P[1] ).verdict
+    ('DROP', 'ACCEPT')
+    >>> differences( Analyzer( R ), Analyzer( F ), P )
+    []
+    >>> F.append_chain( 'INPUT', '-i eth0 -j ACCEPT' )
+    >>> [ (P.name, a.verdict, b.verdict) for P, a, b in differences( Analyzer( R ), Analyzer( F ), P ) ]
+    [('new', 'DROP', 'ACCEPT')]
+    
+    """
+    
+    rv = []
+    for P in packets:
+        a, b = reference.trace( P ), analyzer.trace( P )
+        if a.verdict != b.verdict and possible( reference, P ):
+            rv.append( (P, a, b) )
+    return rv
+
+def chain_depths( traces ):
+    """Return the number of rules each trace evaluated in every chain it
+    entered, as a dict of lists by (table, chain)."""
+    
+    rv = defaultdict( list )
+    for T in traces:
+        for key, n in T.chains.items():
+            rv[key].append( n )
+    return rv
+
+def report( ruleset, traces, top=5 ):
+    """Describe {traces} as a list of lines: the cost of every packet class,
+    the worst and typical (median) number of rules evaluated in every chain,
+    and the {top} most expensive paths, chain by chain.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> R = Ruleset()
+    >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-p tcp --dport 22 -j ACCEPT' )
+    >>> A = Analyzer( R, local=['10.0.0.1'] )
+    >>> T = [ A.trace( Packet( 'ssh', remote, '10.0.0.1', 'eth0', dport=22 ) ),
+    ...     A.trace( Packet( 'web', remote, '10.0.0.1', 'eth0', dport=80 ) ) ]
+    >>> for line in report( R, T, top=1 ): print line
+    Rules evaluated per packet class:
+          2  ACCEPT  ssh
+          2  DROP    web
+    <BLANKLINE>
+    Rules evaluated per chain:
+      rules  worst  typical  classes  chain
+          2      2        2        2  filter INPUT
+    <BLANKLINE>
+    Most expensive paths:
+      ssh (2 rules, ACCEPT)
+          2  filter INPUT
+    
+    """
+    
+    traces = sorted( traces, key=lambda T: ( -T.cost(), T.packet.name ) )
+    rv = [ 'Rules evaluated per packet class:' ]
+    for T in traces:
+        rv.append( '{0:7d}  {1:<6s}  {2}'.format( T.cost(), T.verdict, T.packet.name ) )
+    
+    rv += [ '', 'Rules evaluated per chain:',
+            '  rules  worst  typical  classes  chain' ]
+    depths = chain_depths( traces )
+    for (tb, ch), d in sorted( depths.items(), key=lambda t: -max(t[1]) ):
+        size = len([ t for t in ruleset.all_chains[tb][ch]['rules'] if isinstance(t, Rule) ])
+        rv.append( '{0:7d} {1:6d} {2:8d} {3:8d}  {4} {5}'.format( size, max(d),
+                sorted(d)[ len(d) // 2 ], len(d), tb, ch ) )
+    
+    rv += [ '', 'Most expensive paths:' ]
+    for T in traces[:top]:
+        rv.append( '  {0} ({1} rules, {2})'.format( T.packet.name, T.cost(), T.verdict ) )
+        for key in T.entered:
+            if T.chains.get( key ):
+                rv.append( '      {0:5d}  {1} {2}'.format( T.chains[key], *key ) )
+    return rv
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
@@ -21,24 +21,87 @@
 KW = '205.196.209.62'
 
 from ruleset import Ruleset
+from rule import Rule
 from output import debug
 
+# Reject packets the polite way.
+REJECT = dict({ 'target': 'REJECT',
+        'target_args': '--reject-with icmp-port-unreachable' })
+
+
+def in_set( name, direction ):
+    """Return a match against the ipset {name}.
+    
+    Examples:
+    
+    >>> print Rule( matches=[in_set('local_nets', 'src')], target='ACCEPT' )
+    -m set --match-set local_nets src -j ACCEPT
+    
+    """
+    
+    return '-m set --match-set {0} {1}'.format( name, direction )
+
+# The connection marks set by the classify chain: the number of the subnet a
+# flow comes from, the policy of that subnet, and the role of the interface
+# it comes in on.
+mark_subnet = 0xff
+mark_policy = dict( adblock=0x100, malware=0x200 )
+mark_policies = 0x300
+mark_lan = 0x1000
+mark_wan = 0x2000
+mark_role = mark_lan | mark_wan
+
+def has_mark( value, mask ):
+    """Return a match against the connection mark {value}, under {mask}.
+    
+    Examples:
+    
+    >>> print Rule( matches=[has_mark(mark_lan, mark_role)], target='ACCEPT' )
+    -m connmark --mark 0x1000/0x3000 -j ACCEPT
+    
+    """
+    
+    return '-m connmark --mark 0x{0:x}/0x{1:x}'.format( value, mask )
+
 class Berlin(Ruleset):
     
     malware_blocked = False
     ads_blocked = False
     
+    # Match the local subnets against ipsets, with one rule per interface,
+    # rather than with one rule per subnet.
+    subnet_sets = False
+    
+    # Mark every connection with its subnet, policy and interface role when
+    # it is set up, and match later rules against that mark.
+    classify_flows = False
+    
+    # Accept packets of established connections at the top of INPUT, FORWARD
+    # and OUTPUT, so that only new connections pass the other rules.
+    fast_path = False
+    
     def malware( self, Net ):
         """Apply the 'malware' policy to the subnet."""
         
         if not self.malware_blocked:
             self.create_filter( 'malware_filter', ["malware-hosts"] )
             self.malware_blocked = True
+            if self.classify_flows:
+                self.append_chain(
+                    'PREROUTING',
+                    Rule( protocol='tcp', dport=80,
+                        matches=[ has_mark( mark_lan | mark_policy['malware'],
+                            mark_role | mark_policies ) ],
+                        state='NEW,RELATED,ESTABLISHED', target='malware_filter', goto=True ),
+                    table='nat'
+                )
+        if self.classify_flows:
+            return
         
         self.append_chain(
             'PREROUTING',
-            '-s {0} -p tcp -m tcp --dport 80 -m state --state NEW,RELATED,ESTABLISHED '
-                '-g malware_filter'.format( Net.net() ),
+            Rule( source=Net.net(), protocol='tcp', dport=80,
+                state='NEW,RELATED,ESTABLISHED', target='malware_filter', goto=True ),
             table='nat'
         )
     
@@ -46,16 +109,144 @@ class Berlin(Ruleset):
         """Apply the 'adblock' policy to the subnet."""
         
         if not self.ads_blocked:
-            self.create_filter( 'ad_filter', ["ad-hosts","malware-hosts"] )
+            self.create_filter( 'ad_filter', ["ad-hosts","malware-hosts"],
+                    exclude=["apache/whitelist.conf"] )
             self.ads_blocked = True
+            if self.classify_flows:
+                self.append_chain(
+                    'PREROUTING',
+                    Rule( protocol='tcp', dport=80,
+                        matches=[ has_mark( mark_lan | mark_policy['adblock'],
+                            mark_role | mark_policies ) ],
+                        state='NEW,RELATED,ESTABLISHED', target='ad_filter', goto=True ),
+                    table='nat'
+                )
+        if self.classify_flows:
+            return
         
         self.append_chain(
             'PREROUTING',
-            '-s {0} -p tcp -m tcp --dport 80 -m state --state NEW,RELATED,ESTABLISHED '
-                '-g ad_filter'.format( Net.net() ),
+            Rule( source=Net.net(), protocol='tcp', dport=80,
+                state='NEW,RELATED,ESTABLISHED', target='ad_filter', goto=True ),
             table='nat'
         )
     
+    def smtp( self ):
+        """Reject all forwarded SMTP traffic, save for submission (ports 465
+        and 587) to the hosts in smtp-hosts.
+        
+        A single rule sends all SMTP traffic, whichever interfaces it comes
+        in and goes out on, to the smtp chain, which looks up the destination
+        of submission traffic in smtp_filter (a single set match, with
+        use_ipset ). Everything else is logged, at most a few times a minute,
+        and rejected. This comes before any port forward, so forwarding port
+        25 still doesn't let SMTP in from outside, and it covers SMTP between
+        internal subnets as well.
+        
+        Examples:
+        
+        >>> V = Berlin()
+        >>> V.smtp()
+        >>> V.all_chains['filter']['FORWARD']['rules']
+        [Rule('-p tcp -m multiport --dports 25,465,587 -g smtp')]
+        >>> for r in V.all_chains['filter']['smtp']['rules']: print r
+        -p tcp -m multiport --dports 465,587 -j smtp_filter
+        -m limit --limit 6/min --limit-burst 10 -j LOG --log-prefix "  [SMTP] "
+        -j REJECT --reject-with icmp-port-unreachable
+        
+        """
+        
+        self.create_filter( 'smtp_filter', ["smtp-hosts"], table='filter',
+                      action='-j ACCEPT')
+        self.new_chain( 'smtp', policy='-' )
+        self.append_chain( 'smtp', Rule( protocol='tcp',
+            matches=['-m multiport --dports 465,587'], target='smtp_filter' ) )
+        self.append_chain( 'smtp', Rule( target='LOG',
+            matches=['-m limit --limit 6/min --limit-burst 10'],
+            target_args=['--log-prefix','  [SMTP] '] ) )
+        self.append_chain( 'smtp', Rule( **REJECT ) )
+        self.append_chain('FORWARD',Rule( protocol='tcp',
+            matches=['-m multiport --dports 25,465,587'], target='smtp',
+            goto=True ))
+    
+    def classify( self, Ext, Int ):
+        """Create the classify chain, which marks every new connection coming
+        in on the interfaces in {Ext} or {Int} with its subnet, the policy of
+        that subnet and the role of the interface. Only the first packet of a
+        connection passes the nat table, so this is done once per connection;
+        every later rule matching the mark holds for the whole connection.
+        
+        Examples:
+        
+        >>> from network_config import Iface, Subnet
+        >>> E = Iface( 'eth0' )
+        >>> I = Iface( 'eth1' ); I.subnets = [ Subnet('1'), Subnet('2') ]
+        >>> I.subnets[0].policies = ['adblock']; I.subnets[1].policies = []
+        >>> V = Berlin()
+        >>> V.classify( [E], [I] )
+        >>> V.all_chains['nat']['PREROUTING']['rules']
+        [Rule('-j classify')]
+        >>> for r in V.all_chains['nat']['classify']['rules']: print r
+        -i eth0 -j CONNMARK --set-xmark 0x2000/0xffffffff
+        -s 192.168.1.0/24 -i eth1 -j CONNMARK --set-xmark 0x1101/0xffffffff
+        -s 192.168.2.0/24 -i eth1 -j CONNMARK --set-xmark 0x1002/0xffffffff
+        
+        """
+        
+        nets = [ (I, N) for I in Int for N in I.subnets ]
+        if len(nets) > mark_subnet:
+            raise Exception( "At most {0} subnets can be told apart by their "
+                    "connection mark.".format( mark_subnet ) )
+        
+        self.new_chain( 'classify', table='nat', policy='-' )
+        self.append_chain( 'PREROUTING', Rule( target='classify' ), table='nat' )
+        for E in Ext:
+            self.append_chain( 'classify', Rule( iface_in=E.name, target='CONNMARK',
+                target_args=['--set-mark', '0x{0:x}'.format(mark_wan)] ), table='nat' )
+        for n, (I, N) in enumerate( nets ):
+            mark = mark_lan | ( n+1 )
+            if 'adblock' in N.policies:
+                mark |= mark_policy['adblock']
+            elif 'malware' in N.policies:
+                mark |= mark_policy['malware']
+            self.append_chain( 'classify', Rule( source=N.net(), iface_in=I.name,
+                target='CONNMARK', target_args=['--set-mark', '0x{0:x}'.format(mark)] ),
+                table='nat' )
+    
+    def subnet_set_definitions( self, Int ):
+        """Create the ipsets holding the subnets of the interfaces in {Int}.
+        
+        local_nets holds every local subnet, and local_nets_X those of the
+        interface X. local_pairs pairs every subnet with itself, to match
+        traffic within a subnet, and local_gateways_X every gateway on the
+        interface X with its subnet, to match traffic from a gateway to its
+        own subnet on its own interface.
+        
+        Examples:
+        
+        >>> from network_config import Iface, Subnet
+        >>> I = Iface( 'eth1' ); I.subnets = [ Subnet('1'), Subnet('2') ]
+        >>> V = Berlin()
+        >>> V.subnet_set_definitions( [I] )
+        >>> sorted( V.all_sets.keys() )
+        ['local_gateways_eth1', 'local_nets', 'local_nets_eth1', 'local_pairs']
+        >>> V.all_sets['local_gateways_eth1']['members']
+        ['192.168.1.1,192.168.1.0/24', '192.168.2.1,192.168.2.0/24']
+        
+        """
+        
+        nets = [ N for I in Int for N in I.subnets ]
+        self.new_set( 'local_nets', [ N.net() for N in nets ], 'hash:net',
+                'Every local subnet.' )
+        for I in Int:
+            self.new_set( 'local_nets_' + I.name, [ N.net() for N in I.subnets ],
+                    'hash:net', 'The subnets on {0}.'.format(I.name) )
+            self.new_set( 'local_gateways_' + I.name, [ '{0},{1}'.format( N.gw(), N.net() )
+                    for N in I.subnets ], 'hash:net,net',
+                    'The gateway address of every subnet on {0}, with the subnet.'.format(I.name) )
+        self.new_set( 'local_pairs', [ '{0},{0}'.format( N.net() ) for N in nets ],
+                'hash:net,net', 'Every local subnet, paired with itself.' )
+    
     def import_config( self, C ):
         """Create a NAT firewall using the settings from {C}.
         
@@ -70,189 +261,213 @@ class Berlin(Ruleset):
         
         Ext = [ t for t in C.Interfaces if t.enabled and     t.wan_interface ]
         Int = [ t for t in C.Interfaces if t.enabled and not t.wan_interface ]
+        sets = self.subnet_sets
         
         debug( 0, "Generating rules..." )
         
         self.reset()
+        if sets:
+            self.subnet_set_definitions( Int )
+        if self.classify_flows:
+            self.classify( Ext, Int )
+        if self.fast_path:
+            for ch in [ 'INPUT', 'FORWARD', 'OUTPUT' ]:
+                self.append_chain( ch, '# Fast path: anything belonging to an accepted connection' )
+                self.append_chain( ch, Rule( state='RELATED,ESTABLISHED', target='ACCEPT' ) )
         
         self.append_chain('INPUT','#Loopback interface is valid' )
-        self.append_chain('INPUT','-i lo -j ACCEPT')
+        self.append_chain('INPUT',Rule( iface_in='lo', target='ACCEPT' ))
         
         self.append_chain('INPUT','# All other internal traffic is limited to the interface' )
+        if self.classify_flows:
+            # Connections set up before these rules were loaded have no mark,
+            # and are caught by the rules below.
+            self.append_chain('INPUT',Rule( matches=[ has_mark(mark_lan, mark_role) ],
+                target='ACCEPT' ))
         for I in Int:
+            if sets and I.subnets:
+                self.append_chain('INPUT',Rule( iface_in=I.name, target='ACCEPT',
+                    matches=[ in_set('local_nets_' + I.name, 'src') ] ))
+                continue
             for N in I.subnets:
-                self.append_chain('INPUT','-s {1} -i {0} -j ACCEPT'.format(I.name,N.net()))
+                self.append_chain('INPUT',Rule( source=N.net(), iface_in=I.name, target='ACCEPT' ))
         
         self.append_chain('INPUT','# Remote interface, claiming to be local machines, IP spoofing, get lost!' )
-        for I in Int:
-            for N in I.subnets:
-                for E in Ext:
-                    self.append_chain('INPUT','-s {1} -i {0} -j REJECT --reject-with icmp-port-unreachable'.format(
-                        E.name, N.net() ))
+        if sets:
+            for E in Ext:
+                self.append_chain('INPUT',Rule( iface_in=E.name,
+                    matches=[ in_set('local_nets', 'src') ], **REJECT ))
+        else:
+            for I in Int:
+                for N in I.subnets:
+                    for E in Ext:
+                        self.append_chain('INPUT',Rule( source=N.net(), iface_in=E.name, **REJECT ))
         
         self.append_chain('INPUT','# External interfaces, from any source, for ICMP traffic is valid.' )
         for E in Ext:
-            self.append_chain('INPUT','-d {1}/32 -i {0} -p icmp -j ACCEPT'.format(
-                E.name, E.address ))
+            self.append_chain('INPUT',Rule( destination=E.address, iface_in=E.name,
+                protocol='icmp', target='ACCEPT' ))
         
         self.append_chain('INPUT','# Allow any related traffic coming back to the MASQ server in.' )
         for E in Ext:
-            self.append_chain('INPUT','-d {1}/32 -i {0} -m state '
-                    '--state RELATED,ESTABLISHED -j ACCEPT'.format(
-                        E.name, E.address
-                    ))
+            self.append_chain('INPUT',Rule( destination=E.address, iface_in=E.name,
+                state='RELATED,ESTABLISHED', target='ACCEPT' ))
         
         
         self.append_chain('INPUT','# Allow internal DHCP/DNS traffic.' )
         for I in Int:
-            self.append_chain('INPUT','-i {0} -p tcp -m tcp --sport 68 --dport 67 -j ACCEPT'.format(I.name))
-            self.append_chain('INPUT','-i {0} -p udp -m udp --sport 68 --dport 67 -j ACCEPT'.format(I.name))
+            for proto in ['tcp','udp']:
+                self.append_chain('INPUT',Rule( iface_in=I.name, protocol=proto,
+                    sport=68, dport=67, target='ACCEPT' ))
             
-            self.append_chain('INPUT','-i {0} -p tcp -m tcp --dport 53 -j ACCEPT'.format(I.name))
-            self.append_chain('INPUT','-i {0} -p udp -m udp --dport 53 -j ACCEPT'.format(I.name))
+            for proto in ['tcp','udp']:
+                self.append_chain('INPUT',Rule( iface_in=I.name, protocol=proto,
+                    dport=53, target='ACCEPT' ))
         
         self.append_chain('INPUT','# Internal appliances (not implemented)' )
         for I in Int:
          for N in I.subnets:
           for P in N.services:
-            self.append_chain('INPUT','-i {0} -p tcp --dport {1} -s {2} -j ACCEPT'.format(
-                    I.name, P, N.net() ))
+            self.append_chain('INPUT',Rule( iface_in=I.name, protocol='tcp',
+                    dport=P, source=N.net(), target='ACCEPT' ))
         
         self.append_chain('INPUT','# Remote services' )
         for P in C.local_services:
             for E in Ext:
-                self.append_chain('INPUT','-d {1}/32 -i {0} -p tcp -m state --state '
-                             'NEW,RELATED,ESTABLISHED -m tcp --dport {2} -j ACCEPT'.format(
-                    E.name, E.address, P
-                ))
+                self.append_chain('INPUT',Rule( destination=E.address, iface_in=E.name,
+                    protocol='tcp', state='NEW,RELATED,ESTABLISHED', dport=P,
+                    target='ACCEPT' ))
             debug( -2, '     TCP port {0} is open for business.'.format(P) )
         
         self.append_chain('INPUT','# Active FTP' )
-        self.append_chain('INPUT','-m helper --helper "ftp" -j ACCEPT')
+        self.append_chain('INPUT',Rule( matches=['-m helper --helper ftp'], target='ACCEPT' ))
         
         self.append_chain('INPUT','# Reject everything else.' )
-        self.append_chain('INPUT','-j REJECT --reject-with icmp-port-unreachable')
+        self.append_chain('INPUT',Rule( **REJECT ))
         
         self.append_chain('OUTPUT','# Workaround bug in netfilter' )
-        self.append_chain('OUTPUT','-p icmp -m state --state INVALID -j DROP')
+        self.append_chain('OUTPUT',Rule( protocol='icmp', state='INVALID', target='DROP' ))
         
         self.append_chain('OUTPUT','# Loopback interface is valid' )
-        self.append_chain('OUTPUT','-o lo -j ACCEPT')
+        self.append_chain('OUTPUT',Rule( iface_out='lo', target='ACCEPT' ))
         
         self.append_chain('OUTPUT','# Local interfaces, any source going to local net is valid' )
         for E in Ext:
             for I in Int:
+                if sets and I.subnets:
+                    self.append_chain('OUTPUT',Rule( source=E.address, iface_out=I.name,
+                        matches=[ in_set('local_nets_' + I.name, 'dst') ], target='ACCEPT' ))
+                    continue
                 for N in I.subnets:
-                    self.append_chain('OUTPUT','-s {1}/32 -d {2} -o {0} -j ACCEPT'.format(
-                        I.name, E.address, N.net() ))
+                    self.append_chain('OUTPUT',Rule( source=E.address, destination=N.net(),
+                        iface_out=I.name, target='ACCEPT' ))
         
         self.append_chain('OUTPUT','# Local interface, MASQ server source going to a local net is valid' )
         for I in Int:
+            if sets and I.subnets:
+                self.append_chain('OUTPUT',Rule( iface_out=I.name, target='ACCEPT',
+                    matches=[ in_set('local_gateways_' + I.name, 'src,dst') ] ))
+                continue
             for N in I.subnets:
-                self.append_chain('OUTPUT','-s {1}/32 -d {2} -o {0} -j ACCEPT'.format(
-                    I.name, N.gw(), N.net() ))
+                self.append_chain('OUTPUT',Rule( source=N.gw(), destination=N.net(),
+                    iface_out=I.name, target='ACCEPT' ))
         
         self.append_chain('OUTPUT','# Outgoing to local net on remote interface, stuffed routing, deny' )
-        for E in Ext:
-            for I in Int:
-                for N in I.subnets:
-                    self.append_chain('OUTPUT','-d {1} -o {0} -j REJECT --reject-with icmp-port-unreachable'.format(
-                        E.name, N.net() ))
+        if sets:
+            for E in Ext:
+                self.append_chain('OUTPUT',Rule( iface_out=E.name,
+                    matches=[ in_set('local_nets', 'dst') ], **REJECT ))
+        else:
+            for E in Ext:
+                for I in Int:
+                    for N in I.subnets:
+                        self.append_chain('OUTPUT',Rule( destination=N.net(), iface_out=E.name,
+                            **REJECT ))
         
         self.append_chain('OUTPUT','# Anything else outgoing on remote interface is valid.' )
         for E in Ext:
-            self.append_chain('OUTPUT','-s {1}/32 -o {0} -j ACCEPT'.format(
-                E.name, E.address ))
+            self.append_chain('OUTPUT',Rule( source=E.address, iface_out=E.name,
+                target='ACCEPT' ))
         
         self.append_chain('OUTPUT','# Internal interface, DHCP traffic accepted' )
         for I in Int:
             for N in I.subnets:
-                self.append_chain('OUTPUT','-s {1}/32 -d 255.255.255.255/32 '
-                             '-o {0} -p tcp -m tcp '
-                             '--sport 67 --dport 68 -j ACCEPT'.format(
-                    I.name, N.gw() ))
-                self.append_chain('OUTPUT','-s {1}/32 -d 255.255.255.255/32 '
-                             '-o {0} -p udp -m udp '
-                             '--sport 67 --dport 68 -j ACCEPT'.format(
-                    I.name, N.gw() ))
+                for proto in ['tcp','udp']:
+                    self.append_chain('OUTPUT',Rule( source=N.gw(),
+                        destination='255.255.255.255', iface_out=I.name,
+                        protocol=proto, sport=67, dport=68, target='ACCEPT' ))
         
         debug( -1, 'Catch all rule, all other outgoing is denied and logged.' )
-        self.append_chain('OUTPUT','-j REJECT --reject-with icmp-port-unreachable')
+        self.append_chain('OUTPUT',Rule( **REJECT ))
+        
         
         
         
         
+        self.append_chain('FORWARD',Rule( state='RELATED,ESTABLISHED', target='ACCEPT' ))
         
         self.append_chain('FORWARD','# Reject all SMTP traffic save for a few trusted destinations' )
-        self.create_filter( 'smtp_filter', ["smtp-hosts"], table='filter',
-                      action='-j ACCEPT')
-        self.append_chain( 'smtp_filter', '-j LOG --log-prefix "  [SMTP] "' )
-        self.append_chain( 'smtp_filter', '-j REJECT --reject-with icmp-port-unreachable' )
-        for E in Ext:
-            for I in Int:
-                self.append_chain('FORWARD',' -p tcp -m tcp --dport 25  '
-                             '-j LOG --log-prefix "  [SMTP] "'.format(
-                    E.name, I.name ))
-                self.append_chain('FORWARD',' -p tcp -m tcp --dport 25  '
-                             '-j REJECT --reject-with icmp-port-unreachable'.format(
-                    E.name, I.name ))
-                self.append_chain('FORWARD',' -p tcp -m tcp --dport 587  '
-                             '-g smtp_filter'.format(
-                    E.name, I.name ))
-                self.append_chain('FORWARD',' -p tcp -m tcp --dport 465  '
-                             '-g smtp_filter'.format(
-                    E.name, I.name ))
-        
-        
-        self.append_chain('FORWARD','-m state --state RELATED,ESTABLISHED -j ACCEPT')
+        self.smtp()
         
         self.append_chain('FORWARD','# Network services' )
         for E in Ext:
             for port,host in C.network_services:
                 self.append_chain(
                     'PREROUTING',
-                    '-d {1}/32 -i {0} -p tcp -m tcp --dport {2} -j DNAT --to-destination {3}'.format(
-                        E.name, E.address, port, host ),
+                    Rule( destination=E.address, iface_in=E.name, protocol='tcp',
+                        dport=port, target='DNAT',
+                        target_args=['--to-destination',host] ),
                     table='nat')
-                self.append_chain('FORWARD','-i {0} -p tcp -m state --state NEW -m tcp --dport {1} -j ACCEPT'.format(
-                    E.name, port ))
+                self.append_chain('FORWARD',Rule( iface_in=E.name, protocol='tcp',
+                    state='NEW', dport=port, target='ACCEPT' ))
         
         self.append_chain('PREROUTING','# Redirect traffic to wan address to this gateway',table='nat')
         for E in Ext:
             if E.wan_address == E.address: continue
+            if sets:
+                # to_gateway redirects every subnet to its own gateway.
+                self.append_chain(
+                    'PREROUTING',
+                    Rule( protocol='tcp', destination=E.wan_address,
+                        matches=[ in_set('local_nets', 'src') ],
+                        state='NEW,ESTABLISHED,RELATED', target='to_gateway', goto=True ),
+                    table='nat')
+                continue
             for I in Int:
                 for N in I.subnets:
                     self.append_chain(
                         'PREROUTING',
-                        '-p tcp -s {0} -d {1} -m state --state NEW,ESTABLISHED,RELATED '
-                        '-j DNAT --to {2}'.format(
-                            N.net(), E.wan_address, N.gw() ),
+                        Rule( protocol='tcp', source=N.net(), destination=E.wan_address,
+                            state='NEW,ESTABLISHED,RELATED', target='DNAT',
+                            target_args=['--to-destination',N.gw()] ),
                         table='nat')
         
         self.append_chain('FORWARD','# Accept solicited tcp packets' )
         for E in Ext:
             for I in Int:
-                self.append_chain('FORWARD','-i {0} -o {1} '
-                             '-m state --state RELATED,ESTABLISHED -j ACCEPT'.format(
-                    E.name, I.name ))
+                self.append_chain('FORWARD',Rule( iface_in=E.name, iface_out=I.name,
+                    state='RELATED,ESTABLISHED', target='ACCEPT' ))
         
         self.append_chain('FORWARD','# Allow packets within subnet' )
         for I in Int:
-            self.append_chain('FORWARD','-i {0} -o {0} -j ACCEPT'.format(I.name))
+            self.append_chain('FORWARD',Rule( iface_in=I.name, iface_out=I.name,
+                target='ACCEPT' ))
         
         self.append_chain('FORWARD','# Forward packets from the internal network to the Internet.' )
         for I in Int:
             for E in Ext:
-                self.append_chain('FORWARD','-i {0} -o {1} -j ACCEPT'.format(I.name,E.name))
+                self.append_chain('FORWARD',Rule( iface_in=I.name, iface_out=E.name,
+                    target='ACCEPT' ))
         
         self.append_chain('FORWARD','# Catch-all REJECT rule' )
-        self.append_chain('FORWARD','-j REJECT --reject-with icmp-port-unreachable')
+        self.append_chain('FORWARD',Rule( **REJECT ))
         
         self.append_chain('POSTROUTING','# IP-Masquerade',table='nat')
         for E in Ext:
             self.append_chain(
                 'POSTROUTING',
-                '-o {0} -j SNAT --to-source {1}'.format(E.name,E.address),
+                Rule( iface_out=E.name, target='SNAT',
+                    target_args=['--to-source',E.address] ),
                 table='nat')
         
         debug( 0, 'done.' )
@@ -264,20 +479,30 @@ class Berlin(Ruleset):
         debug( -1, 'Creating "to Gateway" chain.' )
         self.new_chain( 'to_gateway', table='nat', policy='-' )
         self.append_chain('PREROUTING','# Local nat traffic is allowed',table='nat')
+        if sets:
+            self.append_chain(
+                'PREROUTING',
+                Rule( matches=[ in_set('local_pairs', 'src,dst') ], protocol='tcp',
+                    dport=80, state='NEW,RELATED,ESTABLISHED', target='ACCEPT' ),
+                table='nat'
+            )
         for I in Int:
             for N in I.subnets:
-                self.append_chain( 
-                    'PREROUTING',
-                    '-s {0} -d {0} -p tcp -m tcp --dport 80 -m state --state '
-                        'NEW,RELATED,ESTABLISHED -j ACCEPT'.format(N.net()),
-                    table='nat'
-                )
+                if not sets:
+                    self.append_chain( 
+                        'PREROUTING',
+                        Rule( source=N.net(), destination=N.net(), protocol='tcp',
+                            dport=80, state='NEW,RELATED,ESTABLISHED', target='ACCEPT' ),
+                        table='nat'
+                    )
                 self.append_chain(
                     'to_gateway',
-                    '-s {0} -j DNAT --to-destination {1}'.format( N.net(), N.gw() ),
+                    Rule( source=N.net(), target='DNAT',
+                        target_args=['--to-destination',N.gw()] ),
                     table='nat'
                 )
-        self.append_chain('to_gateway', '-j LOG --log-prefix "   [impossible]"', table='nat')
+        self.append_chain('to_gateway', Rule( target='LOG',
+            target_args=['--log-prefix','   [impossible]'] ), table='nat')
         
         
         for I in Int:
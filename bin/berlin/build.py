@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import os, re, json, hashlib, shutil, subprocess
+from addresses import locations
+from netlink import links
+from output import debug
+
+# The host lists address filters are built from.
+host_lists = ['ad-hosts', 'malware-hosts', 'smtp-hosts', 'apache/whitelist.conf']
+
+
+def file_hash( filename ):
+    """Return the SHA-1 of the contents of {filename}, or None if it can't
+    be read.
+    
+    Examples:
+    
+    >>> f = open('/tmp/doctest_file_hash','w')
+    >>> f.write('berlin\\n')
+    >>> f.close()
+    >>> file_hash('/tmp/doctest_file_hash')
+    '741b149f5f5a0cd55150ce9ec0284103528240c1'
+    >>> file_hash('/tmp/nonexistent_file') is None
+    True
+    
+    """
+    
+    H = hashlib.sha1()
+    try:
+        f = open( filename, 'rb' )
+    except IOError:
+        return None
+    while True:
+        block = f.read( 1 << 20 )
+        if not block: break
+        H.update( block )
+    f.close()
+    return H.hexdigest()
+
+def find_config( name ):
+    """Return the first configuration directory containing {name}, in the
+    same order open_file() and list_directory() look."""
+    
+    if name[0] == '/':
+        return name if os.path.exists( name ) else None
+    for L in locations[:-1]:
+        if os.path.exists( L + name ):
+            return L + name
+    return None
+
+def config_files():
+    """Return every configuration file the firewall is built from, except
+    for the host lists.
+    
+    Examples:
+    
+    >>> type( config_files() )
+    <type 'list'>
+    
+    """
+    
+    rv = []
+    for name in ['if-config']:
+        if find_config( name ):
+            rv.append( find_config(name) )
+    
+    for d in ['ports', 'networks']:
+        top = find_config( d )
+        if top is None: continue
+        for path, dirs, files in os.walk( top ):
+            dirs.sort()
+            rv += [ os.path.join( path, f ) for f in sorted(files) ]
+    return rv
+
+def host_list_files():
+    """Return every copy of every host list, in every location."""
+    
+    return [ L + F for F in host_lists for L in locations
+            if os.path.isfile( L + F ) ]
+
+def interface_addresses():
+    """Return the name and IPv4 address of every network interface, as a
+    sorted list of tuples. Interfaces without an address have None.
+    
+    This asks the kernel directly, rather than running ifconfig.
+    
+    Examples:
+    
+    >>> ('lo', '127.0.0.1') in interface_addresses()
+    True
+    
+    """
+    
+    return sorted([ (name, L.address()) for name, L in links().items() ])
+
+# Packet and byte counters, as iptables-save and nft list them.
+live_counters = re.compile( r'\[\d+:\d+\]|packets \d+ bytes \d+' )
+
+def live_state( command ):
+    """Return a hash of what is loaded in the kernel, as listed by {command}
+    (iptables-save, ipset save or nft list ruleset), or None if it can't be
+    run. Comments and counters are left out, so it only changes when the
+    rules or sets themselves do.
+    
+    Examples:
+    
+    >>> A = live_state([ 'printf', '# Generated on Monday\\n:INPUT DROP [3:180]' ])
+    >>> B = live_state([ 'printf', '# Generated on Tuesday\\n:INPUT DROP [0:0]' ])
+    >>> A == B, A == live_state([ 'printf', ':INPUT ACCEPT [0:0]' ])
+    (True, False)
+    >>> live_state([ 'false' ]) is None, live_state([ '/nonexistent' ]) is None
+    (True, True)
+    
+    """
+    
+    try:
+        P = subprocess.Popen( command, stdout=subprocess.PIPE,
+                stderr=open( os.devnull, 'w' ) )
+    except OSError:
+        return None
+    H = hashlib.sha1()
+    for line in P.stdout:
+        if not line.startswith('#'):
+            H.update( live_counters.sub( '', line ) )
+    if P.wait() != 0:
+        return None
+    return H.hexdigest()
+
+
+class BuildGraph:
+    """Keeps track of which outputs are out of date.
+    
+    For every output, the state file records the content hash of each of
+    its inputs, and of the output itself, at the time it was last built. An
+    output has to be built again if any of those changed, or if it was
+    never built at all. Files are only hashed again if their size or
+    modification time changed since the last run."""
+    
+    state_file = None
+    state = None
+    
+    def __init__( self, state_file ):
+        """Load the state from {state_file}, if it exists."""
+        
+        self.state_file = state_file
+        try:
+            f = open( state_file, 'r' )
+            self.state = json.load( f )
+            f.close()
+        except (IOError, ValueError):
+            self.state = dict()
+        self.state.setdefault( 'outputs', dict() )
+        self.state.setdefault( 'files', dict() )
+    
+    def hash( self, filename ):
+        """Return the content hash of {filename}, using the cached one if
+        the file looks the same as last time."""
+        
+        try:
+            st = os.stat( filename )
+        except OSError:
+            return None
+        
+        stamp = [ st.st_size, st.st_mtime ]
+        cached = self.state['files'].get( filename )
+        if cached and cached[0:2] == stamp:
+            return cached[2]
+        
+        rv = file_hash( filename )
+        self.state['files'][ filename ] = stamp + [ rv ]
+        return rv
+    
+    def hash_files( self, filenames ):
+        """Return a dict with the hash of each file in {filenames}."""
+        
+        return dict([ (t, self.hash(t)) for t in filenames ])
+    
+    @staticmethod
+    def hash_value( value ):
+        """Return a content hash of any value that can be written as JSON."""
+        
+        return hashlib.sha1( json.dumps( value, sort_keys=True ) ).hexdigest()
+    
+    def stale( self, output, inputs, filename=None ):
+        """Check whether {output} has to be built again.
+        
+        {inputs} is a dict of input names and their hashes. If {filename} is
+        given, the output is also stale if that file changed or vanished.
+        
+        Examples:
+        
+        >>> G = BuildGraph( '/tmp/doctest_build_state' )
+        >>> G.stale( 'rules', {'if-config': 'abc'} )
+        True
+        >>> G.done( 'rules', {'if-config': 'abc'} )
+        >>> G.stale( 'rules', {'if-config': 'abc'} ), G.stale( 'rules', {'if-config': 'abd'} )
+        (False, True)
+        
+        """
+        
+        recorded = self.state['outputs'].get( output )
+        if recorded is None:
+            return True
+        if recorded['inputs'] != BuildGraph.hash_value( inputs ):
+            return True
+        if filename is not None and recorded.get('hash') != self.hash( filename ):
+            return True
+        return False
+    
+    def changed_inputs( self, output, inputs ):
+        """Return the names of all inputs of {output} that changed."""
+        
+        recorded = self.state['outputs'].get( output, dict() ).get( 'each', dict() )
+        return sorted([ t for t in inputs if recorded.get(t) != inputs[t] ] +
+                [ t for t in recorded if t not in inputs ])
+    
+    def done( self, output, inputs, filename=None ):
+        """Record that {output} was built from {inputs}.
+        
+        Examples:
+        
+        >>> G = BuildGraph( '/tmp/doctest_build_state' )
+        >>> G.done( 'rules', {'if-config': 'abc', 'ad-hosts': '123'} )
+        >>> G.save()
+        >>> H = BuildGraph( '/tmp/doctest_build_state' )
+        >>> H.stale( 'rules', {'if-config': 'abc', 'ad-hosts': '123'} )
+        False
+        >>> H.changed_inputs( 'rules', {'if-config': 'abc', 'ad-hosts': '456'} )
+        ['ad-hosts']
+        
+        """
+        
+        self.state['outputs'][ output ] = dict({
+            'inputs': BuildGraph.hash_value( inputs ),
+            'each': inputs,
+            'hash': self.hash( filename ) if filename else None
+        })
+    
+    def save( self ):
+        """Write the state back to the state file."""
+        
+        f = open( self.state_file + '.new', 'w' )
+        json.dump( self.state, f )
+        f.close()
+        os.rename( self.state_file + '.new', self.state_file )
+
+
+def sync_tree( source, destination ):
+    """Make the directory {destination} the same as {source}, only touching
+    files whose contents differ.
+    
+    Files that did not change keep their modification time, so anything
+    built from them is not needlessly rebuilt. {source} is removed
+    afterwards. Returns a sorted list of changed paths, relative to
+    {destination}.
+    
+    Examples:
+    
+    >>> for d in ['/tmp/doctest_sync_a/x', '/tmp/doctest_sync_b/x', '/tmp/doctest_sync_b/y']:
+    ...     os.makedirs( d )
+    >>> for fn in ['a/x/same', 'a/x/new', 'b/x/same', 'b/y/gone']:
+    ...     f = open( '/tmp/doctest_sync_' + fn, 'w' ); f.write(fn[2:]); f.close()
+    >>> sync_tree( '/tmp/doctest_sync_a', '/tmp/doctest_sync_b' )
+    ['x/new', 'y', 'y/gone']
+    >>> sorted( os.listdir('/tmp/doctest_sync_b/x') ), os.path.exists('/tmp/doctest_sync_a')
+    (['new', 'same'], False)
+    
+    """
+    
+    changed = []
+    if not os.path.isdir( destination ):
+        os.makedirs( destination )
+    
+    for path, dirs, files in os.walk( source ):
+        rel = os.path.relpath( path, source )
+        target = os.path.normpath( os.path.join( destination, rel ) )
+        if not os.path.isdir( target ):
+            os.mkdir( target )
+        for F in files:
+            if file_hash( os.path.join(path, F) ) != file_hash( os.path.join(target, F) ):
+                shutil.copy2( os.path.join(path, F), os.path.join(target, F) )
+                changed.append( os.path.normpath( os.path.join(rel, F) ) )
+    
+    for path, dirs, files in os.walk( destination, topdown=False ):
+        rel = os.path.relpath( path, destination )
+        for F in files + dirs:
+            if not os.path.lexists( os.path.join( source, rel, F ) ):
+                gone = os.path.join( path, F )
+                if os.path.isdir( gone ):
+                    os.rmdir( gone )
+                else:
+                    os.unlink( gone )
+                changed.append( os.path.normpath( os.path.join(rel, F) ) )
+    
+    shutil.rmtree( source )
+    return sorted( changed )
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    
+    import os,sys
+    os.unlink('/tmp/doctest_file_hash')
+    os.unlink('/tmp/doctest_build_state')
+    shutil.rmtree('/tmp/doctest_sync_b')
+    
+    sys.exit( fail )
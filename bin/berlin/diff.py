@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+from difflib import SequenceMatcher
+from rule import Rule
+
+builtin_chains = dict({
+    'filter': ['INPUT','FORWARD','OUTPUT'],
+    'nat': ['PREROUTING','POSTROUTING','OUTPUT']
+})
+
+
+def is_rule( rule ):
+    """Check whether {rule} ends up in the kernel, rather than being a comment.
+    
+    Examples:
+    
+    >>> is_rule(Rule.parse('-j ACCEPT')), is_rule(Rule.parse('# A comment'))
+    (True, False)
+    
+    """
+    
+    return isinstance( rule, Rule )
+
+def chain_edits( chain, old, new ):
+    """Generate the commands that turn the rules {old} into {new}.
+    
+    Both {old} and {new} are lists of Rule objects in {chain}. Rules that do
+    the same thing are left alone, even if their options are written in a
+    different order; everything else is deleted or inserted by position. The
+    commands are generated back to front, so each position refers to the
+    chain as it is at that point.
+    
+    Examples:
+    
+    >>> P = lambda L: [ Rule.parse(t) for t in L ]
+    >>> list(chain_edits( 'X', P(['-j A','-j B','-j C']), P(['-j A','-j D','-j C','-j E']) ))
+    ['-I X 4 -j E', '-D X 2', '-I X 2 -j D']
+    >>> list(chain_edits( 'X', P(['-p tcp --dport 22 -i eth0 -j A']),
+    ...     P(['-i eth0 -p tcp -m tcp --dport 22 -j A']) ))
+    []
+    
+    """
+    
+    S = SequenceMatcher( None, [t.key() for t in old],
+            [t.key() for t in new], autojunk=False )
+    
+    for tag, i1, i2, j1, j2 in reversed( S.get_opcodes() ):
+        if tag == 'equal':
+            continue
+        for i in range(i1, i2):
+            yield '-D {0} {1}'.format( chain, i1+1 )
+        for j in range(j1, j2):
+            yield '-I {0} {1} {2}'.format( chain, i1+1 + j-j1, new[j] )
+
+def render_diff( old, new, tables=['nat','filter'] ):
+    """Generate an iptables-restore --noflush script turning {old} into {new}.
+    
+    Both {old} and {new} are Ruleset objects. Chains that only exist in {new}
+    are created before any rule is changed, and chains that only exist in
+    {old} are removed after every reference to them is gone, including those
+    from other chains that are removed.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> A = Ruleset()
+    >>> A.new_chain( 'gone' )
+    >>> A.append_chain( 'INPUT', '-j gone' )
+    >>> B = Ruleset()
+    >>> B.new_chain( 'new' )
+    >>> B.append_chain( 'new', '# Just a comment' )
+    >>> B.append_chain( 'INPUT', '-j new' )
+    >>> for line in render_diff( A, B ): print line,
+    *nat
+    COMMIT
+    *filter
+    -N new
+    -D INPUT 1
+    -I INPUT 1 -j new
+    -F gone
+    -X gone
+    COMMIT
+    
+    >>> A.new_chain( 'also_gone' )
+    >>> A.append_chain( 'gone', '-j also_gone' )
+    >>> [ line.strip() for line in render_diff( A, B, ['filter'] ) if line[:2] in ('-F','-X') ]
+    ['-F also_gone', '-F gone', '-X also_gone', '-X gone']
+    
+    """
+    
+    for tb in tables:
+        before = old.all_chains[tb]
+        after = new.all_chains[tb]
+        
+        yield '*{0}\n'.format(tb)
+        
+        for ch in sorted(after.keys()):
+            if ch not in before:
+                yield '-N {0}\n'.format(ch)
+        
+        for ch in builtin_chains[tb]:
+            if before[ch]['policy'] != after[ch]['policy']:
+                yield '-P {0} {1}\n'.format( ch, after[ch]['policy'] )
+        
+        for ch in builtin_chains[tb] + \
+                [ t for t in sorted(after.keys()) if t not in builtin_chains[tb] ]:
+            old_rules = [ t for t in before[ch]['rules'] if is_rule(t) ] \
+                    if ch in before else []
+            new_rules = [ t for t in after[ch]['rules'] if is_rule(t) ]
+            for line in chain_edits( ch, old_rules, new_rules ):
+                yield line + '\n'
+        
+        # Removed chains may still refer to each other, so all of them are
+        # flushed before the first one is deleted.
+        gone = [ ch for ch in sorted(before.keys()) if ch not in after ]
+        for ch in gone:
+            yield '-F {0}\n'.format(ch)
+        for ch in gone:
+            yield '-X {0}\n'.format(ch)
+        
+        yield 'COMMIT\n'
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import csv
+from bisect import bisect_right
+from addresses import ip_to_int
+from rule import Rule
+from optimize import port_range
+from analyze import Packet, parse_network
+
+# Options that name a network, or a list of ports.
+network_options = set([ '-s', '--source', '-d', '--destination' ])
+port_options = set([ '--dport', '--sport', '--dports', '--sports', '--ports',
+        '--destination-port', '--source-port', '--destination-ports',
+        '--source-ports' ])
+
+# Protocols as conntrack names them.
+protocols = set([ 'tcp', 'udp', 'icmp', 'udplite', 'sctp', 'dccp', 'gre' ])
+
+# The columns of the CSV files read and written.
+columns = [ 'src', 'dst', 'proto', 'sport', 'dport', 'in', 'out', 'state' ]
+
+
+def network_bounds( net ):
+    """Return the first address of {net}, and the first one after it.
+    
+    Examples:
+    
+    >>> network_bounds('10.0.0.0/8'), network_bounds('10.0.0.1')
+    ((167772160, 184549376), (167772161, 167772162))
+    
+    """
+    
+    address, length = parse_network( net )
+    first = address & ( (0xffffffff << (32-length)) & 0xffffffff )
+    return ( first, first + (1 << (32-length)) )
+
+def port_bounds( spec ):
+    """Return the first port of every range in {spec}, and the first port
+    after each of them."""
+    
+    rv = []
+    for p in spec.split(','):
+        first, last = port_range( p )
+        rv += [ first, last+1 ]
+    return rv
+
+
+class Evaluator:
+    """Decides the fate of large numbers of flows at once.
+    
+    Every address and port mentioned anywhere in the ruleset, its sets or
+    its routes splits the address and port space into intervals. Two flows
+    with their addresses and ports in the same intervals, and the same
+    interfaces, protocol and state, are treated the same by every rule. So
+    only the first flow of each such class is followed through the rules by
+    the Analyzer, and every other flow is a dictionary lookup."""
+    
+    def __init__( self, analyzer ):
+        self.analyzer = analyzer
+        R = analyzer.ruleset
+        
+        addresses = set([ 0 ])
+        ports = set([ 0 ])
+        for tb in R.all_chains:
+            for ch in R.all_chains[tb]:
+                for r in R.all_chains[tb][ch]['rules']:
+                    if not isinstance( r, Rule ):
+                        continue
+                    for net in ( r.source, r.destination ):
+                        if net:
+                            addresses.update( network_bounds(net) )
+                    for p in ( r.sport, r.dport ):
+                        if p:
+                            ports.update( port_bounds(p) )
+                    for m in r.matches:
+                        for j in range( len(m) - 1 ):
+                            if m[j] in network_options:
+                                addresses.update( network_bounds(m[j+1]) )
+                            elif m[j] in port_options:
+                                ports.update( port_bounds(m[j+1]) )
+        
+        for ipset in R.all_sets.values():
+            for m in ipset['members']:
+                for net in m.split(','):
+                    addresses.update( network_bounds(net) )
+        for net, iface in analyzer.routes:
+            addresses.update( network_bounds(net) )
+        for address in analyzer.local:
+            addresses.update( network_bounds(address) )
+        
+        self.addresses = sorted( addresses )
+        self.ports = sorted( ports )
+        # The interval of every address looked up so far.
+        self.intervals = dict()
+        # The verdict and deciding rule of every class of flows seen so far.
+        self.results = dict()
+    
+    def interval( self, address ):
+        """Return the number of the address interval {address} is in."""
+        
+        rv = self.intervals.get( address )
+        if rv is None:
+            rv = self.intervals[ address ] = \
+                    bisect_right( self.addresses, ip_to_int(address) )
+        return rv
+    
+    def key( self, P ):
+        """Return the class of flow {P}."""
+        
+        return ( self.interval( P.source ), self.interval( P.destination ),
+                P.iface_in, P.iface_out, P.protocol,
+                None if P.sport is None else bisect_right( self.ports, P.sport ),
+                None if P.dport is None else bisect_right( self.ports, P.dport ),
+                P.state )
+    
+    def evaluate( self, packets ):
+        """Return the verdict and the deciding (table, chain, number, rule)
+        of every packet in {packets}, in the same order. See Trace.
+        
+        Examples:
+        
+        >>> from ruleset import Ruleset
+        >>> from analyze import Analyzer
+        >>> R = Ruleset()
+        >>> R.append_chain( 'FORWARD', '-i eth1 -p tcp --dport 25 -j REJECT' )
+        >>> R.append_chain( 'FORWARD', '-i eth1 -j ACCEPT' )
+        >>> E = Evaluator( Analyzer( R, routes=[('192.168.1.0/24','eth1'), ('0.0.0.0/0','eth0')] ) )
+        >>> P = [ flow( E.analyzer, '192.168.1.{0}'.format(n), '198.51.100.7', 'tcp',
+        ...     40000 + n, port ) for n in range(100) for port in (25, 80) ]
+        >>> V = E.evaluate( P )
+        >>> V[0], V[1]
+        (('REJECT', ('filter', 'FORWARD', 1, Rule('-i eth1 -p tcp -m tcp --dport 25 -j REJECT'))), ('ACCEPT', ('filter', 'FORWARD', 2, Rule('-i eth1 -j ACCEPT'))))
+        >>> len(V), len(E.results)
+        (200, 2)
+        
+        """
+        
+        rv = []
+        for P in packets:
+            k = self.key( P )
+            result = self.results.get( k )
+            if result is None:
+                T = self.analyzer.trace( P )
+                result = self.results[k] = ( T.verdict, T.decision )
+            rv.append( result )
+        return rv
+
+
+def flow( analyzer, source, destination, protocol='tcp', sport=None,
+        dport=None, iface_in=None, iface_out=None, state='NEW', name=None ):
+    """Return the first packet of a flow as a Packet. Interfaces that are
+    not given are looked up in the routes of {analyzer}.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> from analyze import Analyzer
+    >>> A = Analyzer( Ruleset(), local=['192.168.1.1'],
+    ...     routes=[('192.168.1.0/24','eth1'), ('0.0.0.0/0','eth0')] )
+    >>> P = flow( A, '192.168.1.5', '198.51.100.7', 'tcp', '40000', '443' )
+    >>> P.iface_in, P.iface_out, P.dport
+    ('eth1', 'eth0', 443)
+    >>> flow( A, '192.168.1.1', '192.168.1.5' ).iface_in is None
+    True
+    
+    """
+    
+    port = lambda p: int(p) if p not in (None, '') else None
+    return Packet( name, source, destination,
+            iface_in or analyzer.interface( source ),
+            iface_out or analyzer.interface( destination ),
+            protocol.lower(), port(sport), port(dport), state )
+
+def read_csv( f, analyzer ):
+    """Yield a Packet for every line of the CSV file {f}.
+    
+    The first line names the columns: src, dst, proto, sport, dport, and
+    optionally in, out and state. Empty interfaces are looked up; an empty
+    state means a new connection."""
+    
+    for n, row in enumerate( csv.DictReader( f ) ):
+        yield flow( analyzer, row['src'], row['dst'], row.get('proto') or 'tcp',
+                row.get('sport'), row.get('dport'), row.get('in'), row.get('out'),
+                row.get('state') or 'NEW', n+1 )
+
+def read_conntrack( f, analyzer ):
+    """Yield a Packet for every connection in {f}, the output of
+    conntrack -L  or the contents of /proc/net/nf_conntrack.
+    
+    Every connection counts as new, since that is when the rules decide
+    whether to let it through; the addresses are those of its first packet.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> from analyze import Analyzer
+    >>> A = Analyzer( Ruleset() )
+    >>> L = [ 'tcp      6 431999 ESTABLISHED src=192.168.1.5 dst=198.51.100.7 '
+    ...     'sport=40000 dport=443 src=198.51.100.7 dst=1.2.3.4 sport=443 '
+    ...     'dport=40000 [ASSURED] mark=0 use=1',
+    ...     'ipv6     10 udp      17 29 src=::1 dst=::1 sport=53 dport=53' ]
+    >>> [ (P.protocol, P.destination, P.dport) for P in read_conntrack( L, A ) ]
+    [('tcp', '198.51.100.7', 443)]
+    
+    """
+    
+    for n, line in enumerate( f ):
+        T = line.split()
+        if not T or T[0] == 'ipv6':
+            continue
+        fields = dict()
+        for t in T:
+            k, _, v = t.partition('=')
+            if v and k not in fields:
+                fields[k] = v
+        protocol = [ t for t in T if t in protocols ]
+        if 'src' not in fields or 'dst' not in fields or not protocol:
+            continue
+        yield flow( analyzer, fields['src'], fields['dst'], protocol[0],
+                fields.get('sport'), fields.get('dport'), name=n+1 )
+
+def batches( iterable, size=10000 ):
+    """Split {iterable} into lists of at most {size} items.
+    
+    Examples:
+    
+    >>> [ len(t) for t in batches( range(25), 10 ) ]
+    [10, 10, 5]
+    
+    """
+    
+    batch = []
+    for t in iterable:
+        batch.append( t )
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def tally( results, counts ):
+    """Add how many flows in {results}, as returned by evaluate(), every
+    rule or policy decided to {counts}, a dict of counts by (verdict,
+    decision), so the results of one batch can go as soon as they are
+    counted. Returns the number of flows counted."""
+    
+    for verdict, decision in results:
+        counts[ (verdict, decision) ] = counts.get( (verdict, decision), 0 ) + 1
+    return len( results )
+
+def hits( counts ):
+    """Return the {counts} kept by tally() as a list of (count, verdict,
+    decision) tuples, the most used first.
+    
+    Examples:
+    
+    >>> counts = dict()
+    >>> tally( [ ('ACCEPT', None), ('DROP', None) ], counts )
+    2
+    >>> tally( [ ('DROP', None) ], counts )
+    1
+    >>> hits( counts )
+    [(2, 'DROP', None), (1, 'ACCEPT', None)]
+    
+    """
+    
+    return sorted([ (n, v, d) for (v, d), n in counts.items() ],
+            key=lambda t: ( -t[0], str(t[2]) ) )
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
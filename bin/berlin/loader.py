@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import os, stat
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from output import span, count
+
+# Every file parsed so far, by path, as a (modification time, size, contents)
+# tuple, so a file is only parsed again after it changed. The same goes for
+# files that are read as they are, and for directory listings.
+parsed = dict()
+contents = dict()
+listed = dict()
+
+
+def parse_config( text ):
+    """Parse the contents of a simple config file, in the form
+    key: val1 val2  val3 val4
+    to a defaultdict in the form
+    dict({'key': ['val1','val2','val3','val4']})
+    
+    Examples:
+    
+    >>> P = parse_config( 'interface: eth1\\npolicies: adblock malware\\n' )
+    >>> P['policies'], P['comment']
+    (['adblock', 'malware'], ['undefined'])
+    
+    """
+    
+    rv = defaultdict(lambda:['undefined'])
+    for t in text.splitlines():
+        i = t.split(':',1)
+        if len(i) < 2: continue
+        rv[i[0].strip()] = [s.strip() for s in i[1].split(None)]
+    return rv
+
+def private( st ):
+    """Return whether the file or directory {st}, as returned by os.stat(),
+    belongs to the current user, and nobody else can write to it.
+    
+    Examples:
+    
+    >>> private( os.stat( os.path.expanduser('~') ) )
+    True
+    >>> private( os.stat('/tmp') )
+    False
+    
+    """
+    
+    return st.st_uid == os.getuid() and not st.st_mode & ( stat.S_IWGRP | stat.S_IWOTH )
+
+def read_path( path ):
+    """Return {path} with its modification time, size and contents, or only
+    with its modification time and size if it was already parsed since it
+    last changed, or None if it can't be read.
+    
+    This is the part of parsing a file that waits for the disk, so it is
+    safe and useful to do in many threads at once."""
+    
+    try:
+        st = os.stat( path )
+        entry = parsed.get( path )
+        if entry is not None and entry[:2] == ( st.st_mtime, st.st_size ):
+            return path, st.st_mtime, st.st_size, None
+        f = open( path )
+        try:
+            return path, st.st_mtime, st.st_size, f.read()
+        finally:
+            f.close()
+    except (OSError, IOError):
+        return None
+
+def parse_read( result ):
+    """Parse a file read by read_path(), or take it from {parsed} if it
+    didn't change since it was last parsed."""
+    
+    if result is None:
+        return parse_config( '' )
+    
+    path, mtime, size, text = result
+    if text is not None:
+        count( 'parsed files' )
+        parsed[ path ] = ( mtime, size, dict( parse_config(text) ) )
+    else:
+        count( 'unchanged files' )
+    
+    rv = parse_config( '' )
+    for k, v in parsed[ path ][2].items():
+        rv[k] = list( v )
+    return rv
+
+def parse_path( path ):
+    """Parse the config file at {path}, like parse_config(). A file that
+    can't be read parses as empty.
+    
+    Every caller gets a copy of its own, so changing it doesn't change what
+    the next caller gets.
+    
+    Examples:
+    
+    >>> f = open('/tmp/doctest_parse_path','w')
+    >>> f.write('policies: adblock\\n')
+    >>> f.close()
+    >>> P = parse_path('/tmp/doctest_parse_path')
+    >>> P['policies'].remove('adblock')
+    >>> parse_path('/tmp/doctest_parse_path')['policies']
+    ['adblock']
+    >>> parse_path('/nonexistent')['policies']
+    ['undefined']
+    
+    """
+    
+    return parse_read( read_path( path ) )
+
+def read_contents( path ):
+    """Return the contents of the file at {path}, or None if it can't be
+    read. Like parse_path(), the file is only read again after it changed.
+    
+    Examples:
+    
+    >>> read_contents('/tmp/doctest_parse_path')
+    'policies: adblock\\n'
+    >>> read_contents('/nonexistent') is None
+    True
+    
+    """
+    
+    try:
+        st = os.stat( path )
+        entry = contents.get( path )
+        if entry is None or entry[:2] != ( st.st_mtime, st.st_size ):
+            f = open( path )
+            try:
+                entry = contents[ path ] = ( st.st_mtime, st.st_size, f.read() )
+            finally:
+                f.close()
+    except (OSError, IOError):
+        return None
+    return entry[2]
+
+def list_path( path ):
+    """Return the names in the directory {path} in alphabetical order, or an
+    empty list if it can't be read. The directory is only listed again if
+    its modification time or size changed, which they do as soon as anything
+    is added to it or removed from it.
+    
+    Examples:
+    
+    >>> 'tmp' in list_path('/')
+    True
+    >>> list_path('/nonexistent')
+    []
+    
+    """
+    
+    try:
+        st = os.stat( path )
+        entry = listed.get( path )
+        if entry is None or entry[:2] != ( st.st_mtime, st.st_size ):
+            entry = listed[ path ] = ( st.st_mtime, st.st_size, sorted( os.listdir(path) ) )
+    except OSError:
+        return []
+    return list( entry[2] )
+
+
+class Loader:
+    """Reads the networks/ tree of the configuration in one go.
+    
+    The first of {locations} with a networks/ directory is the root, and is
+    only looked up once. The tree is walked once, and every netconf and
+    host file in it is read by a pool of {threads} threads, rather than
+    file by file as each Subnet and Host asks for it. The files are parsed
+    as they come in; parsing itself holds the interpreter lock, so it gains
+    nothing from more threads. Files that were parsed before (see snapshot)
+    only have to be checked for changes, which is done right away."""
+    
+    threads = 8
+    
+    def __init__( self, locations ):
+        self.root = None
+        for L in locations:
+            if os.path.isdir( L + 'networks' ):
+                self.root = L
+                break
+        
+        # The host names of every subnet, by subnet.
+        self.tree = dict()
+        # The parsed files, by path relative to the root.
+        self.files = dict()
+        
+        if self.root is None:
+            return
+        
+        with span( 'walk' ):
+            paths = []
+            top = self.root + 'networks/'
+            for net in list_path( top ):
+                if not os.path.isdir( top + net ):
+                    continue
+                paths.append( 'networks/{0}/netconf'.format(net) )
+                hosts = list_path( top + net + '/hosts' )
+                self.tree[ net ] = hosts
+                paths += [ 'networks/{0}/hosts/{1}'.format(net, h) for h in hosts ]
+        
+        with span( 'parse' ):
+            new = [ t for t in paths if self.root + t not in parsed ]
+            for t in paths:
+                if self.root + t in parsed:
+                    self.files[ t ] = parse_path( self.root + t )
+            if len(new) > self.threads > 1:
+                pool = ThreadPool( self.threads )
+                try:
+                    results = [ parse_read( t ) for t in
+                            pool.imap( read_path, [ self.root + t for t in new ], 64 ) ]
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [ parse_path( self.root + t ) for t in new ]
+            self.files.update( zip( new, results ) )
+    
+    def nets( self ):
+        """Return the name of every subnet, in order."""
+        
+        return sorted( self.tree )
+    
+    def hosts( self, net ):
+        """Return the name of every host in the subnet {net}, in order."""
+        
+        return self.tree.get( net, [] )
+    
+    def netconf( self, net ):
+        """Return the parsed netconf file of the subnet {net}."""
+        
+        return self.files.get( 'networks/{0}/netconf'.format(net) ) or parse_config('')
+    
+    def host( self, net, name ):
+        """Return the parsed file of the host {name} in the subnet {net}."""
+        
+        return self.files.get( 'networks/{0}/hosts/{1}'.format(net, name) ) or \
+                parse_config('')
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    os.unlink('/tmp/doctest_parse_path')
+    sys.exit( fail )
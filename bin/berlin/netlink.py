@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import os, socket, struct, fcntl
+
+# Finds the network interfaces and their IPv4 addresses, by asking the
+# kernel over rtnetlink: one dump of all links, and one of all addresses.
+# Where netlink can't be used, /sys/class/net and an ioctl per interface
+# are used instead.
+
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_F_SECONDARY = 0x01
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+
+# The layout of a netlink message header, and of the fixed part of the
+# link and address messages.
+nlmsghdr = struct.Struct( '=IHHII' )
+ifinfomsg = struct.Struct( '=BxHiII' )
+ifaddrmsg = struct.Struct( '=BBBBI' )
+rtattr = struct.Struct( '=HH' )
+
+
+class Link:
+    """A network interface, as the kernel knows it."""
+    
+    def __init__( self, name, index=None, flags=0 ):
+        self.name = name
+        self.index = index
+        self.flags = flags
+        # Every IPv4 address, as an (address, prefix length) tuple, the
+        # primary one first.
+        self.addresses = []
+    
+    def __repr__( self ):
+        return 'Link({0!r}, {1!r}, {2!r})'.format( self.name, self.index, self.addresses )
+    
+    def up( self ):
+        return bool( self.flags & IFF_UP )
+    
+    def loopback( self ):
+        return bool( self.flags & IFF_LOOPBACK )
+    
+    def address( self ):
+        """Return the primary IPv4 address, or None."""
+        
+        return self.addresses[0][0] if self.addresses else None
+
+
+def align( n ):
+    """Round {n} up to the 4-byte alignment of netlink messages."""
+    
+    return ( n + 3 ) & ~3
+
+def attributes( data, offset ):
+    """Return the routing attributes in {data} from {offset} on, as a dict
+    of their values by type.
+    
+    Examples:
+    
+    >>> data = rtattr.pack( 9, IFLA_IFNAME ) + 'eth0\\0' + '\\0\\0\\0'
+    >>> attributes( data, 0 )
+    {3: 'eth0\\x00'}
+    
+    """
+    
+    rv = dict()
+    while offset + rtattr.size <= len(data):
+        length, kind = rtattr.unpack_from( data, offset )
+        if length < rtattr.size:
+            break
+        rv.setdefault( kind, data[ offset+rtattr.size : offset+length ] )
+        offset += align( length )
+    return rv
+
+def dump( sock, kind, seq ):
+    """Send a dump request of type {kind} over the netlink socket {sock},
+    and yield the type and payload of every message in the reply."""
+    
+    request = struct.pack( '=B3x', socket.AF_UNSPEC if kind == RTM_GETLINK
+            else socket.AF_INET )
+    sock.send( nlmsghdr.pack( nlmsghdr.size + len(request), kind,
+            NLM_F_REQUEST | NLM_F_DUMP, seq, 0 ) + request )
+    
+    while True:
+        data = sock.recv( 65536 )
+        offset = 0
+        while offset + nlmsghdr.size <= len(data):
+            length, t, flags, s, pid = nlmsghdr.unpack_from( data, offset )
+            if length < nlmsghdr.size:
+                return
+            payload = data[ offset+nlmsghdr.size : offset+length ]
+            offset += align( length )
+            if s != seq:
+                continue
+            if t == NLMSG_DONE:
+                return
+            if t == NLMSG_ERROR:
+                raise socket.error( -struct.unpack_from( '=i', payload )[0],
+                        'netlink dump failed' )
+            yield t, payload
+
+def netlink_links():
+    """Return every network interface with its IPv4 addresses, as a dict of
+    Links by name, using two netlink dumps."""
+    
+    sock = socket.socket( socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE )
+    try:
+        sock.bind( (0, 0) )
+        
+        by_index = dict()
+        for t, payload in dump( sock, RTM_GETLINK, 1 ):
+            if t != RTM_NEWLINK:
+                continue
+            family, kind, index, flags, change = ifinfomsg.unpack_from( payload )
+            name = attributes( payload, ifinfomsg.size ).get( IFLA_IFNAME )
+            if name:
+                by_index[ index ] = Link( name.rstrip('\0'), index, flags )
+        
+        # Primary addresses come first, each kind in the order the kernel
+        # lists them, so the first primary one stays the first.
+        secondary = dict()
+        for t, payload in dump( sock, RTM_GETADDR, 2 ):
+            if t != RTM_NEWADDR:
+                continue
+            family, length, flags, scope, index = ifaddrmsg.unpack_from( payload )
+            A = attributes( payload, ifaddrmsg.size )
+            # On point-to-point links, IFA_ADDRESS is the other end.
+            address = A.get( IFA_LOCAL ) or A.get( IFA_ADDRESS )
+            if family != socket.AF_INET or index not in by_index or not address:
+                continue
+            entry = ( socket.inet_ntoa( address ), length )
+            if flags & IFA_F_SECONDARY:
+                secondary.setdefault( index, [] ).append( entry )
+            else:
+                by_index[ index ].addresses.append( entry )
+        for index, entries in secondary.items():
+            by_index[ index ].addresses += entries
+    finally:
+        sock.close()
+    
+    return dict([ (L.name, L) for L in by_index.values() ])
+
+def sysfs_links( root='/sys/class/net' ):
+    """Return every network interface in {root} with its primary IPv4
+    address, as a dict of Links by name, using an ioctl per interface."""
+    
+    def read( name, field ):
+        try:
+            f = open( os.path.join( root, name, field ) )
+            try:
+                return int( f.read().strip(), 0 )
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+    
+    try:
+        names = os.listdir( root )
+    except OSError:
+        return dict()
+    
+    rv = dict()
+    s = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    for name in names:
+        L = rv[ name ] = Link( name, read( name, 'ifindex' ), read( name, 'flags' ) or 0 )
+        try:
+            ifreq = struct.pack( '256s', name[:15] )
+            address = fcntl.ioctl( s.fileno(), SIOCGIFADDR, ifreq )[20:24]
+            mask = fcntl.ioctl( s.fileno(), SIOCGIFNETMASK, ifreq )[20:24]
+            L.addresses.append( ( socket.inet_ntoa( address ),
+                    bin( struct.unpack( '!I', mask )[0] ).count('1') ) )
+        except IOError:
+            pass
+    s.close()
+    return rv
+
+def links():
+    """Return every network interface with its IPv4 addresses, as a dict of
+    Links by name.
+    
+    Examples:
+    
+    >>> L = links()
+    >>> L['lo'].address(), L['lo'].addresses[0], L['lo'].loopback()
+    ('127.0.0.1', ('127.0.0.1', 8), True)
+    >>> sorted( L ) == sorted( sysfs_links() )
+    True
+    
+    """
+    
+    try:
+        return netlink_links()
+    except (socket.error, AttributeError):
+        # No netlink here (AttributeError: no AF_NETLINK at all).
+        return sysfs_links()
+
+def device_names( L ):
+    """Return the names of the interfaces in {L}, as returned by links(),
+    leaving out loopback interfaces, in alphabetical order.
+    
+    Examples:
+    
+    >>> device_names( dict( lo=Link('lo', 1, IFF_LOOPBACK), eth1=Link('eth1', 3),
+    ...     eth0=Link('eth0', 2) ) )
+    ['eth0', 'eth1']
+    
+    """
+    
+    return sorted([ name for name, T in L.items() if not T.loopback() ])
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
@@ -21,6 +21,14 @@ import termios, sys, os
 import subprocess
 from collections import *
 from getpass import getuser
+from build import sync_tree
+from netlink import Link, links, device_names
+from loader import Loader, parse_config, parse_path, read_contents, list_path
+import snapshot
+from output import span
+
+# The configuration directories, in the order they are searched.
+locations = ['/etc/berlin/','/etc/vuurmuur/','/etc/firewall.d/config/']
 
 def open_file( filename, mode ):
     """Does the same as open(), only transparently checks multiple locations."""
@@ -29,8 +37,6 @@ def open_file( filename, mode ):
         # This is an absolute path, so just open that file.
         return open( filename, mode )
     
-    locations = ['/etc/berlin/','/etc/vuurmuur/','/etc/firewall.d/config/']
-    
     for L in locations:
         fn = L + filename
         try:
@@ -41,26 +47,30 @@ def open_file( filename, mode ):
     
     raise IOError("File not found, or permission denied.")
 
-def list_directory( dir ):
-    """Does the same as os.listdir, only it transparently checks multiple
-    locations."""
-    
-    if dir[0] == '/':
-        try:
-            return os.listdir(dir)
-        except OSError:
-            return []
-    
-    locations = ['/etc/berlin/','/etc/vuurmuur/','/etc/firewall.d/config/']
+def find_file( filename ):
+    """Return the path of {filename} in the first location that has it, or
+    None if none does."""
     
+    if filename[0] == '/':
+        return filename if os.path.exists( filename ) else None
     for L in locations:
-        dn = L + dir
-        try:
-            return os.listdir(dn)
-        except OSError:
-            pass
+        if os.path.exists( L + filename ):
+            return L + filename
+    return None
+
+def list_directory( dir ):
+    """Does the same as os.listdir, only it transparently checks multiple
+    locations, and returns the names in alphabetical order."""
     
-    return []
+    with span( 'list_directory' ):
+        if dir[0] == '/':
+            return list_path( dir )
+        
+        for L in locations:
+            if os.path.isdir( L + dir ):
+                return list_path( L + dir )
+        
+        return []
 
 def file_put_contents( filename, data ):
     """Write str({data}) to the file {filename}."""
@@ -107,19 +117,11 @@ def parse_file( filename ):
     
     """
     
-    rv = defaultdict(lambda:['undefined'])
-    try:
-        f = open_file( filename, 'r' )
-    except(OSError, IOError):
-        pass
-    else:
-        s = f.read()
-        l = [ t.split(':',1) for t in s.splitlines() ]
-        for i in l:
-            if len(i) < 2: continue
-            rv[i[0].strip()] = [t.strip() for t in i[1].split(None)]
-        f.close()
-    return rv
+    with span( 'parse_file' ):
+        path = find_file( filename )
+        if path is None:
+            return parse_config( '' )
+        return parse_path( path )
 
 def unparse_file( data ):
     """String-format a configuration file.
@@ -156,19 +158,24 @@ class Config:
     local_services = []
     network_services = []
     
-    def __init__( self, network_devices=None ):
-        """Parses the config directories into a Config class."""
+    def __init__( self, network_devices=None, snapshot_file=None ):
+        """Parses the config directories into a Config class.
+        
+        If {snapshot_file} is given, everything that was parsed before and
+        did not change since is taken from there, and the snapshot is
+        brought up to date afterwards."""
+        
+        if snapshot_file is not None:
+            snapshot.load( snapshot_file )
         
         self.Interfaces = []
         self.ifconfig = parse_file("if-config")
         
+        # One look at the kernel's interfaces, shared by every Iface.
+        with span( 'interfaces' ):
+            L = links()
         if network_devices == None:
-            #print "   detecting network devices..."
-            P = subprocess.Popen( ['/bin/sh', '-c',
-                '/sbin/ifconfig -a -s 2>/dev/null | grep -v Iface '
-                    '| cut -d\  -f1 | cut -d: -f1 | grep -v lo | sort | uniq'],
-                stdout=subprocess.PIPE )
-            s = P.stdout.read()
+            s = '\n'.join( device_names(L) )
         else:
             s = network_devices
         
@@ -179,12 +186,16 @@ class Config:
             self.open_port(portfile)
         
         
-        # Get a list of subnets
-        nets = list_directory('networks')
+        # Read every subnet once; each Iface takes the ones on it.
+        loader = Loader( locations )
+        nets = [ Subnet( N, loader ) for N in loader.nets() ]
         
         gb = None
         for ifx in s.splitlines():
-            I = Iface( ifx.strip(), self.ifconfig, nets )
+            # A device the kernel doesn't know gets an empty Link, rather
+            # than None, which would have Iface look at every device again.
+            name = ifx.strip()
+            I = Iface( name, self.ifconfig, nets, L.get( name ) or Link( name ) )
             
             if gb is None and I.enabled and not I.wan_interface:
                 gb = I
@@ -192,9 +203,12 @@ class Config:
             self.Interfaces.append( I )
         
         for N in nets:
-            gb.subnets.append(Subnet(N))
+            gb.subnets.append( N )
         
         self.tion = ( self.Interfaces[0], None, None )
+        
+        if snapshot_file is not None:
+            snapshot.save( snapshot_file )
     
     def open_port(self, portfile):
         """Parse an 'open port' file.
@@ -209,9 +223,10 @@ class Config:
         """
         
         try:
-            f = open_file("ports/" + portfile,'r')
-            c = f.read().strip()
-            f.close()
+            c = read_contents( find_file( "ports/" + portfile ) or '' )
+            if c is None:
+                raise IOError( portfile )
+            c = c.strip()
             port = int(portfile)
         except IOError, ValueError: 
             print "Error parsing portfile {0}".format(portfile)
@@ -223,32 +238,39 @@ class Config:
         else:
             self.local_services.append( port )
     
-    def Export( self ):
-        """Writes back all config files into /tmp/firewall/."""
+    def Export( self, destination='/tmp/firewall' ):
+        """Writes back all config files into {destination}.
+        
+        Everything is written to a scratch directory first, and then only the
+        files that changed are copied over, so nothing built from the others
+        has to be rebuilt. Returns a list of the files that changed."""
         
+        dir = destination + '.new'
         ifaces_file = self.interfaces_file()
         
         subprocess.call([
-            'rm', '-rf', '/tmp/firewall'
+            'rm', '-rf', dir
         ])
-        os.mkdir( '/tmp/firewall' )
+        os.mkdir( dir )
         
         # Export special configuration files
-        file_put_contents( '/tmp/firewall/if-config', self.if_config_file() )
-        file_put_contents( '/tmp/firewall/interfaces', self.interfaces_file() )
-        file_put_contents( '/tmp/firewall/dhcpd.conf', self.dhcp_conf() )
+        file_put_contents( dir + '/if-config', self.if_config_file() )
+        file_put_contents( dir + '/interfaces', self.interfaces_file() )
+        file_put_contents( dir + '/dhcpd.conf', self.dhcp_conf() )
         
         # Export all networks
-        os.mkdir( '/tmp/firewall/networks' )
+        os.mkdir( dir + '/networks' )
         for I in self.Interfaces:
-            I.Export( '/tmp/firewall/networks' )
+            I.Export( dir + '/networks' )
         
         # Export all open or forwarded ports
-        os.mkdir( '/tmp/firewall/ports' )
+        os.mkdir( dir + '/ports' )
         for port in self.local_services:
-            file_put_contents( '/tmp/firewall/ports/' + str(int(port)), '' )
+            file_put_contents( dir + '/ports/' + str(int(port)), '' )
         for port,host in self.network_services:
-            file_put_contents( '/tmp/firewall/ports/' + str(int(port)), host )
+            file_put_contents( dir + '/ports/' + str(int(port)), host )
+        
+        return sync_tree( dir, destination )
     
     
     def if_config_file( self ):
@@ -386,11 +408,35 @@ class Iface:
     
     subnets = None
     
-    def __init__( self, name='##', ifconfig=defaultdict(lambda:'undefined'), nets=[] ):
+    def __init__( self, name='##', ifconfig=defaultdict(lambda:'undefined'), nets=[],
+            link=None ):
         """Create a new Iface object.
         
-        Create a new Iface object, adding all appropriate subnets to its own
-        collection."""
+        Create a new Iface object, taking the Subnets in {nets} that are on
+        this interface out of {nets} into its own collection. Its address is
+        taken from {link}, as returned by netlink.links(), or looked up if
+        that isn't given; a Link without addresses leaves it empty.
+        
+        Examples:
+        
+        >>> from netlink import Link
+        >>> L = Link( 'eth1', 3 ); L.addresses = [ ('192.168.1.1', 24) ]
+        >>> Iface( 'eth1', link=L ).address
+        '192.168.1.1'
+        >>> Iface( 'lo' ).address
+        '127.0.0.1'
+        >>> Iface( 'nonexistent0' ).address
+        ''
+        >>> Iface( 'nonexistent0', link=Link('nonexistent0') ).address
+        ''
+        >>> N = [ Subnet('1'), Subnet('2'), Subnet('3') ]
+        >>> N[0].interface = N[1].interface = 'eth1'
+        >>> C = parse_config( 'internal interface: eth1' )
+        >>> I = Iface( 'eth1', C, N, L )
+        >>> [ S.address for S in I.subnets ], [ S.address for S in N ]
+        (['1', '2'], ['3'])
+        
+        """
         
         self.name = name
         self.subnets = []
@@ -400,19 +446,15 @@ class Iface:
             self.wan_address = ' '.join(ifconfig['wan address'])
         elif name in ifconfig['internal interface']:
             self.enabled = True
-            for net in nets:
-                N = Subnet( net )
-                if N.interface != self.name: continue
-                self.subnets.append( N )
-                nets.remove( net )
-        
-        ifc = subprocess.Popen( ['/sbin/ifconfig', name], stdout = subprocess.PIPE, stderr = subprocess.PIPE )
-        ifc.stderr.close()
-        pipe = subprocess.Popen( [ '/bin/sh', '-c',
-            'grep -oP "inet addr:(([0-9]+\.){3}[0-9]+)" | cut -d: -f2'
-        ], stdin = ifc.stdout, stdout = subprocess.PIPE )
-        ifc.stdout.close()
-        self.address = pipe.stdout.read().strip()
+            self.subnets = [ N for N in nets if N.interface == self.name ]
+            nets[:] = [ N for N in nets if N.interface != self.name ]
+        
+        if link is None:
+            with span( 'interfaces' ):
+                link = links().get( name )
+        self.address = ''
+        if link is not None and link.address():
+            self.address = link.address()
         
     def __repr__( self ):
         return "ifx{{name}}".format( name=self.name )
@@ -535,15 +577,22 @@ class Subnet:
     policies = None
     services = [] # TODO: implement
     
-    def __init__(self, net):
-        nc = parse_file( 'networks/{net}/netconf'.format( net=net ) )
+    def __init__(self, net, loader=None):
+        """Read the subnet {net}, from {loader} if given, as a Loader that
+        has already read the configuration, or else from its files."""
+        
+        if loader is None:
+            nc = parse_file( 'networks/{net}/netconf'.format( net=net ) )
+            hf = list_directory( 'networks/{net}/hosts'.format( net=net ) )
+            self.hosts = [Host(t,net) for t in hf]
+        else:
+            nc = loader.netconf( net )
+            self.hosts = [Host(t,net,loader.host(net,t)) for t in loader.hosts(net)]
         self.name = ' '.join(nc['friendly name'])
         self.address = net
         self.policies = nc['policies']
         while 'undefined' in self.policies:
             self.policies.remove('undefined')
-        hf = list_directory( 'networks/{net}/hosts'.format( net=net ) )
-        self.hosts = [Host(t,net) for t in hf]
         self.interface = ' '.join(nc['interface'])
     
     def net( self ):
@@ -688,12 +737,16 @@ class Host:
     name = '';
     comment = '';
     
-    def __init__( self, name, net ):
+    def __init__( self, name, net, hf=None ):
+        """Read the host {name} in the subnet {net}, or take its parsed file
+        as {hf}."""
+        
         self.name = name
         fn = 'networks/{net}/hosts/{name}'.format(
             net=net, name=name
         )
-        hf = parse_file( fn )
+        if hf is None:
+            hf = parse_file( fn )
         self.mac = ' '.join(hf['hardware ethernet'])
         ipaddr = ' '.join(hf['fixed address']).strip().split('.')
         if ipaddr[0] == 'undefined':
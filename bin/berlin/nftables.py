@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+from rule import Rule, Comment, parse_mark
+from diff import builtin_chains
+
+# Every iptables table we use becomes an nftables table of its own.
+table_names = dict({ 'nat': 'berlin_nat', 'filter': 'berlin_filter' })
+
+# Base chain types, hooks and priorities, as iptables-nft would use them.
+base_chains = dict({
+    ('nat', 'PREROUTING'): ('nat', 'prerouting', -100),
+    ('nat', 'OUTPUT'): ('nat', 'output', -100),
+    ('nat', 'POSTROUTING'): ('nat', 'postrouting', 100),
+    ('filter', 'INPUT'): ('filter', 'input', 0),
+    ('filter', 'FORWARD'): ('filter', 'forward', 0),
+    ('filter', 'OUTPUT'): ('filter', 'output', 0),
+})
+
+# Targets that translate to a verdict without arguments.
+verdicts = dict({ 'ACCEPT': 'accept', 'DROP': 'drop', 'RETURN': 'return' })
+
+# Set types, and how their members are written.
+set_types = dict({
+    'hash:ip': ('ipv4_addr', False),
+    'hash:net': ('ipv4_addr', True),
+    'hash:net,net': ('ipv4_addr . ipv4_addr', True),
+})
+
+
+def address( net ):
+    """Write an address or network the way nft does.
+    
+    Examples:
+    
+    >>> address('10.0.0.1/32'), address('10.0.0.0/8')
+    ('10.0.0.1', '10.0.0.0/8')
+    
+    """
+    
+    return net[:-3] if net.endswith('/32') else net
+
+def iface( name ):
+    """Quote an interface name, translating the iptables wildcard.
+    
+    Examples:
+    
+    >>> print iface('eth0'), iface('ppp+')
+    "eth0" "ppp*"
+    
+    """
+    
+    return '"{0}"'.format( name[:-1] + '*' if name.endswith('+') else name )
+
+def ports( port ):
+    """Write a port, range or comma separated list of ports.
+    
+    Examples:
+    
+    >>> ports('1024:65535'), ports('25,465,587'), ports('80')
+    ('1024-65535', '{ 25, 465, 587 }', '80')
+    
+    """
+    
+    port = port.replace(':','-')
+    if ',' in port:
+        return '{ ' + ', '.join( port.split(',') ) + ' }'
+    return port
+
+def option( tokens, name, default=None ):
+    """Return the value following {name} in {tokens}."""
+    
+    for i, t in enumerate( tokens[:-1] ):
+        if t == name:
+            return tokens[i+1]
+    return default
+
+def match_statements( rule ):
+    """Translate everything {rule} matches on into nft expressions.
+    
+    Raises an Exception for match modules without a translation, since
+    leaving them out would change what the rule matches.
+    
+    Examples:
+    
+    >>> match_statements( Rule.parse('-s 10.0.0.0/8 -i eth1 -p tcp --dport 80 -m state --state NEW,ESTABLISHED') )
+    ['iifname "eth1"', 'ip saddr 10.0.0.0/8', 'tcp dport 80', 'ct state { new, established }']
+    >>> match_statements( Rule.parse('-p tcp -m multiport --dports 25,465 -m set ! --match-set x dst') )
+    ['meta l4proto tcp', 'tcp dport { 25, 465 }', 'ip daddr != @x']
+    >>> match_statements( Rule.parse('-m connmark --mark 0x1100/0x3300') )
+    ['ct mark and 0x3300 == 0x1100']
+    >>> match_statements( Rule.parse('-m foo --bar') )
+    Traceback (most recent call last):
+    ...
+    Exception: No nftables translation for -m foo --bar
+    
+    """
+    
+    rv = []
+    if rule.iface_in is not None:
+        rv.append( 'iifname ' + iface(rule.iface_in) )
+    if rule.iface_out is not None:
+        rv.append( 'oifname ' + iface(rule.iface_out) )
+    if rule.source is not None:
+        rv.append( 'ip saddr ' + address(rule.source) )
+    if rule.destination is not None:
+        rv.append( 'ip daddr ' + address(rule.destination) )
+    
+    if rule.protocol is not None:
+        if rule.sport is None and rule.dport is None:
+            rv.append( 'meta l4proto ' + rule.protocol )
+        if rule.sport is not None:
+            rv.append( '{0} sport {1}'.format( rule.protocol, ports(rule.sport) ) )
+        if rule.dport is not None:
+            rv.append( '{0} dport {1}'.format( rule.protocol, ports(rule.dport) ) )
+    
+    if rule.state:
+        state = [ t.lower() for t in rule.state ]
+        rv.append( 'ct state ' + ( state[0] if len(state) == 1
+                else '{ ' + ', '.join(state) + ' }' ) )
+    
+    fields = dict({ '-s': 'ip saddr', '-d': 'ip daddr', '-i': 'iifname',
+            '-o': 'oifname', '-p': 'meta l4proto' })
+    
+    for m in rule.matches:
+        negate = '!' in m
+        op = '!= ' if negate else ''
+        T = [ t for t in m if t != '!' ]
+        
+        if T[0] in fields and len(T) == 2:
+            value = iface(T[1]) if T[0] in ('-i','-o') else \
+                    address(T[1]) if T[0] in ('-s','-d') else T[1]
+            rv.append( '{0} {1}{2}'.format( fields[T[0]], op, value ) )
+            continue
+        
+        module = T[1] if T[0] in ('-m','--match') and len(T) > 1 else None
+        if module == 'set':
+            name = option( T, '--match-set' )
+            direction = option( T, name, 'dst' ).split(',')
+            keys = [ 'ip saddr' if t == 'src' else 'ip daddr' for t in direction ]
+            rv.append( '{0} {1}@{2}'.format( ' . '.join(keys), op, name ) )
+        elif module == 'multiport' and rule.protocol and not negate:
+            for o, field in [ ('--sports','sport'), ('--dports','dport'),
+                    ('--ports','th dport') ]:
+                if option( T, o ):
+                    rv.append( '{0} {1} {2}'.format( rule.protocol,
+                            field, ports(option(T, o)) ) )
+        elif module == 'helper' and not negate:
+            rv.append( 'ct helper "{0}"'.format( option(T, '--helper') ) )
+        elif module in ('mark', 'connmark'):
+            value, _, mask = option( T, '--mark' ).partition('/')
+            key = 'ct mark' if module == 'connmark' else 'meta mark'
+            if mask:
+                key += ' and ' + mask
+            rv.append( '{0} {1}{2}'.format( key, op or '== ', value ) )
+        elif module == 'limit' and not negate:
+            rate = option( T, '--limit', '3/hour' ).split('/')
+            units = dict({ 's': 'second', 'm': 'minute', 'h': 'hour', 'd': 'day' })
+            rv.append( 'limit rate {0}/{1} burst {2} packets'.format( rate[0],
+                    units[ rate[1][0] ], option(T, '--limit-burst', 5) ) )
+        else:
+            raise Exception( 'No nftables translation for {0}'.format( ' '.join(m) ) )
+    
+    return rv
+
+def verdict( rule ):
+    """Translate the target of {rule} into an nft statement.
+    
+    Examples:
+    
+    >>> verdict( Rule.parse('-j REJECT --reject-with icmp-port-unreachable') )
+    'reject'
+    >>> verdict( Rule.parse('-j LOG --log-prefix "  [SMTP] "') )
+    'log prefix "  [SMTP] "'
+    >>> verdict( Rule.parse('-j DNAT --to 10.0.0.1') ), verdict( Rule.parse('-g to_gateway') )
+    ('dnat to 10.0.0.1', 'goto to_gateway')
+    >>> verdict( Rule.parse('-j CONNMARK --set-mark 0x1101') ), verdict( Rule.parse('-j MARK --set-xmark 0x1/0xff') )
+    ('ct mark set 0x1101', 'meta mark set meta mark and 0xffffff00 xor 0x1')
+    
+    """
+    
+    t = rule.target
+    args = rule.target_args
+    
+    if t is None:
+        return 'counter'
+    if t in verdicts:
+        return verdicts[t]
+    if t == 'REJECT':
+        with_ = option( args, '--reject-with', 'icmp-port-unreachable' )
+        if with_ == 'icmp-port-unreachable':
+            return 'reject'
+        if with_ == 'tcp-reset':
+            return 'reject with tcp reset'
+        return 'reject with icmp type ' + with_.replace('icmp-','',1)
+    if t == 'LOG':
+        rv = 'log'
+        if option( args, '--log-prefix' ) is not None:
+            rv += ' prefix "{0}"'.format( option(args, '--log-prefix') )
+        if option( args, '--log-level' ) is not None:
+            rv += ' level ' + option( args, '--log-level' )
+        return rv
+    if t == 'DNAT':
+        return 'dnat to ' + ( option(args, '--to-destination') or option(args, '--to') )
+    if t == 'SNAT':
+        return 'snat to ' + ( option(args, '--to-source') or option(args, '--to') )
+    if t == 'MASQUERADE':
+        return 'masquerade'
+    if t == 'REDIRECT':
+        return 'redirect to :' + ports( option(args, '--to-ports') )
+    if t in ('MARK', 'CONNMARK') and option( args, '--set-xmark' ):
+        mark = 'meta mark' if t == 'MARK' else 'ct mark'
+        value, mask = parse_mark( option( args, '--set-xmark' ) )
+        if mask == 0xffffffff:
+            return '{0} set 0x{1:x}'.format( mark, value )
+        return '{0} set {0} and 0x{1:x} xor 0x{2:x}'.format( mark,
+                ~mask & 0xffffffff, value )
+    if t.isupper() or args:
+        raise Exception( 'No nftables translation for -j {0}'.format(
+                ' '.join( (t,) + args ) ) )
+    return ( 'goto ' if rule.goto else 'jump ' ) + t
+
+def render_rule( rule ):
+    """Translate a single rule.
+    
+    Examples:
+    
+    >>> print render_rule( Rule.parse('-d 10.0.0.1 -i eth0 -p tcp -m tcp --dport 80 -j DNAT --to-destination 192.168.1.2') )
+    iifname "eth0" ip daddr 10.0.0.1 tcp dport 80 dnat to 192.168.1.2
+    
+    """
+    
+    return ' '.join( match_statements(rule) + [ verdict(rule) ] )
+
+def fold_key( rule, *fields ):
+    """Return the key of {rule}, leaving out {fields} and its target."""
+    
+    changes = dict([ (f, None) for f in fields ])
+    changes.update({ 'target': None, 'target_args': (), 'goto': False })
+    return rule.copy( **changes ).key()
+
+def fold_dnat( rules ):
+    """Fold a run of DNAT rules, that only differ in their destination port
+    and where they forward to, into a single rule using a map.
+    
+    Returns the rule and the number of rules it replaces; if nothing can be
+    folded, that number is 0.
+    
+    Examples:
+    
+    >>> P = lambda L: [ Rule.parse('-d 1.2.3.4 -i eth0 -p tcp ' + t) for t in L ]
+    >>> fold_dnat(P([ '--dport 80 -j DNAT --to-destination 10.0.0.2',
+    ...     '--dport 25 -j DNAT --to-destination 10.0.0.3:2525', '--dport 22 -j ACCEPT' ]))
+    ('iifname "eth0" ip daddr 1.2.3.4 dnat ip addr . port to tcp dport map { 80 : 10.0.0.2 . 80, 25 : 10.0.0.3 . 2525 }', 2)
+    
+    """
+    
+    first = rules[0]
+    if not isinstance( first, Rule ) or first.target != 'DNAT' or \
+            first.dport is None or first.protocol not in ('tcp','udp'):
+        return None, 0
+    
+    key = fold_key( first, 'dport' )
+    group = []
+    for r in rules:
+        if not isinstance( r, Rule ) or r.target != 'DNAT' or \
+                fold_key( r, 'dport' ) != key or r.dport in [ t[0] for t in group ] or \
+                not r.dport.isdigit():
+            break
+        to = option( r.target_args, '--to-destination' ) or option( r.target_args, '--to' )
+        if not to or to[0] == ':' or '-' in to:
+            break
+        group.append( (r.dport, to) )
+    
+    if len(group) < 2:
+        return None, 0
+    
+    matches = match_statements( first.copy( dport=None ) )
+    matches = [ t for t in matches if t != 'meta l4proto ' + first.protocol ]
+    
+    if all([ ':' not in to for port, to in group ]):
+        elements = [ '{0} : {1}'.format( port, to ) for port, to in group ]
+        statement = 'dnat to {0} dport map {{ {1} }}'
+    else:
+        elements = [ '{0} : {1} . {2}'.format( port, to.split(':')[0],
+                to.split(':')[1] if ':' in to else port ) for port, to in group ]
+        statement = 'dnat ip addr . port to {0} dport map {{ {1} }}'
+    
+    return ' '.join( matches + [ statement.format( first.protocol,
+            ', '.join(elements) ) ] ), len(group)
+
+def fold_interfaces( rules ):
+    """Fold a run of rules, that only differ in their interfaces and simple
+    verdicts, into a single rule using an anonymous set or verdict map.
+    
+    Returns the rule and the number of rules it replaces; if nothing can be
+    folded, that number is 0.
+    
+    Examples:
+    
+    >>> P = lambda L: [ Rule.parse(t) for t in L ]
+    >>> fold_interfaces(P([ '-i eth1 -o eth1 -j ACCEPT', '-i eth2 -o eth2 -j ACCEPT' ]))
+    ('iifname . oifname { "eth1" . "eth1", "eth2" . "eth2" } accept', 2)
+    >>> fold_interfaces(P([ '-i eth1 -p tcp --dport 53 -j ACCEPT',
+    ...     '-i eth2 -p tcp --dport 53 -j DROP', '-i eth1 -p tcp --dport 53 -j DROP' ]))
+    ('tcp dport 53 iifname vmap { "eth1" : accept, "eth2" : drop }', 2)
+    
+    """
+    
+    def simple( r ):
+        return isinstance( r, Rule ) and not r.target_args and r.target is not None \
+                and ( r.target in verdicts or not r.target.isupper() ) \
+                and not [ t for t in (r.iface_in, r.iface_out) if t and t.endswith('+') ] \
+                and ( r.iface_in or r.iface_out )
+    
+    first = rules[0]
+    if not simple( first ):
+        return None, 0
+    
+    fields = ( first.iface_in is not None, first.iface_out is not None )
+    key = fold_key( first, 'iface_in', 'iface_out' )
+    group = []
+    for r in rules:
+        if not simple( r ) or fold_key( r, 'iface_in', 'iface_out' ) != key or \
+                ( r.iface_in is not None, r.iface_out is not None ) != fields or \
+                (r.iface_in, r.iface_out) in [ t[0] for t in group ]:
+            break
+        group.append( ( (r.iface_in, r.iface_out), verdict(r) ) )
+    
+    if len(group) < 2:
+        return None, 0
+    
+    # Only look at the interfaces that actually differ.
+    used = [ i for i in (0, 1) if fields[i] and
+            len(set([ t[0][i] for t in group ])) > 1 ]
+    if not used:
+        return None, 0
+    names = [ ('iifname','oifname')[i] for i in used ]
+    keys = [ ' . '.join([ iface(t[0][i]) for i in used ]) for t in group ]
+    
+    changes = dict([ (('iface_in','iface_out')[i], None) for i in used ])
+    matches = match_statements( first.copy( **changes ) )
+    
+    if len(set([ t[1] for t in group ])) == 1:
+        folded = '{0} {{ {1} }} {2}'.format( ' . '.join(names), ', '.join(keys),
+                group[0][1] )
+    else:
+        folded = '{0} vmap {{ {1} }}'.format( ' . '.join(names),
+                ', '.join([ '{0} : {1}'.format( k, t[1] ) for k, t in zip(keys, group) ]) )
+    
+    return ' '.join( matches + [ folded ] ), len(group)
+
+def render_chain( rules ):
+    """Translate the rules of a chain, folding them where possible.
+    
+    Examples:
+    
+    >>> for t in render_chain([ Comment('# Internal'),
+    ...     Rule.parse('-i eth1 -j ACCEPT'), Rule.parse('-i eth2 -j ACCEPT'),
+    ...     Rule.parse('-j REJECT') ]): print t
+    # Internal
+    iifname { "eth1", "eth2" } accept
+    reject
+    
+    """
+    
+    i = 0
+    while i < len(rules):
+        if not isinstance( rules[i], Rule ):
+            if str(rules[i]).strip():
+                yield str(rules[i]).strip()
+            i += 1
+            continue
+        
+        folded, n = fold_dnat( rules[i:] )
+        if not n:
+            folded, n = fold_interfaces( rules[i:] )
+        if n:
+            yield folded
+            i += n
+        else:
+            yield render_rule( rules[i] )
+            i += 1
+
+def set_definition( name, settype, members ):
+    """Declare a named set, with its members.
+    
+    Examples:
+    
+    >>> for t in set_definition( 'x', 'hash:net', ['10.0.0.1', '10.1.0.0/16'] ): print t
+    set x {
+        type ipv4_addr
+        flags interval
+        elements = { 10.0.0.1, 10.1.0.0/16 }
+    }
+    
+    """
+    
+    datatype, interval = set_types[ settype ]
+    yield 'set {0} {{'.format( name )
+    yield '    type ' + datatype
+    if interval:
+        yield '    flags interval'
+    
+    members = [ ' . '.join( t.split(',') ) for t in members ]
+    for i in range( 0, len(members), 8 ):
+        yield '    {0}{1}{2}'.format(
+                'elements = { ' if i == 0 else '             ',
+                ', '.join( members[i:i+8] ),
+                ' }' if i+8 >= len(members) else ',' )
+    yield '}'
+
+def replace_set( rules, S ):
+    """Return {rules}, with the rules that the 'set' {S} of their chain
+    stands for (see Ruleset.create_filter) replaced by its single rule, in
+    the place of the first of them. Anything added to the chain since, such
+    as comments, stays where it is.
+    
+    Examples:
+    
+    >>> A, B = Rule.parse('-d 10.0.0.1 -j DROP'), Rule.parse('-d 10.0.0.2 -j DROP')
+    >>> S = dict( rule=Rule.parse('-m set --match-set x dst -j DROP'), replaces=[A, B] )
+    >>> replace_set( [ Comment('# Hits'), A, Comment('# [5:300]'), B, Rule(target='RETURN') ], S )
+    [Comment('# Hits'), Rule('-m set --match-set x dst -j DROP'), Comment('# [5:300]'), Rule('-j RETURN')]
+    
+    """
+    
+    replaced = set([ id(t) for t in S['replaces'] ])
+    rv = []
+    placed = False
+    for t in rules:
+        if id(t) not in replaced:
+            rv.append( t )
+        elif not placed:
+            rv.append( S['rule'] )
+            placed = True
+    return rv
+
+def render_nft( ruleset ):
+    """Generate a script for  nft -f  that loads {ruleset}, line by line.
+    
+    Every table is created, deleted and defined again in a single
+    transaction, so the old rules are replaced atomically. Address filters
+    become named sets, and are matched by a single rule each, even if the
+    ruleset itself does not use ipset.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> R = Ruleset()
+    >>> R.new_chain( 'to_gateway', table='nat', policy='-' )
+    >>> R.append_chain( 'to_gateway', '-s 10.0.0.0/24 -j DNAT --to-destination 10.0.0.1', table='nat' )
+    >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+    >>> print ''.join( render_nft( R ) ),
+    #!/usr/sbin/nft -f
+    <BLANKLINE>
+    table ip berlin_nat
+    delete table ip berlin_nat
+    table ip berlin_nat {
+        chain PREROUTING {
+            type nat hook prerouting priority -100; policy accept;
+        }
+        chain POSTROUTING {
+            type nat hook postrouting priority 100; policy accept;
+        }
+        chain OUTPUT {
+            type nat hook output priority -100; policy accept;
+        }
+        chain to_gateway {
+        }
+    <BLANKLINE>
+        chain to_gateway {
+            ip saddr 10.0.0.0/24 dnat to 10.0.0.1
+        }
+    }
+    <BLANKLINE>
+    table ip berlin_filter
+    delete table ip berlin_filter
+    table ip berlin_filter {
+        chain INPUT {
+            type filter hook input priority 0; policy drop;
+        }
+        chain FORWARD {
+            type filter hook forward priority 0; policy drop;
+        }
+        chain OUTPUT {
+            type filter hook output priority 0; policy drop;
+        }
+    <BLANKLINE>
+        chain INPUT {
+            iifname "lo" accept
+        }
+    }
+    
+    """
+    
+    yield '#!/usr/sbin/nft -f\n'
+    
+    for tb in ['nat','filter']:
+        table = ruleset.all_chains[tb]
+        name = table_names[tb]
+        order = builtin_chains[tb] + sorted([ t for t in table.keys()
+                if t not in builtin_chains[tb] and 'tree' not in table[t] ])
+        
+        yield '\n'
+        yield 'table ip {0}\n'.format( name )
+        yield 'delete table ip {0}\n'.format( name )
+        yield 'table ip {0} {{\n'.format( name )
+        
+        # Sets first, from the address filters and from ipset.
+        sets = dict()
+        for ch in order:
+            if 'set' in table[ch]:
+                S = table[ch]['set']
+                sets[ch] = ( 'hash:net', S['members'] )
+        for s, S in ruleset.all_sets.items():
+            sets.setdefault( s, ( S['type'], S['members'] ) )
+        for s in sorted( sets.keys() ):
+            for line in set_definition( s, *sets[s] ):
+                yield '    {0}\n'.format( line )
+        
+        # Declare every chain before any rule can jump to it.
+        for ch in order:
+            yield '    chain {0} {{\n'.format( ch )
+            if (tb, ch) in base_chains:
+                yield '        type {0} hook {1} priority {2}; policy {3};\n'.format(
+                        *base_chains[(tb, ch)] + ( table[ch]['policy'].lower(), ) )
+            yield '    }\n'
+        
+        for ch in order:
+            rules = table[ch]['rules']
+            if 'set' in table[ch]:
+                rules = replace_set( rules, table[ch]['set'] )
+            if not [ t for t in rules if isinstance( t, Rule ) ]:
+                continue
+            
+            yield '\n'
+            yield '    chain {0} {{\n'.format( ch )
+            for line in render_chain( rules ):
+                yield '        {0}\n'.format( line )
+            yield '    }\n'
+        
+        yield '}\n'
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import socket
+from collections import defaultdict
+from addresses import ip_to_int, int_to_ip
+from rule import Rule, Comment
+from output import debug
+
+# The longest chain name iptables accepts.
+max_chain_name = 28
+
+# Targets after which no other rule in the chain is looked at.
+terminal_targets = set([ 'ACCEPT', 'DROP', 'REJECT', 'RETURN',
+        'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT' ])
+
+
+def is_terminal( rule ):
+    """Check whether a packet matching {rule} never reaches the next rule.
+    
+    Examples:
+    
+    >>> is_terminal(Rule.parse('-j ACCEPT')), is_terminal(Rule.parse('-g ad_filter'))
+    (True, True)
+    >>> is_terminal(Rule.parse('-j LOG')), is_terminal(Rule.parse('-j ad_filter'))
+    (False, False)
+    
+    """
+    
+    return rule.goto or rule.target in terminal_targets
+
+def supernets( net ):
+    """Return every network containing {net}, including {net} itself and
+    None, which stands for any address.
+    
+    Examples:
+    
+    >>> supernets('10.0.0.0/30')[-3:]
+    ['10.0.0.0/28', '10.0.0.0/29', '10.0.0.0/30']
+    >>> len(supernets('10.0.0.0/30')), supernets(None)
+    (32, [None])
+    
+    """
+    
+    if net is None:
+        return [None]
+    try:
+        address, length = net.split('/')
+        address, length = ip_to_int(address), int(length)
+    except (ValueError, socket.error):
+        # Not something we can reason about, so only an exact match will do.
+        return [None, net]
+    
+    rv = [None]
+    for l in range(0, length+1):
+        mask = (0xffffffff << (32-l)) & 0xffffffff
+        rv.append( '{0}/{1}'.format( int_to_ip(address & mask), l ) )
+    return rv
+
+def port_range( port ):
+    """Return a port or port range as a (first, last) tuple.
+    
+    Examples:
+    
+    >>> port_range('80'), port_range('1024:65535'), port_range(':1023')
+    ((80, 80), (1024, 65535), (0, 1023))
+    
+    """
+    
+    if ':' not in port:
+        return ( int(port), int(port) )
+    first, last = port.split(':')
+    return ( int(first or 0), int(last or 65535) )
+
+def covers_field( a, b, kind ):
+    """Check whether every value of field {b} is also matched by field {a}."""
+    
+    if a is None:
+        return True
+    if b is None:
+        return False
+    if a == b:
+        return True
+    
+    if kind == 'iface':
+        return a.endswith('+') and b.startswith(a[:-1])
+    if kind == 'port':
+        try:
+            (a0, a1), (b0, b1) = port_range(a), port_range(b)
+        except ValueError:
+            return False
+        return a0 <= b0 and b1 <= a1
+    if kind == 'state':
+        return set(b) <= set(a)
+    return False
+
+def shape( rule ):
+    """Return everything {rule} matches on, apart from its addresses."""
+    
+    return ( rule.iface_in, rule.iface_out, rule.protocol, rule.sport,
+            rule.dport, rule.state, rule.matches )
+
+def covers_shape( a, b ):
+    """Check whether shape {a} matches every packet shape {b} matches.
+    
+    Examples:
+    
+    >>> A = shape(Rule.parse('-i eth+ -p tcp --dport 1:1023 -j ACCEPT'))
+    >>> B = shape(Rule.parse('-i eth1 -p tcp --dport 25 -m state --state NEW -j LOG'))
+    >>> covers_shape( A, B ), covers_shape( B, A )
+    (True, False)
+    
+    """
+    
+    return covers_field( a[0], b[0], 'iface' ) and \
+            covers_field( a[1], b[1], 'iface' ) and \
+            covers_field( a[2], b[2], 'protocol' ) and \
+            covers_field( a[3], b[3], 'port' ) and \
+            covers_field( a[4], b[4], 'port' ) and \
+            covers_field( a[5], b[5], 'state' ) and \
+            set(a[6]) <= set(b[6])
+
+def redundant_rules( rules ):
+    """Find the rules in a chain that can never decide a packet's fate.
+    
+    A rule is redundant if an earlier rule, after which the chain is never
+    continued, matches every packet it matches. Duplicates of rules that do
+    continue the chain, such as LOG rules, are kept: each of them still does
+    something. So are rules with a stateful match (see Rule.stateful()):
+    once the budget of an earlier one is used up, a later one can match
+    again, so they neither cover nor are covered by anything. Returns a list
+    of (index, reason) tuples, where rule numbers in the reasons count from
+    1, like iptables does.
+    
+    Examples:
+    
+    >>> P = lambda L: [ Rule.parse(t) for t in L ]
+    >>> redundant_rules(P([ '-p tcp --dport 25 -j LOG', '-p tcp --dport 25 -j REJECT',
+    ...     '-p tcp --dport 465 -g smtp_filter', '-p tcp --dport 25 -j LOG',
+    ...     '-p tcp --dport 25 -j REJECT', '-p tcp --dport 465 -g smtp_filter' ]))
+    [(3, 'shadowed by rule 2'), (4, 'duplicate of rule 2'), (5, 'duplicate of rule 3')]
+    
+    >>> redundant_rules(P([ '-s 10.0.0.0/8 -j ACCEPT', '-s 10.1.0.0/16 -i eth1 -j DROP',
+    ...     '-d 10.0.0.1 -j ACCEPT', '-j LOG', '-j LOG' ]))
+    [(1, 'shadowed by rule 1')]
+    
+    >>> redundant_rules(P([ '-p tcp -m limit --limit 1/s -j ACCEPT',
+    ...     '-p tcp -m limit --limit 1/s -j ACCEPT', '-p tcp -j DROP',
+    ...     '-p tcp -m recent --rcheck -j DROP' ]))
+    []
+    
+    """
+    
+    rv = []
+    # Rule numbers, as iptables would count them, by rule key.
+    seen = dict()
+    # For every shape of terminal rule so far: source -> destination -> number.
+    earlier = defaultdict( lambda: defaultdict(dict) )
+    n = 0
+    
+    for i, r in enumerate( rules ):
+        if not isinstance( r, Rule ):
+            continue
+        n += 1
+        if r.stateful():
+            continue
+        
+        k = r.key()
+        if k in seen and is_terminal(r):
+            rv.append( (i, 'duplicate of rule {0}'.format(seen[k])) )
+            continue
+        seen.setdefault( k, n )
+        
+        shadow = None
+        s = shape( r )
+        for sh, sources in earlier.items():
+            if not covers_shape( sh, s ):
+                continue
+            for src in supernets( r.source ):
+                for dst in supernets( r.destination ) if src in sources else []:
+                    if dst in sources[src]:
+                        shadow = min( shadow or n, sources[src][dst] )
+        
+        if shadow:
+            rv.append( (i, 'shadowed by rule {0}'.format(shadow)) )
+        elif is_terminal( r ):
+            earlier[s][r.source].setdefault( r.destination, n )
+    
+    return rv
+
+def remove_redundant( ruleset ):
+    """Remove every duplicate or unreachable rule from {ruleset}.
+    
+    Returns a list of (table, chain, rule, reason) tuples describing what was
+    removed. Rule numbers in the reasons refer to the chain as it was.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> R = Ruleset()
+    >>> R.append_chain( 'INPUT', '# Comments stay' )
+    >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i lo -p tcp -j ACCEPT' )
+    >>> for t in remove_redundant( R ): print t
+    ('filter', 'INPUT', Rule('-i lo -p tcp -j ACCEPT'), 'shadowed by rule 1')
+    >>> R.all_chains['filter']['INPUT']['rules']
+    [Comment('# Comments stay'), Rule('-i lo -j ACCEPT')]
+    
+    """
+    
+    rv = []
+    for tb in sorted( ruleset.all_chains.keys() ):
+        for ch in sorted( ruleset.all_chains[tb].keys() ):
+            rules = ruleset.all_chains[tb][ch]['rules']
+            drop = redundant_rules( rules )
+            if not drop:
+                continue
+            for i, reason in drop:
+                rv.append( (tb, ch, rules[i], reason) )
+            gone = set([ t[0] for t in drop ])
+            ruleset.all_chains[tb][ch]['rules'] = \
+                    [ r for i, r in enumerate(rules) if i not in gone ]
+    
+    ruleset.reindex()
+    
+    for tb, ch, r, reason in rv:
+        debug( -1, '  Removed from {0}/{1}: {2}  ({3})'.format(tb, ch, r, reason) )
+    return rv
+
+
+
+def overlaps( a, b, kind ):
+    """Check whether some packet could match both field {a} and field {b}.
+    
+    Examples:
+    
+    >>> overlaps('10.0.0.0/8', '10.1.2.3/32', 'network'), overlaps('10.0.0.0/8', '11.0.0.0/8', 'network')
+    (True, False)
+    >>> overlaps('eth+', 'eth1', 'iface'), overlaps('1024:65535', '80', 'port')
+    (True, False)
+    
+    """
+    
+    if a is None or b is None or a == b:
+        return True
+    if kind == 'network':
+        return a in supernets(b) or b in supernets(a)
+    if kind == 'iface':
+        return covers_field( a, b, kind ) or covers_field( b, a, kind )
+    if kind == 'port':
+        try:
+            (a0, a1), (b0, b1) = port_range(a), port_range(b)
+        except ValueError:
+            return True
+        return a0 <= b1 and b0 <= a1
+    if kind == 'state':
+        return bool( set(a) & set(b) )
+    return False
+
+def disjoint( a, b ):
+    """Check whether no packet can match both rule {a} and rule {b}.
+    
+    Only the fields no target in the filter table can change are looked at;
+    other match modules are assumed to overlap.
+    
+    Examples:
+    
+    >>> disjoint( Rule.parse('-p tcp --dport 22 -j ACCEPT'), Rule.parse('-p tcp --dport 80 -j LOG') )
+    True
+    >>> disjoint( Rule.parse('-i eth1 -j ACCEPT'), Rule.parse('-s 10.0.0.1 -j DROP') )
+    False
+    
+    """
+    
+    return not ( overlaps( a.source, b.source, 'network' ) and
+            overlaps( a.destination, b.destination, 'network' ) and
+            overlaps( a.iface_in, b.iface_in, 'iface' ) and
+            overlaps( a.iface_out, b.iface_out, 'iface' ) and
+            overlaps( a.protocol, b.protocol, 'protocol' ) and
+            overlaps( a.sport, b.sport, 'port' ) and
+            overlaps( a.dport, b.dport, 'port' ) and
+            overlaps( a.state, b.state, 'state' ) )
+
+def commutes( a, b ):
+    """Check whether swapping the adjacent rules {a} and {b} can never
+    change what happens to a packet.
+    
+    That is the case if no packet matches both, or if both end the chain
+    with the same verdict.
+    
+    Examples:
+    
+    >>> commutes( Rule.parse('-i eth1 -j ACCEPT'), Rule.parse('-s 10.0.0.1 -j ACCEPT') )
+    True
+    >>> commutes( Rule.parse('-i eth1 -j ACCEPT'), Rule.parse('-s 10.0.0.1 -j DROP') )
+    False
+    
+    """
+    
+    if disjoint( a, b ):
+        return True
+    return is_terminal(a) and is_terminal(b) and \
+            (a.target, a.target_args, a.goto) == (b.target, b.target_args, b.goto)
+
+def reorder_rules( rules ):
+    """Move frequently matched rules ahead of rarely matched ones.
+    
+    A rule only ever moves past an adjacent rule it commutes with, so the
+    chain still does exactly the same thing. Comments move along with the
+    rule after them. Returns the new list of rules, or None if nothing moved.
+    
+    Examples:
+    
+    >>> P = lambda L: [ Rule.parse(t) for t in L ]
+    >>> R = P([ '-s 10.0.0.0/8 -j DROP', '-i eth1 -p udp -j ACCEPT', '# SSH',
+    ...     '-i eth1 -p tcp --dport 22 -j ACCEPT', '-i eth2 -j ACCEPT' ])
+    >>> for i, c in [ (0, 1), (1, 10), (3, 50), (4, 80) ]: R[i].counters = (c, 0)
+    >>> for r in reorder_rules( R ): print r
+    -s 10.0.0.0/8 -j DROP
+    -i eth2 -j ACCEPT
+    # SSH
+    -i eth1 -p tcp -m tcp --dport 22 -j ACCEPT
+    -i eth1 -p udp -j ACCEPT
+    
+    """
+    
+    # Every rule, together with the comments before it.
+    groups = []
+    pending = []
+    for r in rules:
+        pending.append( r )
+        if isinstance( r, Rule ):
+            groups.append( pending )
+            pending = []
+    
+    hits = lambda g: g[-1].counters[0] if g[-1].counters else 0
+    moved = False
+    
+    for i in range( 1, len(groups) ):
+        j = i
+        while j > 0 and hits(groups[j-1]) < hits(groups[j]) and \
+                commutes( groups[j-1][-1], groups[j][-1] ):
+            groups[j-1], groups[j] = groups[j], groups[j-1]
+            j -= 1
+            moved = True
+    
+    if not moved:
+        return None
+    return [ r for g in groups for r in g ] + pending
+
+def reorder( ruleset ):
+    """Reorder every chain in {ruleset} by the counters of its rules.
+    
+    The counters each chain was tuned from are written above its rules as
+    comments. Returns a list of (table, chain) tuples that were changed.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> R = Ruleset()
+    >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i eth0 -p tcp --dport 22 -j ACCEPT' )
+    >>> R.all_chains['filter']['INPUT']['rules'][1].counters = (500, 30000)
+    >>> reorder( R )
+    [('filter', 'INPUT')]
+    >>> for r in R.all_chains['filter']['INPUT']['rules']: print r
+    # Reordered by packet count, from these counters [packets:bytes]:
+    # [500:30000]
+    -i eth0 -p tcp -m tcp --dport 22 -j ACCEPT
+    # [0:0]
+    -i lo -j ACCEPT
+    
+    """
+    
+    rv = []
+    for tb in sorted( ruleset.all_chains.keys() ):
+        for ch in sorted( ruleset.all_chains[tb].keys() ):
+            chain = ruleset.all_chains[tb][ch]
+            rules = reorder_rules( chain['rules'] )
+            if rules is None:
+                continue
+            
+            chain['rules'] = [ Comment('# Reordered by packet count, '
+                    'from these counters [packets:bytes]:') ]
+            for r in rules:
+                if isinstance( r, Rule ):
+                    chain['rules'].append( Comment( '# [{0}:{1}]'.format(
+                            *(r.counters or (0, 0)) ) ) )
+                chain['rules'].append( r )
+            
+            rv.append( (tb, ch) )
+            debug( -1, '  Reordered {0}/{1}'.format(tb, ch) )
+    
+    return rv
+
+
+def with_comments( rules, wanted ):
+    """Return the rules in {rules} for which {wanted} is true, each with the
+    comments heading its part of the chain, if it is the first one kept.
+    
+    Examples:
+    
+    >>> R = [ Comment('# Internal'), Rule.parse('-i eth1 -j ACCEPT'),
+    ...     Comment('# External'), Rule.parse('-i eth0 -j ACCEPT') ]
+    >>> with_comments( R, lambda r: r.iface_in == 'eth0' )
+    [Comment('# External'), Rule('-i eth0 -j ACCEPT')]
+    
+    """
+    
+    rv = []
+    comments = []
+    section = False
+    for r in rules:
+        if not isinstance( r, Rule ):
+            if section:
+                comments, section = [], False
+            comments.append( r )
+            continue
+        section = True
+        if wanted( r ):
+            rv += comments + [ r ]
+            comments = []
+    return rv
+
+def split_chain( ruleset, chain, field, prefix, table='filter' ):
+    """Move the rules of {chain} for each interface in {field} of its rules
+    into a chain of their own, called {prefix} followed by the interface,
+    and reached from {chain} by a single goto rule.
+    
+    Every such chain also gets the rules matching any interface, in their
+    place, so a packet only passes the rules for its own interface. Rules at
+    the head of {chain}, before the first rule matching an interface, stay
+    there, and so do interfaces with a single rule, which a chain of their
+    own would not save anything. Returns the names of the new chains.
+    
+    Examples:
+    
+    >>> from ruleset import Ruleset
+    >>> R = Ruleset()
+    >>> R.append_chain( 'INPUT', '-m state --state RELATED,ESTABLISHED -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i eth1 -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i eth0 -p tcp --dport 22 -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-p icmp -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i eth0 -p tcp --dport 80 -j ACCEPT' )
+    >>> R.append_chain( 'INPUT', '-i eth1 -j LOG' )
+    >>> split_chain( R, 'INPUT', 'iface_in', 'input_' )
+    ['input_eth1', 'input_eth0']
+    >>> for r in R.all_chains['filter']['INPUT']['rules']: print r
+    -m state --state RELATED,ESTABLISHED -j ACCEPT
+    -i eth1 -g input_eth1
+    -i eth0 -g input_eth0
+    -p icmp -j ACCEPT
+    -i lo -j ACCEPT
+    >>> for r in R.all_chains['filter']['input_eth0']['rules']: print r
+    -p tcp -m tcp --dport 22 -j ACCEPT
+    -p icmp -j ACCEPT
+    -p tcp -m tcp --dport 80 -j ACCEPT
+    
+    """
+    
+    rules = ruleset.all_chains[table][chain]['rules']
+    n = 0
+    while n < len(rules) and not ( isinstance( rules[n], Rule ) and
+            getattr( rules[n], field ) is not None ):
+        n += 1
+    head, rest = rules[:n], rules[n:]
+    
+    # Wildcards such as eth+ may match any interface, so they go everywhere.
+    exact = lambda r: getattr( r, field ) is not None and '+' not in getattr( r, field )
+    order = [ getattr( r, field ) for r in rest if isinstance( r, Rule ) and exact(r) ]
+    ifaces = []
+    for iface in order:
+        if iface not in ifaces and order.count( iface ) > 1 and \
+                len( prefix + iface ) <= max_chain_name:
+            ifaces.append( iface )
+    if not ifaces:
+        return []
+    
+    for iface in ifaces:
+        ruleset.new_chain( prefix + iface, table=table, policy='-',
+                description='The rules of `{0}` for {1}.'.format( chain, iface ) )
+        ruleset.all_chains[table][prefix + iface]['rules'] = with_comments( rest,
+                lambda r: not exact(r) or getattr( r, field ) == iface )
+        # The field itself no longer needs checking.
+        for i, r in enumerate( ruleset.all_chains[table][prefix + iface]['rules'] ):
+            if isinstance( r, Rule ) and getattr( r, field ) == iface:
+                ruleset.all_chains[table][prefix + iface]['rules'][i] = \
+                        r.copy( **{ field: None } )
+    
+    ruleset.all_chains[table][chain]['rules'] = head + [
+            Rule( target=prefix + iface, goto=True, **{ field: iface } )
+            for iface in ifaces ] + with_comments( rest,
+            lambda r: getattr( r, field ) not in ifaces )
+    return [ prefix + iface for iface in ifaces ]
+
+def split_by_interface( ruleset ):
+    """Split INPUT and OUTPUT into a chain per interface, input_X and
+    output_X, and FORWARD into a chain per incoming interface, fwd_X, each
+    of which is split into a chain per outgoing interface, fwd_X_Y.
+    Returns the names of the new chains."""
+    
+    rv = split_chain( ruleset, 'INPUT', 'iface_in', 'input_' )
+    rv += split_chain( ruleset, 'OUTPUT', 'iface_out', 'output_' )
+    for ch in split_chain( ruleset, 'FORWARD', 'iface_in', 'fwd_' ):
+        rv += [ ch ] + split_chain( ruleset, ch, 'iface_out', ch + '_' )
+    ruleset.reindex()
+    return rv
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
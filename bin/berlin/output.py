@@ -17,7 +17,7 @@
 
 """
 
-import sys
+import sys, time, json
 
 # Debug level
 #  2 = Nothing, not even errors
@@ -41,3 +41,159 @@ if '--silence' in sys.argv:
     if len(sys.argv) > x:
         debuglevel = int(sys.argv[x])
 
+
+
+# Instrumentation. Nothing is recorded unless {profiling} is set, which
+# --profile does; until then, span() and count() return right away.
+profiling = False
+
+# Number of calls and total time of every span, by path of span names.
+timings = dict()
+
+# Named counters.
+counters = dict()
+
+# The names of the spans currently open.
+stack = []
+
+
+class Span:
+    """Records the time spent inside a  with  block. See span()."""
+    
+    def __init__( self, name ):
+        self.name = name
+    
+    def __enter__( self ):
+        stack.append( self.name )
+        self.start = time.time()
+        return self
+    
+    def __exit__( self, *exc ):
+        elapsed = time.time() - self.start
+        path = tuple( stack )
+        stack.pop()
+        t = timings.get( path )
+        if t is None:
+            timings[ path ] = [ 1, elapsed ]
+        else:
+            t[0] += 1
+            t[1] += elapsed
+        return False
+
+class NullSpan:
+    """A span that records nothing, for when profiling is off."""
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *exc ):
+        return False
+
+null_span = NullSpan()
+
+
+def profile( enabled=True ):
+    """Turn instrumentation on or off, forgetting everything recorded."""
+    
+    global profiling
+    profiling = enabled
+    timings.clear()
+    counters.clear()
+    del stack[:]
+
+def span( name ):
+    """Return a context manager that times everything inside it as {name}.
+    
+    Spans opened inside another span are recorded beneath it, so the same
+    name can show up in several places. Time and number of calls add up
+    over every time a span is entered.
+    
+    Examples:
+    
+    >>> profile()
+    >>> with span( 'outer' ):
+    ...     with span( 'inner' ):
+    ...         count( 'widgets', 3 )
+    >>> with span( 'outer' ):
+    ...     count( 'widgets' )
+    >>> timings[('outer',)][0], timings[('outer','inner')][0], counters['widgets']
+    (2, 1, 4)
+    
+    >>> profile( False )
+    >>> span( 'outer' ) is null_span, timings
+    (True, {})
+    
+    """
+    
+    if not profiling:
+        return null_span
+    return Span( name )
+
+def count( name, n=1 ):
+    """Add {n} to the counter called {name}."""
+    
+    if profiling:
+        counters[ name ] = counters.get( name, 0 ) + n
+
+def summary():
+    """Return the timings and counters as a table, one line at a time.
+    
+    Examples:
+    
+    >>> profile()
+    >>> with span( 'outer' ):
+    ...     with span( 'inner' ):
+    ...         count( 'widgets', 3 )
+    >>> for line in summary(): print line
+       seconds    calls  span
+         0.0...       1  outer
+         0.0...       1    inner
+    <BLANKLINE>
+         count  counter
+             3  widgets
+    >>> profile( False )
+    
+    """
+    
+    rv = [ '{0:>10s} {1:>8s}  {2}'.format( 'seconds', 'calls', 'span' ) ]
+    for path in sorted( timings ):
+        rv.append( '{0:10.3f} {1:8d}  {2}{3}'.format( timings[path][1],
+                timings[path][0], '  ' * ( len(path) - 1 ), path[-1] ) )
+    
+    if counters:
+        rv.append( '' )
+        rv.append( '{0:>10s}  {1}'.format( 'count', 'counter' ) )
+        for name in sorted( counters ):
+            rv.append( '{0:10d}  {1}'.format( counters[name], name ) )
+    return rv
+
+def report( filename=None ):
+    """Print the summary, and append everything recorded to {filename} as a
+    single line of JSON, if profiling is on."""
+    
+    if not profiling:
+        return
+    
+    for line in summary():
+        debug( 1, line )
+    
+    if filename is not None:
+        f = open( filename, 'a' )
+        f.write( json.dumps( dict({
+            'time': time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+            'options': sys.argv[1:],
+            'timings': dict([ ( '/'.join(p), dict( calls=timings[p][0],
+                    seconds=timings[p][1] ) ) for p in timings ]),
+            'counters': counters,
+        }), sort_keys=True ) + '\n' )
+        f.close()
+
+if '--profile' in sys.argv:
+    profiling = True
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    sys.exit( fail )
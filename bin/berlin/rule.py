@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import shlex
+
+# Options that end the option list of a match module.
+main_options = set([ '-s','--source', '-d','--destination',
+        '-i','--in-interface', '-o','--out-interface', '-p','--protocol',
+        '-m','--match', '-j','--jump', '-g','--goto', '!' ])
+
+# The order in which iptables-save lists connection states.
+state_order = ['INVALID','NEW','RELATED','ESTABLISHED','UNTRACKED']
+
+# Target options that iptables-save writes out in full, or in another form,
+# by target. The value of --set-mark is rewritten by xmark() as well.
+target_aliases = dict({
+    'DNAT': dict({ '--to': '--to-destination' }),
+    'SNAT': dict({ '--to': '--to-source' }),
+    'MARK': dict({ '--set-mark': '--set-xmark' }),
+    'CONNMARK': dict({ '--set-mark': '--set-xmark' }),
+})
+
+# Match modules that keep state of their own, such as a budget of packets
+# or a list of addresses seen. Whether they match depends on which packets
+# got to them before, so neither their order in a rule nor the order of
+# rules containing them may be changed.
+stateful_modules = frozenset([ 'limit', 'hashlimit', 'recent', 'statistic',
+        'connlimit', 'quota' ])
+
+
+def quote( token ):
+    """Quote {token} for iptables-restore, if necessary.
+    
+    Examples:
+    
+    >>> quote('ACCEPT'), quote('  [SMTP] ')
+    ('ACCEPT', '"  [SMTP] "')
+    
+    """
+    
+    if token and not [ t for t in ' \t"\'#' if t in token ]:
+        return token
+    return '"{0}"'.format( token.replace('"','\\"') )
+
+def network( address ):
+    """Normalise an address or network to the form iptables-save uses.
+    
+    Examples:
+    
+    >>> network('10.0.0.1'), network('192.168.1.0/24')
+    ('10.0.0.1/32', '192.168.1.0/24')
+    
+    """
+    
+    if address is None:
+        return None
+    return intern( address if '/' in address else address + '/32' )
+
+def states( state ):
+    """Normalise a comma separated list of connection states.
+    
+    Examples:
+    
+    >>> states('NEW,ESTABLISHED,RELATED')
+    ('NEW', 'RELATED', 'ESTABLISHED')
+    
+    """
+    
+    if not state:
+        return None
+    if isinstance( state, basestring ):
+        state = state.split(',')
+    return tuple( sorted([ intern(t.strip().upper()) for t in state ],
+            key=lambda t: state_order.index(t) if t in state_order else 99) )
+
+def tokens( option ):
+    """Split {option} into a tuple of interned tokens.
+    
+    Examples:
+    
+    >>> tokens('--log-prefix "  [SMTP] "')
+    ('--log-prefix', '  [SMTP] ')
+    >>> tokens(('--to', '10.0.0.1'))
+    ('--to', '10.0.0.1')
+    
+    """
+    
+    if isinstance( option, basestring ):
+        option = shlex.split( option )
+    return tuple([ intern(str(t)) for t in option ])
+
+def parse_mark( value ):
+    """Return the value and mask of the mark {value}, in the form value or
+    value/mask, as numbers. Without a mask, every bit is set.
+    
+    Examples:
+    
+    >>> parse_mark( '0x1000/0x3000' ), parse_mark( '17' )
+    ((4096, 12288), (17, 4294967295))
+    
+    """
+    
+    value, _, mask = value.partition( '/' )
+    return int( value, 0 ), int( mask, 0 ) if mask else 0xffffffff
+
+def xmark( value, set_mark=False ):
+    """Return the mark {value} of --set-xmark the way iptables-save writes
+    it. With {set_mark}, {value} is that of --set-mark instead, which sets
+    the bits of the value on top of those of the mask.
+    
+    Examples:
+    
+    >>> xmark( '0x1101', True ), xmark( '1/0xff', True ), xmark( '16/0xff' )
+    ('0x1101/0xffffffff', '0x1/0xff', '0x10/0xff')
+    
+    """
+    
+    try:
+        value, mask = parse_mark( value )
+    except ValueError:
+        return value
+    if set_mark:
+        mask |= value
+    return '0x{0:x}/0x{1:x}'.format( value, mask )
+
+def target_options( target, args ):
+    """Return the options {args} of {target} as a tuple of tokens, with any
+    option written out the way iptables-save does.
+    
+    Examples:
+    
+    >>> target_options( 'DNAT', ['--to', '10.0.0.1'] )
+    ('--to-destination', '10.0.0.1')
+    >>> target_options( 'LOG', '--log-prefix "  [SMTP] "' )
+    ('--log-prefix', '  [SMTP] ')
+    >>> target_options( 'CONNMARK', '--set-mark 0x1101' )
+    ('--set-xmark', '0x1101/0xffffffff')
+    
+    """
+    
+    aliases = target_aliases.get( target, dict() )
+    args = tokens( args )
+    rv = []
+    for n, t in enumerate( args ):
+        if n and args[n-1] in ('--set-mark', '--set-xmark') and \
+                target in ('MARK', 'CONNMARK'):
+            t = xmark( t, args[n-1] == '--set-mark' )
+        rv.append( intern( aliases.get(t, t) ) )
+    return tuple( rv )
+
+
+class Comment(object):
+    """A comment or an empty line between rules.
+    
+    Comments only end up in the rules file; the kernel never sees them."""
+    
+    __slots__ = ('text',)
+    
+    def __init__( self, text='' ):
+        self.text = text
+    
+    def __str__( self ):
+        return self.text
+    
+    def __repr__( self ):
+        return 'Comment({0!r})'.format( self.text )
+    
+    def __eq__( self, other ):
+        if isinstance( other, basestring ):
+            return self.text == other
+        return isinstance( other, Comment ) and self.text == other.text
+    
+    def __ne__( self, other ):
+        return not self == other
+
+
+class Rule(object):
+    """A single iptables rule.
+    
+    The common options are kept in separate fields, so rules can be indexed
+    and compared without parsing them again. Any other match modules are
+    kept in {matches}, each as a tuple of tokens. If the rule was read from
+    iptables-save -c, {counters} holds its (packets, bytes) tuple."""
+    
+    __slots__ = ( 'source', 'destination', 'iface_in', 'iface_out',
+            'protocol', 'sport', 'dport', 'state', 'matches',
+            'target', 'target_args', 'goto', 'counters' )
+    
+    def __init__( self, source=None, destination=None, iface_in=None,
+            iface_out=None, protocol=None, sport=None, dport=None, state=None,
+            matches=(), target=None, target_args=(), goto=False, counters=None ):
+        """Create a new rule.
+        
+        Examples:
+        
+        >>> print Rule( iface_in='eth1', source='192.168.1.0/24', target='ACCEPT' )
+        -s 192.168.1.0/24 -i eth1 -j ACCEPT
+        >>> print Rule( protocol='tcp', dport=80, state='NEW,ESTABLISHED',
+        ...     matches=['-m helper --helper ftp'], target='smtp_filter', goto=True )
+        -p tcp -m tcp --dport 80 -m state --state NEW,ESTABLISHED -m helper --helper ftp -g smtp_filter
+        
+        """
+        
+        intern_ = lambda t: None if t is None else intern(str(t))
+        
+        self.source = network( source )
+        self.destination = network( destination )
+        self.iface_in = intern_( iface_in )
+        self.iface_out = intern_( iface_out )
+        self.protocol = intern_( protocol.lower() if protocol else None )
+        self.sport = intern_( sport )
+        self.dport = intern_( dport )
+        self.state = states( state )
+        self.matches = tuple([ tokens(t) for t in matches ])
+        self.target = intern_( target )
+        self.target_args = target_options( target, target_args )
+        self.goto = goto
+        self.counters = counters
+    
+    @staticmethod
+    def parse( text ):
+        """Parse a rule, as passed to iptables after  -A CHAIN.
+        
+        Returns a Comment instead if {text} is empty, or starts with a #.
+        
+        Examples:
+        
+        >>> R = Rule.parse('-i eth0 -p tcp -m state --state NEW -m tcp --dport 22 -j ACCEPT')
+        >>> R.iface_in, R.protocol, R.dport, R.state, R.target
+        ('eth0', 'tcp', '22', ('NEW',), 'ACCEPT')
+        >>> print R
+        -i eth0 -p tcp -m tcp --dport 22 -m state --state NEW -j ACCEPT
+        
+        >>> print Rule.parse('-j LOG --log-prefix "  [SMTP] "')
+        -j LOG --log-prefix "  [SMTP] "
+        >>> Rule.parse('-m set --match-set ad_filter dst -g to_gateway').matches
+        (('-m', 'set', '--match-set', 'ad_filter', 'dst'),)
+        >>> Rule.parse('# A comment')
+        Comment('# A comment')
+        >>> print Rule.parse('part II')
+        part II
+        >>> Rule.parse('! -s 10.0.0.0/8 -m set ! --match-set x dst -j DROP').matches
+        (('!', '-s', '10.0.0.0/8'), ('-m', 'set', '!', '--match-set', 'x', 'dst'))
+        >>> print Rule.parse('-p tcp -j DNAT --to 192.168.1.1')
+        -p tcp -j DNAT --to-destination 192.168.1.1
+        
+        """
+        
+        if not text or text.lstrip()[0] == '#':
+            return Comment( text )
+        
+        T = shlex.split( text )
+        kw = dict()
+        matches = []
+        i = 0
+        
+        fields = dict({
+            '-s': 'source', '--source': 'source',
+            '-d': 'destination', '--destination': 'destination',
+            '-i': 'iface_in', '--in-interface': 'iface_in',
+            '-o': 'iface_out', '--out-interface': 'iface_out',
+            '-p': 'protocol', '--protocol': 'protocol',
+            '--sport': 'sport', '--source-port': 'sport',
+            '--dport': 'dport', '--destination-port': 'dport',
+        })
+        
+        def option_end( j ):
+            # Find the first token after {j} that starts a new option.
+            while j < len(T):
+                if T[j] in main_options and T[j] != '!':
+                    break
+                if T[j] == '!' and j+1 < len(T) and T[j+1] in main_options:
+                    break
+                j += 1
+            return j
+        
+        while i < len(T):
+            t = T[i]
+            
+            if t in fields and i+1 < len(T):
+                kw[ fields[t] ] = T[i+1]
+                i += 2
+            
+            elif t in ('-m','--match') and i+1 < len(T):
+                module = T[i+1]
+                j = option_end( i+2 )
+                options = T[i+2:j]
+                i = j
+                
+                if module in ('tcp','udp'):
+                    # The protocol module is implied by the port options.
+                    while options and options[0] in fields and len(options) > 1:
+                        kw[ fields[options[0]] ] = options[1]
+                        options = options[2:]
+                    if options:
+                        matches.append( ['-m', module] + options )
+                elif module == 'state' and len(options) == 2 and options[0] == '--state':
+                    kw['state'] = options[1]
+                else:
+                    matches.append( ['-m', module] + options )
+            
+            elif t in ('-j','--jump','-g','--goto') and i+1 < len(T):
+                kw['target'] = T[i+1]
+                kw['target_args'] = T[i+2:]
+                kw['goto'] = t in ('-g','--goto')
+                break
+            
+            else:
+                # Anything not understood, including negations, is kept as it is.
+                j = option_end( i+2 if t == '!' else i+1 )
+                matches.append( T[i:j] )
+                i = j
+        
+        return Rule( matches=matches, **kw )
+    
+    def copy( self, **changes ):
+        """Return a copy of this rule, with some fields replaced.
+        
+        Examples:
+        
+        >>> R = Rule.parse('-p tcp -g to_gateway')
+        >>> print R.copy( destination='10.0.0.1' )
+        -d 10.0.0.1/32 -p tcp -g to_gateway
+        
+        """
+        
+        rv = Rule.__new__( Rule )
+        for f in Rule.__slots__:
+            setattr( rv, f, getattr(self, f) )
+        for f, v in changes.items():
+            if f in ('source','destination'):
+                v = network( v )
+            elif f == 'state':
+                v = states( v )
+            elif f == 'target_args':
+                v = target_options( changes.get('target', self.target), v )
+            setattr( rv, f, v )
+        return rv
+    
+    def stateful( self ):
+        """Return whether any match module of this rule keeps state of its
+        own (see stateful_modules).
+        
+        Examples:
+        
+        >>> Rule.parse('-m limit --limit 6/min -j LOG').stateful()
+        True
+        >>> Rule.parse('-m set --match-set x dst -j DROP').stateful()
+        False
+        
+        """
+        
+        for m in self.matches:
+            if len(m) > 1 and m[0] in ('-m','--match') and m[1] in stateful_modules:
+                return True
+        return False
+    
+    def key( self ):
+        """Return a tuple that is equal for rules that do the same thing,
+        no matter in which order their options were written. Counters are
+        not part of the key. The order of the match modules only counts if
+        any of them is stateful.
+        
+        Examples:
+        
+        >>> A = Rule.parse('-p tcp -m state --state NEW -m tcp --dport 22 -s 10.0.0.1 -j ACCEPT')
+        >>> B = Rule.parse('-s 10.0.0.1/32 -p tcp -m tcp --dport 22 -m state --state NEW -j ACCEPT')
+        >>> A.key() == B.key()
+        True
+        >>> A = Rule.parse('-m limit --limit 1/s -m recent --rcheck -j DROP')
+        >>> B = Rule.parse('-m recent --rcheck -m limit --limit 1/s -j DROP')
+        >>> A.key() == B.key()
+        False
+        
+        A classify rule matches the same rule as iptables-save lists it:
+        
+        >>> A = Rule( source='192.168.1.0/24', iface_in='eth1', target='CONNMARK',
+        ...     target_args=['--set-mark', '0x1101'] )
+        >>> B = Rule.parse('-s 192.168.1.0/24 -i eth1 -j CONNMARK --set-xmark 0x1101/0xffffffff')
+        >>> A.key() == B.key()
+        True
+        
+        """
+        
+        return ( self.source, self.destination, self.iface_in, self.iface_out,
+                self.protocol, self.sport, self.dport, self.state,
+                self.matches if self.stateful() else tuple(sorted(self.matches)),
+                self.target, self.target_args, self.goto )
+    
+    def __eq__( self, other ):
+        if isinstance( other, basestring ):
+            other = Rule.parse( other )
+        return isinstance( other, Rule ) and self.key() == other.key()
+    
+    def __ne__( self, other ):
+        return not self == other
+    
+    def __hash__( self ):
+        return hash( self.key() )
+    
+    def __repr__( self ):
+        return 'Rule({0!r})'.format( str(self) )
+    
+    def __str__( self ):
+        """Render the rule in the order iptables-save would use."""
+        
+        rv = []
+        for option, value in [ ('-s', self.source), ('-d', self.destination),
+                ('-i', self.iface_in), ('-o', self.iface_out),
+                ('-p', self.protocol) ]:
+            if value is not None:
+                rv += [ option, value ]
+        
+        if self.sport is not None or self.dport is not None:
+            if self.protocol in ('tcp','udp'):
+                rv += [ '-m', self.protocol ]
+            if self.sport is not None:
+                rv += [ '--sport', self.sport ]
+            if self.dport is not None:
+                rv += [ '--dport', self.dport ]
+        
+        if self.state:
+            rv += [ '-m', 'state', '--state', ','.join(self.state) ]
+        
+        for m in self.matches:
+            rv += [ quote(t) for t in m ]
+        
+        if self.target is not None:
+            rv += [ '-g' if self.goto else '-j', self.target ]
+            rv += [ quote(t) for t in self.target_args ]
+        
+        return ' '.join( rv )
+
+
+
+if __name__ == '__main__':
+    import doctest
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
+    import sys
+    sys.exit( fail )
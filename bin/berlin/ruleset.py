@@ -17,8 +17,14 @@
 
 """
 
-import os,subprocess
+import os,subprocess,tempfile
 from collections import defaultdict
+from addresses import AddressSet, prefix_to_string, int_to_ip, ip_to_int
+from output import debug, span
+from diff import builtin_chains, render_diff
+from rule import Rule, Comment
+from optimize import remove_redundant, reorder, split_by_interface
+from nftables import render_nft
 
 class Ruleset:
     """A collection of iptables rules.
@@ -27,9 +33,21 @@ class Ruleset:
     stack."""
     
     all_chains = dict({})
+    all_sets = dict({})
+    index = None
     table_description = defaultdict(lambda s: \
             'I have no idea what the table `{0}` does.'.format(s))
     
+    # Use ipset to match address filters, rather than one rule per address.
+    use_ipset = False
+    
+    # Write packet and byte counters, and have iptables-restore load them.
+    keep_counters = False
+    
+    # Without ipset, split address filters into a tree of chains with at most
+    # this many rules each. Zero keeps every filter in a single chain.
+    tree_fanout = 0
+    
     def __init__(self):
         
         # Initialize descriptions for default tables.
@@ -68,6 +86,8 @@ class Ruleset:
         """
         
         self.all_chains = dict({})
+        self.all_sets = dict({})
+        self.index = defaultdict(list)
         for tb in ['nat','filter']:
             self.all_chains[tb] = dict()
         
@@ -134,6 +154,38 @@ class Ruleset:
         else:
             raise Exception("Chain {0} in table {1} already exists.")
     
+    def new_set( self, name, members, settype='hash:ip', description=None ):
+        """Add a new ipset.
+        
+        Add an ipset called {name} of type {settype}, containing {members}.
+        The sets are written out separately by output_sets(), and have to be
+        loaded before any rule referring to them.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.new_set( 'godfather', ['10.0.0.1','10.0.0.2'] )
+        >>> R.all_sets['godfather']['type']
+        'hash:ip'
+        >>> R.new_set( 'godfather', [] )
+        Traceback (most recent call last):
+        ...
+        Exception: Set godfather already exists.
+        
+        """
+        
+        if name in self.all_sets:
+            raise Exception("Set {0} already exists.".format(name))
+        
+        if not description:
+            description = 'The addresses in the set `{0}`.'.format(name)
+        
+        self.all_sets[name] = dict({
+                'type': settype,
+                'members': list(members),
+                'description': description
+        })
+    
     def append_chain( self, chain, rule, table='filter', comments=False ):
         """Append a rule to a chain.
         
@@ -160,15 +212,151 @@ class Ruleset:
         >>> 'part IV' in R.all_chains['filter']['godfather']['rules']
         False
         
+        Rules given as text are parsed into Rule objects, and comments into
+        Comment objects.
+        
+        >>> R.append_chain( 'godfather', '# part I was better' )
+        >>> R.all_chains['filter']['godfather']['rules']
+        [Rule('part II'), Rule('part III'), Comment('# part I was better')]
+        
         """
         
         if not chain in self.all_chains[table]:
             raise Exception("Chain '{0}' does not yet exist. Try creating it explicitly.".format(chain))
         
+        if isinstance( rule, basestring ):
+            rule = Rule.parse( rule )
+        
         self.all_chains[table][chain]['rules'].append(rule)
+        if isinstance( rule, Rule ):
+            self.index_rule( table, chain, rule )
+    
+    def index_rule( self, table, chain, rule ):
+        """Add {rule} in {chain} to the lookup index."""
+        
+        entry = (table, chain, rule)
+        for iface in set([ rule.iface_in, rule.iface_out ]):
+            if iface is not None:
+                self.index[ ('iface', iface) ].append( entry )
+        if rule.target is not None:
+            self.index[ ('target', rule.target) ].append( entry )
+    
+    def reindex( self ):
+        """Rebuild the lookup index, after rules were changed in place."""
+        
+        self.index = defaultdict(list)
+        for tb, table in self.all_chains.items():
+            for ch, chain in table.items():
+                for r in chain['rules']:
+                    if isinstance( r, Rule ):
+                        self.index_rule( tb, ch, r )
+    
+    def rules_on( self, iface ):
+        """Return all rules matching packets coming in or going out on
+        {iface}, as a list of (table, chain, rule) tuples.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-i eth1 -j ACCEPT' )
+        >>> R.append_chain( 'FORWARD', '-i eth0 -o eth1 -j ACCEPT' )
+        >>> R.append_chain( 'INPUT', '-j REJECT' )
+        >>> R.rules_on( 'eth1' )
+        [('filter', 'INPUT', Rule('-i eth1 -j ACCEPT')), ('filter', 'FORWARD', Rule('-i eth0 -o eth1 -j ACCEPT'))]
+        
+        """
+        
+        return list( self.index.get( ('iface', iface), [] ) )
+    
+    def rules_jumping_to( self, target ):
+        """Return all rules with target {target}, which is either a chain or
+        a built-in target, as a list of (table, chain, rule) tuples.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.new_chain( 'smtp_filter' )
+        >>> R.append_chain( 'FORWARD', '-p tcp --dport 465 -g smtp_filter' )
+        >>> R.rules_jumping_to( 'smtp_filter' )
+        [('filter', 'FORWARD', Rule('-p tcp -m tcp --dport 465 -g smtp_filter'))]
+        
+        """
+        
+        return list( self.index.get( ('target', target), [] ) )
+    
+    def optimize( self ):
+        """Remove duplicate and unreachable rules from every chain.
+        
+        Returns a list of (table, chain, rule, reason) tuples.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.append_chain( 'FORWARD', '-o eth0 -p tcp --dport 25 -j REJECT' )
+        >>> R.append_chain( 'FORWARD', '-o eth0 -p tcp --dport 25 -j REJECT' )
+        >>> R.optimize()
+        [('filter', 'FORWARD', Rule('-o eth0 -p tcp -m tcp --dport 25 -j REJECT'), 'duplicate of rule 1')]
+        >>> len( R.rules_jumping_to('REJECT') )
+        1
+        
+        """
+        
+        with span( 'optimize' ):
+            rv = remove_redundant( self )
+        debug( 0 if rv else -1, "Removed {0} redundant rules.".format(len(rv)) )
+        return rv
+    
+    def split_interfaces( self ):
+        """Split INPUT, OUTPUT and FORWARD into a chain per interface, so that
+        a packet only passes the rules for its own interfaces, after a short
+        list of gotos. See split_by_interface().
         
+        Returns the names of the new chains.
         
+        Examples:
         
+        >>> R = Ruleset()
+        >>> for i, o in [ ('eth1','eth0'), ('eth0','eth1'), ('eth1','eth2'), ('eth0','eth1') ]:
+        ...     R.append_chain( 'FORWARD', '-i {0} -o {1} -p tcp --dport 25 -j REJECT'.format(i, o) )
+        ...     R.append_chain( 'FORWARD', '-i {0} -o {1} -j ACCEPT'.format(i, o) )
+        >>> R.split_interfaces()
+        ['fwd_eth1', 'fwd_eth1_eth0', 'fwd_eth1_eth2', 'fwd_eth0', 'fwd_eth0_eth1']
+        >>> R.all_chains['filter']['fwd_eth0_eth1']['rules']
+        [Rule('-p tcp -m tcp --dport 25 -j REJECT'), Rule('-j ACCEPT'), Rule('-p tcp -m tcp --dport 25 -j REJECT'), Rule('-j ACCEPT')]
+        >>> R.rules_jumping_to( 'fwd_eth0_eth1' )
+        [('filter', 'fwd_eth0', Rule('-o eth1 -g fwd_eth0_eth1'))]
+        
+        """
+        
+        with span( 'split interfaces' ):
+            rv = split_by_interface( self )
+        debug( -1, "Split off {0} interface chains.".format(len(rv)) )
+        return rv
+    
+    def reorder( self, live ):
+        """Move the rules matching the most packets in {live}, which should
+        come from iptables-save -c, ahead of the others where that is safe.
+        
+        Returns a list of (table, chain) tuples that were changed.
+        
+        Examples:
+        
+        >>> L = Ruleset()
+        >>> L.import_restore([ '*filter', '[1:60] -A INPUT -i lo -j ACCEPT',
+        ...     '[90:5400] -A INPUT -i eth1 -j ACCEPT', 'COMMIT' ])
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+        >>> R.append_chain( 'INPUT', '-i eth1 -j ACCEPT' )
+        >>> R.reorder( L )
+        [('filter', 'INPUT')]
+        >>> [ str(t) for t in R.all_chains['filter']['INPUT']['rules'] ]
+        [..., '-i eth1 -j ACCEPT', '# [1:60]', '-i lo -j ACCEPT']
+        
+        """
+        
+        with span( 'reorder' ):
+            debug( -1, "Matched counters for {0} rules.".format(self.take_counters(live)) )
+            return reorder( self )
     
     @staticmethod
     def IP_addresses_from_files( filenames ):
@@ -187,27 +375,15 @@ class Ruleset:
         
         """
         
-        locations = ['/etc/berlin/','/etc/vuurmuur/','/etc/firewall.d/config/','']
-        files = sum([[L+F for F in filenames] for L in locations],[])
-        f = subprocess.Popen(
-                ['cat', '/dev/null'] + files,
-                stdout = subprocess.PIPE, stderr = open('/dev/null','w')
-        )
-        gr = subprocess.Popen(
-                ['sh','-c','grep -oP "([0-9]{1,3}\.){3}[0-9]{1,3}" | sort | uniq'],
-                stdin = f.stdout, stdout = subprocess.PIPE
-        )
-        f.stdout.close()
-        s = gr.stdout.read()
-        gr.stdout.close()
-        return s.split()
-    
-    def create_filter( self, name, files, table='nat', action='-g to_gateway' ):
+        return AddressSet.from_files( filenames ).strings()
+    
+    def create_filter( self, name, files, table='nat', action='-g to_gateway',
+            exclude=[] ):
         """Create an outbound filter.
         
         Create a separate filter chain called {name}. As soon as a tcp packet is
-        detected to an IP address in any one of the files in {files}, the {action}
-        is performed.
+        detected to an IP address in any one of the files in {files}, but not in
+        any of the files in {exclude}, the {action} is performed.
         
         >>> R = Ruleset()
         
@@ -223,22 +399,475 @@ class Ruleset:
         >>> len(R.all_chains['filter']['another_doctest']['rules'])
         0
         
+        >>> f = open('/tmp/doctest_create_filter_exclude','w')
+        >>> f.write('ServerAlias 10.0.0.138\\n')
+        >>> f.close()
+        
+        >>> R.create_filter( 'excluded', ['/tmp/doctest_create_filter'],
+        ...     exclude=['/tmp/doctest_create_filter_exclude'] )
+        >>> R.all_chains['nat']['excluded']['rules']
+        [Rule('-d 127.0.0.1/32 -p tcp -g to_gateway')]
+        
+        Adjacent addresses are merged into a single prefix.
+        
+        >>> f = open('/tmp/doctest_create_filter_range','w')
+        >>> f.write('10.0.0.4\\n10.0.0.5\\n10.0.0.6\\n10.0.0.7\\n')
+        >>> f.close()
+        
+        >>> R.create_filter( 'range', ['/tmp/doctest_create_filter_range'] )
+        >>> R.all_chains['nat']['range']['rules']
+        [Rule('-d 10.0.0.4/30 -p tcp -g to_gateway')]
+        
+        If  use_ipset  is set, the addresses go into an ipset of the same name,
+        and the chain only gets a single rule matching against that set.
+        
+        >>> R.use_ipset = True
+        >>> R.create_filter( 'set_doctest', ['/tmp/doctest_create_filter'] )
+        >>> R.all_chains['nat']['set_doctest']['rules']
+        [Rule('-p tcp -m set --match-set set_doctest dst -g to_gateway')]
+        >>> sorted(R.all_sets['set_doctest']['members'])
+        ['10.0.0.138', '127.0.0.1']
+        
+        Either way, the chain's 'set' records the prefixes, the single rule
+        matching against them as a set, and the rules of the chain that rule
+        stands for, so other backends can use sets of their own.
+        
+        >>> S = R.all_chains['nat']['excluded']['set']
+        >>> S['rule'], S['members'], S['replaces']
+        (Rule('-p tcp -m set --match-set excluded dst -g to_gateway'), ['127.0.0.1'], [Rule('-d 127.0.0.1/32 -p tcp -g to_gateway')])
+        
+        If  tree_fanout  is set instead, large filters are split into a tree of
+        chains by destination prefix; see filter_tree().
+        
+        >>> R.use_ipset = False
+        >>> R.tree_fanout = 2
+        >>> R.create_filter( 'tree_doctest', ['/tmp/doctest_create_filter'] )
+        >>> R.all_chains['nat']['tree_doctest']['rules']
+        [Rule('-d 10.0.0.138/32 -p tcp -g to_gateway'), Rule('-d 127.0.0.1/32 -p tcp -g to_gateway')]
+        
+        """
+        
+        with span( 'create_filter ' + name ):
+            addresses = AddressSet.from_files( files )
+            if exclude:
+                addresses = addresses - AddressSet.from_files( exclude )
+            
+            # Merge runs of adjacent addresses into larger prefixes.
+            prefixes = addresses.aggregate()
+            if len(addresses) > 0:
+                debug( -1, '{0}: {1} addresses aggregated into {2} prefixes '
+                        '({3}% fewer).'.format( name, len(addresses), len(prefixes),
+                        100 - 100 * len(prefixes) // len(addresses) ) )
+            
+            self.new_chain( name, table=table, policy='RETURN' )
+            
+            # Parse the action only once, and copy it for every address.
+            action = Rule.parse( '-p tcp ' + action )
+            
+            members = [ prefix_to_string(t) if t[1] < 32 else int_to_ip(t[0])
+                    for t in prefixes ]
+            set_rule = action.copy( matches=action.matches +
+                    ( ('-m','set','--match-set',name,'dst'), ) )
+            
+            if self.use_ipset:
+                # Always hash:net, which takes single addresses as well: the
+                # type of a set has to stay the same from one run to the next,
+                # or it can't be swapped with the live one.
+                self.new_set( name, members, 'hash:net' )
+                self.append_chain( name, set_rule, table=table )
+            
+            elif self.tree_fanout and len(prefixes) > self.tree_fanout:
+                self.filter_tree( name, prefixes, action, table )
+            
+            else:
+                for P in prefixes:
+                    self.append_chain(
+                        name,
+                        action.copy( destination=prefix_to_string(P) ),
+                        table=table
+                    )
+            
+            self.all_chains[table][name]['set'] = dict({
+                'members': members,
+                'rule': set_rule,
+                'replaces': list( self.all_chains[table][name]['rules'] )
+            })
+    
+    def filter_tree( self, name, prefixes, action, table='nat' ):
+        """Spread {prefixes} over a tree of chains below the chain {name}.
+        
+        Every chain in the tree gets at most {tree_fanout} rules. Each of them
+        either performs {action} for a single prefix, or jumps to the chain
+        for a larger prefix containing several; the bits these prefixes cover
+        are chosen per chain, as many as the fan-out allows. A packet then
+        only passes O(log n) rules, rather than all of them.
+        
+        The sub-chains are called {name}_t001 and so on, numbered depth
+        first, and their 'tree' is set to {name}. They are entered with -j, so
+        any rules added to {name} later on still apply to packets none of the
+        prefixes match.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.tree_fanout = 4
+        >>> R.new_chain( 'tree', table='nat', policy='RETURN' )
+        >>> R.filter_tree( 'tree', [ (ip_to_int('10.0.{0}.0'.format(t)), 24)
+        ...     for t in range(0, 16, 2) ] + [(ip_to_int('192.168.0.1'), 32)],
+        ...     Rule.parse('-p tcp -g to_gateway') )
+        >>> for ch in sorted( R.all_chains['nat'] ):
+        ...     for r in R.all_chains['nat'][ch]['rules']: print ch, r
+        tree -d 10.0.0.0/21 -p tcp -j tree_t001
+        tree -d 10.0.8.0/21 -p tcp -j tree_t002
+        tree -d 192.168.0.1/32 -p tcp -g to_gateway
+        tree_t001 -d 10.0.0.0/24 -p tcp -g to_gateway
+        tree_t001 -d 10.0.2.0/24 -p tcp -g to_gateway
+        tree_t001 -d 10.0.4.0/24 -p tcp -g to_gateway
+        tree_t001 -d 10.0.6.0/24 -p tcp -g to_gateway
+        tree_t002 -d 10.0.8.0/24 -p tcp -g to_gateway
+        tree_t002 -d 10.0.10.0/24 -p tcp -g to_gateway
+        tree_t002 -d 10.0.12.0/24 -p tcp -g to_gateway
+        tree_t002 -d 10.0.14.0/24 -p tcp -g to_gateway
+        
+        """
+        
+        fanout = max( 2, self.tree_fanout )
+        width = max( 3, len(str(len(prefixes))) )
+        chains = [0]
+        
+        def entries( prefixes, length ):
+            # Group the prefixes by their first {length} bits; any prefix that
+            # is shorter, or alone in its group, gets a rule of its own.
+            groups = []
+            for P in prefixes:
+                if P[1] < length:
+                    groups.append( (P, [P]) )
+                    continue
+                mask = (0xffffffff << (32-length)) & 0xffffffff
+                net = ( P[0] & mask, length )
+                if groups and groups[-1][0] == net:
+                    groups[-1][1].append( P )
+                else:
+                    groups.append( (net, [P]) )
+            return groups
+        
+        def build( chain, prefixes, length ):
+            # Look at as many bits at once as the fan-out allows.
+            groups = entries( prefixes, length+1 )
+            for l in range( length+2, 33 ):
+                more = entries( prefixes, l )
+                if len(more) > fanout: break
+                groups = more
+            
+            for net, members in groups:
+                if len(members) == 1:
+                    self.append_chain( chain,
+                            action.copy( destination=prefix_to_string(members[0]) ),
+                            table=table )
+                    continue
+                
+                chains[0] += 1
+                sub = '{0}_t{1:0{2}d}'.format( name, chains[0], width )
+                self.new_chain( sub, table=table, policy='RETURN',
+                        description='Part of the filter `{0}`, for destinations '
+                        'in {1}.'.format( name, prefix_to_string(net) ) )
+                self.all_chains[table][sub]['tree'] = name
+                self.append_chain( chain,
+                        action.copy( destination=prefix_to_string(net),
+                            target=sub, target_args=(), goto=False ),
+                        table=table )
+                
+                if len(members) > fanout:
+                    build( sub, members, net[1] )
+                else:
+                    for P in members:
+                        self.append_chain( sub,
+                                action.copy( destination=prefix_to_string(P) ),
+                                table=table )
+        
+        build( name, prefixes, 0 )
+    
+    
+    
+    
+    
+    
+    def import_restore( self, lines ):
+        """Replace all chains with the ones in {lines}, in iptables-save format.
+        
+        Tables other than nat and filter are ignored. Counters, as written by
+        iptables-save -c, are kept in each rule's {counters}, and in the
+        'counters' of each built-in chain.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.import_restore([
+        ...     '# Generated by iptables-save',
+        ...     '*mangle', ':PREROUTING ACCEPT [0:0]', '-A PREROUTING -j MARK --set-mark 1', 'COMMIT',
+        ...     '*filter', ':INPUT ACCEPT [10:200]', ':ad_filter - [0:0]',
+        ...     '[3:120] -A INPUT -i lo -j ACCEPT', '-A ad_filter -j RETURN', 'COMMIT' ])
+        >>> R.all_chains['filter']['INPUT']['policy'], R.all_chains['filter']['INPUT']['rules']
+        ('ACCEPT', [Rule('-i lo -j ACCEPT')])
+        >>> R.all_chains['filter']['INPUT']['counters']
+        (10, 200)
+        >>> R.all_chains['filter']['ad_filter']['rules']
+        [Rule('-j RETURN')]
+        >>> R.all_chains['filter']['INPUT']['rules'][0].counters
+        (3, 120)
+        >>> len(R.all_chains['nat']['PREROUTING']['rules'])
+        0
+        
         """
         
-        addresses = Ruleset.IP_addresses_from_files( files )
-        self.new_chain( name, table=table, policy='RETURN' )
+        self.reset()
+        table = None
         
-        for IP in addresses:
-            self.append_chain(
-                name,
-                '-d {0}/32 -p tcp {1}'.format(IP,action),
-                table=table
-            )
+        for line in lines:
+            line = line.strip()
+            counters = None
+            if line.startswith('['):
+                counters, line = line.split(None,1)
+                counters = tuple([ int(t) for t in counters[1:-1].split(':') ])
+            
+            if not line or line[0] == '#' or line == 'COMMIT':
+                continue
+            elif line[0] == '*':
+                table = line[1:] if line[1:] in self.all_chains else None
+            elif table is None:
+                continue
+            elif line[0] == ':':
+                T = line[1:].split()
+                ch, policy = T[0:2]
+                if ch in self.all_chains[table]:
+                    self.all_chains[table][ch]['policy'] = policy
+                    if len(T) > 2:
+                        self.all_chains[table][ch]['counters'] = \
+                                tuple([ int(t) for t in T[2][1:-1].split(':') ])
+                else:
+                    self.new_chain( ch, table=table, policy=policy )
+            elif line.startswith('-N '):
+                self.new_chain( line[3:].strip(), table=table, policy='-' )
+            elif line.startswith('-A '):
+                ch, rule = line[3:].split(None,1)
+                self.append_chain( ch, rule, table=table )
+                self.all_chains[table][ch]['rules'][-1].counters = counters
     
+    def import_sets( self, lines ):
+        """Replace all sets with the ones in {lines}, in the format of ipset
+        save, or of ipset restore as written by output_sets().
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.import_sets([ 'create ad_filter-new hash:net family inet -exist',
+        ...     'flush ad_filter-new', 'add ad_filter-new 10.0.0.0/8',
+        ...     'create ad_filter hash:net family inet -exist',
+        ...     'swap ad_filter-new ad_filter', 'destroy ad_filter-new',
+        ...     '# A comment', 'create local_pairs hash:net,net family inet',
+        ...     'add local_pairs 192.168.1.0/24,192.168.1.0/24' ])
+        >>> sorted( R.all_sets )
+        ['ad_filter', 'local_pairs']
+        >>> R.all_sets['ad_filter']['type'], R.all_sets['ad_filter']['members']
+        ('hash:net', ['10.0.0.0/8'])
+        
+        """
+        
+        self.all_sets = dict()
+        for line in lines:
+            T = line.split()
+            if not T or T[0][0] == '#' or len(T) < 2:
+                continue
+            elif T[0] == 'create' and len(T) > 2:
+                if T[1] not in self.all_sets:
+                    self.new_set( T[1], [], T[2] )
+            elif T[0] == 'add' and len(T) > 2 and T[1] in self.all_sets:
+                self.all_sets[ T[1] ]['members'].append( T[2] )
+            elif T[0] == 'flush' and T[1] in self.all_sets:
+                del self.all_sets[ T[1] ]['members'][:]
+            elif T[0] == 'swap' and len(T) > 2:
+                a, b = self.all_sets.pop( T[1], None ), self.all_sets.pop( T[2], None )
+                if a is not None: self.all_sets[ T[2] ] = a
+                if b is not None: self.all_sets[ T[1] ] = b
+            elif T[0] == 'destroy':
+                self.all_sets.pop( T[1], None )
+    
+    def set_references( self ):
+        """Return the names of all sets the rules match against, in order.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-m set ! --match-set b src -m set --match-set a dst -j DROP' )
+        >>> R.set_references()
+        ['a', 'b']
+        
+        """
+        
+        rv = set()
+        for table in self.all_chains.values():
+            for chain in table.values():
+                for r in chain['rules']:
+                    if not isinstance( r, Rule ):
+                        continue
+                    for m in r.matches:
+                        if '--match-set' in m:
+                            rv.add( m[ m.index('--match-set')+1 ] )
+        return sorted( rv )
     
+    def import_saved( self, filename, sets_file=None ):
+        """Replace all chains with the ones in {filename}, saved by
+        iptables-save or by rules.py, and all sets with the ones in
+        {sets_file}, saved by ipset save or by rules.py.
+        
+        Without {sets_file}, the file ipsets next to {filename} is used, if
+        there is one. A rule matching a set says nothing about which packets
+        it matches without the members of that set, so a ruleset with rules
+        matching sets that weren't found can't be used.
+        
+        Examples:
+        
+        >>> f = open( '/tmp/doctest_import_saved', 'w' )
+        >>> f.write( '*filter\\n-A INPUT -m set --match-set ad_filter dst -j DROP\\nCOMMIT\\n' )
+        >>> f.close()
+        >>> R = Ruleset()
+        >>> R.import_saved( '/tmp/doctest_import_saved', '/nonexistent' )
+        Traceback (most recent call last):
+        ...
+        Exception: /tmp/doctest_import_saved matches against sets that are not in /nonexistent: ad_filter
+        >>> f = open( '/tmp/doctest_import_saved_sets', 'w' )
+        >>> f.write( 'create ad_filter hash:net\\nadd ad_filter 10.0.0.0/8\\n' )
+        >>> f.close()
+        >>> R.import_saved( '/tmp/doctest_import_saved', '/tmp/doctest_import_saved_sets' )
+        >>> R.all_sets['ad_filter']['members'], len( R.all_chains['filter']['INPUT']['rules'] )
+        (['10.0.0.0/8'], 1)
+        
+        """
+        
+        f = open( filename )
+        self.import_restore( f.read().splitlines() )
+        f.close()
+        
+        if sets_file is None:
+            sets_file = os.path.join( os.path.dirname(filename), 'ipsets' )
+        try:
+            f = open( sets_file )
+            self.import_sets( f.read().splitlines() )
+            f.close()
+        except IOError:
+            self.all_sets = dict()
+        
+        missing = [ t for t in self.set_references() if t not in self.all_sets ]
+        if missing:
+            raise Exception( "{0} matches against sets that are not in {1}: {2}".format(
+                    filename, sets_file, ', '.join(missing) ) )
     
+    def take_counters( self, live ):
+        """Copy the counters of every rule in {live} to the same rule here,
+        and those of every built-in chain to the same chain.
+        
+        Rules are matched by table, chain and key; if a rule occurs more than
+        once in a chain, the copies are matched in order. Returns the number
+        of rules that were matched.
+        
+        Examples:
+        
+        >>> L = Ruleset()
+        >>> L.import_restore([ '*filter', '[5:300] -A INPUT -i lo -j ACCEPT',
+        ...     '[7:420] -A INPUT -p tcp --dport 22 -j ACCEPT', 'COMMIT' ])
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-p tcp -m tcp --dport 22 -j ACCEPT' )
+        >>> R.append_chain( 'INPUT', '-i eth1 -j ACCEPT' )
+        >>> R.take_counters( L )
+        1
+        >>> [ t.counters for t in R.all_chains['filter']['INPUT']['rules'] ]
+        [(7, 420), None]
+        >>> R.all_chains['filter']['INPUT'].get('counters')
+        >>> L.all_chains['filter']['INPUT']['counters'] = (12, 720)
+        >>> R.take_counters( L ), R.all_chains['filter']['INPUT']['counters']
+        (1, (12, 720))
+        
+        """
+        
+        rv = 0
+        for tb, table in self.all_chains.items():
+            for ch, chain in table.items():
+                if ch not in live.all_chains[tb]:
+                    continue
+                if 'counters' in live.all_chains[tb][ch]:
+                    chain['counters'] = live.all_chains[tb][ch]['counters']
+                counters = defaultdict(list)
+                for r in reversed( live.all_chains[tb][ch]['rules'] ):
+                    if isinstance( r, Rule ) and r.counters is not None:
+                        counters[ r.key() ].append( r.counters )
+                for r in chain['rules']:
+                    if isinstance( r, Rule ) and counters.get( r.key() ):
+                        r.counters = counters[ r.key() ].pop()
+                        rv += 1
+        return rv
     
+    @staticmethod
+    def live_ruleset( command=['/sbin/iptables-save'] ):
+        """Return the ruleset currently loaded in the kernel.
+        
+        Returns None if {command} could not be run.
+        
+        Examples:
+        
+        >>> R = Ruleset.live_ruleset(['echo', '*filter\\n-A INPUT -j ACCEPT'])
+        >>> R.all_chains['filter']['INPUT']['rules']
+        [Rule('-j ACCEPT')]
+        >>> Ruleset.live_ruleset(['false']) is None
+        false failed.
+        True
+        
+        """
+        
+        try:
+            P = subprocess.Popen( command, stdout=subprocess.PIPE )
+        except OSError, e:
+            debug( 1, 'Could not run {0}: {1}'.format(command[0], e) )
+            return None
+        
+        R = Ruleset()
+        R.import_restore( P.stdout )
+        if P.wait() != 0:
+            debug( 1, '{0} failed.'.format(command[0]) )
+            return None
+        return R
     
+    def apply_diff( self, tee=None, save=['/sbin/iptables-save'],
+            restore=['/sbin/iptables-restore','--noflush'] ):
+        """Change the live ruleset into this one, touching only what differs.
+        
+        Reads the current rules using {save}, and pipes the changes needed into
+        {restore}. If the current rules can't be read, all chains are reloaded
+        instead. If {tee} is given, the changes are written there as well.
+        Returns the exit status of {restore}.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-j ACCEPT' )
+        >>> R.apply_diff( tee='/tmp/doctest_apply_diff',
+        ...     save=['echo','*filter\\n-A INPUT -j DROP'], restore=['true'] )
+        0
+        >>> print open('/tmp/doctest_apply_diff').read()
+        *nat
+        COMMIT
+        *filter
+        -D INPUT 1
+        -I INPUT 1 -j ACCEPT
+        COMMIT
+        
+        """
+        
+        live = Ruleset.live_ruleset( save )
+        if live is None:
+            debug( 1, 'Falling back to a full reload.' )
+            return self.apply_chains( tee=tee, command=restore[0:1] )
+        
+        return Ruleset.pipe_lines( render_diff(live, self), restore, tee )
     
     def output_chains(self, filename):
         """Export all chains in iptables-restore format to {filename}.
@@ -279,63 +908,311 @@ class Ruleset:
         
         """
         
-        counters = dict({
-            'filter': ['INPUT','FORWARD','OUTPUT'],
-            'nat': ['PREROUTING','POSTROUTING','OUTPUT']
-        })
+        with span( 'render iptables' ):
+            f = open(filename,'w')
+            for line in self.render_chains():
+                f.write(line)
+            f.close()
+    
+    def render_chains(self):
+        """Generate all chains in iptables-restore format, line by line.
+        
+        If {keep_counters} is set, the counters of every rule and built-in
+        chain that has them are written as well, for iptables-restore -c.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-j ACCEPT' )
+        >>> [ t for t in R.render_chains() if t[0] in '*-' ]
+        ['*nat\\n', '*filter\\n', '-A INPUT -j ACCEPT\\n']
+        
+        >>> R.keep_counters = True
+        >>> R.all_chains['filter']['INPUT']['rules'][0].counters = (3, 180)
+        >>> R.all_chains['filter']['INPUT']['counters'] = (10, 600)
+        >>> [ t for t in R.render_chains() if t[0] in ':[' and 'INPUT' in t ]
+        [':INPUT DROP [10:600]\\n', '[3:180] -A INPUT -j ACCEPT\\n']
+        
+        """
         
-        f = open(filename,'w')
+        counters = builtin_chains
+        counter_prefix = lambda c: '[{0}:{1}] '.format( *c ) \
+                if self.keep_counters and c is not None else ''
         
         for tb in ['nat','filter']:
             table = self.all_chains[tb]
             
+            # Built-in chains first, then the rest by name, so the output only
+            # changes when the rules do.
+            order = counters[tb] + sorted([ t for t in table.keys()
+                    if t not in counters[tb] ])
+            
             # Write down what the table does
-            f.write('\n\n\n\n###     \n###     {0}\n###     \n\n'.format(
-                    self.table_description[tb].replace('\n','\n###     ') ))
+            yield '\n\n\n\n###     \n###     {0}\n###     \n\n'.format(
+                    self.table_description[tb].replace('\n','\n###     ') )
             
-            f.write('*{0}\n'.format(tb))
+            yield '*{0}\n'.format(tb)
             
             # Write the chain declarations for all buitin chains
             for ch in counters[tb]:
-                f.write(':{0} {1} [0:0]\n'.format(ch,table[ch]['policy']))
+                yield ':{0} {1} {2}\n'.format( ch, table[ch]['policy'],
+                        counter_prefix( table[ch].get('counters') ).strip() or '[0:0]' )
             
             # Write the chain declarations for all user-defined chains
-            for ch,chain in table.items():
+            for ch in order:
+                chain = table[ch]
                 if ch in counters[tb]: continue
-                f.write('-N {0}\n'.format(ch))
+                yield '-N {0}\n'.format(ch)
                 if chain['policy'] not in ['-','RETURN']:
-                    f.write('-P {0} {1}\n'.format(ch,chain['policy']))
+                    yield '-P {0} {1}\n'.format(ch,chain['policy'])
             
             # Write all the rules for the user-defined chains
-            for ch,chain in table.items():
+            for ch in order:
+                chain = table[ch]
                 if len(chain['rules']) > 0:
                     # Write the description first.
-                    f.write('\n\n##  {0}\n\n'.format(
-                            chain['description'].replace('\n','\n##  ') ))
+                    yield '\n\n##  {0}\n\n'.format(
+                            chain['description'].replace('\n','\n##  ') )
                 
                 for r in chain['rules']:
-                    if not r:
-                        f.write('\n')
-                    elif r[0] == '#':
-                        f.write( '{0}\n'.format(r) )
+                    if isinstance( r, Comment ):
+                        yield '{0}\n'.format(r)
                     else:
-                        f.write('-A {0} {1}\n'.format(ch,r))
+                        yield '{0}-A {1} {2}\n'.format( counter_prefix(r.counters), ch, r )
             
             # Commit everything.
-            f.write('\n\nCOMMIT\n')
+            yield '\n\nCOMMIT\n'
+    
+    def apply_chains(self, tee=None, command=['/sbin/iptables-restore']):
+        """Stream all chains straight into iptables-restore.
         
-        f.close()
+        The rules are piped into {command} as they are generated. If {tee} is
+        given, they are written to that file as well, for later reference.
+        If {keep_counters} is set, {command} is given the -c option, so the
+        counters written are loaded too. Returns the exit status of {command}.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.apply_chains( tee='/tmp/doctest_apply_chains', command=['true'] )
+        0
+        >>> open('/tmp/doctest_apply_chains').read() == ''.join(R.render_chains())
+        True
+        
+        """
+        
+        if self.keep_counters:
+            command = command + ['-c']
+        with span( 'apply iptables' ):
+            return Ruleset.pipe_lines( self.render_chains(), command, tee )
+    
+    def output_nft( self, filename ):
+        """Export all chains and sets as an  nft -f  script to {filename}.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.append_chain( 'INPUT', '-i lo -j ACCEPT' )
+        >>> R.output_nft( '/tmp/doctest_output_nft' )
+        >>> print open( '/tmp/doctest_output_nft' ).read()
+        #!/usr/sbin/nft -f
+        ...
+        table ip berlin_filter {
+        ...
+            chain INPUT {
+                iifname "lo" accept
+            }
+        }
+        
+        """
+        
+        with span( 'render nft' ):
+            f = open( filename, 'w' )
+            for line in render_nft( self ):
+                f.write( line )
+            f.close()
+    
+    def apply_nft( self, tee=None, command=['/usr/sbin/nft','-f','-'] ):
+        """Load all chains and sets with nftables, in a single transaction.
+        
+        If {tee} is given, the script is written to that file as well.
+        Returns the exit status of {command}.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.apply_nft( tee='/tmp/doctest_apply_nft', command=['true'] )
+        0
+        
+        """
+        
+        with span( 'apply nft' ):
+            return Ruleset.pipe_lines( render_nft(self), command, tee )
+    
+    def output_sets(self, filename):
+        """Export all sets in ipset-restore format to {filename}.
+        
+        Every set is filled under a temporary name first, and then swapped with
+        the live set, so rules referring to it never see a half-filled set.
+        
+        Examples:
+        
+        >>> R = Ruleset()
+        >>> R.new_set( 'doctest', ['10.0.0.1'] )
+        >>> R.output_sets( '/tmp/doctest_output_sets' )
+        
+        >>> f = open( '/tmp/doctest_output_sets', 'r' )
+        >>> print f.read()
+        <BLANKLINE>
+        ##  The addresses in the set `doctest`.
+        <BLANKLINE>
+        create doctest-new hash:ip family inet hashsize 1024 maxelem 4194304 -exist
+        flush doctest-new
+        add doctest-new 10.0.0.1
+        create doctest hash:ip family inet hashsize 1024 maxelem 4194304 -exist
+        swap doctest-new doctest
+        destroy doctest-new
+        <BLANKLINE>
+        >>> f.close()
+        
+        """
+        
+        with span( 'render sets' ):
+            f = open(filename,'w')
+            for line in self.render_sets():
+                f.write(line)
+            f.close()
+    
+    def render_sets(self):
+        """Generate all sets in ipset-restore format, line by line."""
+        
+        for name in sorted(self.all_sets.keys()):
+            ipset = self.all_sets[name]
+            
+            # Leave plenty of room, since ipset will not grow past maxelem.
+            # It stays the same however large the set gets (up to millions of
+            # members), since  create -exist  fails on a set that exists with
+            # other options; it costs nothing, as hashes grow as they fill up.
+            maxelem = 1 << 22
+            while maxelem < 2 * len(ipset['members']):
+                maxelem *= 2
+            options = '{0} family inet hashsize 1024 maxelem {1}'.format(
+                    ipset['type'], maxelem )
+            tmp = name + '-new'
+            
+            yield '\n##  {0}\n\n'.format(
+                    ipset['description'].replace('\n','\n##  ') )
+            yield 'create {0} {1} -exist\n'.format(tmp,options)
+            yield 'flush {0}\n'.format(tmp)
+            for m in ipset['members']:
+                yield 'add {0} {1}\n'.format(tmp,m)
+            yield 'create {0} {1} -exist\n'.format(name,options)
+            yield 'swap {0} {1}\n'.format(tmp,name)
+            yield 'destroy {0}\n'.format(tmp)
+    
+    def apply_sets(self, tee=None, command=['/sbin/ipset','restore']):
+        """Stream all sets straight into ipset restore.
+        
+        Works like apply_chains(). Nothing is run if there are no sets, but
+        {tee} is still emptied, so it never lists sets that are gone.
+        
+        Examples:
+        
+        >>> f = open( '/tmp/doctest_apply_sets', 'w' )
+        >>> f.write( 'create stale hash:ip\\n' )
+        >>> f.close()
+        >>> Ruleset().apply_sets( tee='/tmp/doctest_apply_sets' )
+        0
+        >>> os.path.getsize( '/tmp/doctest_apply_sets' )
+        0
+        
+        """
+        
+        if not self.all_sets:
+            if tee:
+                open( tee, 'w' ).close()
+            return 0
+        with span( 'apply sets' ):
+            return Ruleset.pipe_lines( self.render_sets(), command, tee )
     
+    @staticmethod
+    def pipe_lines( lines, command, tee=None ):
+        """Write {lines} to the standard input of {command}, and wait for it.
+        
+        If {tee} is given, every line is written to that file as well. Any
+        error output of {command} is passed on to debug(), and its exit status
+        is returned.
+        
+        Examples:
+        
+        >>> Ruleset.pipe_lines( ['a\\n','b\\n'], ['sh','-c','cat >/dev/null'] )
+        0
+        >>> Ruleset.pipe_lines( ['a\\n'], ['sh','-c','echo oops >&2; exit 3'] )
+        [sh] oops
+        [sh] exited with status 3.
+        3
+        
+        """
+        
+        # A file, rather than a pipe, so a chatty child can never block on it.
+        err = tempfile.TemporaryFile()
+        try:
+            P = subprocess.Popen( command, stdin=subprocess.PIPE,
+                    stdout=err, stderr=err, bufsize=-1 )
+        except OSError, e:
+            debug( 1, 'Could not run {0}: {1}'.format(command[0], e) )
+            return 127
+        
+        f = open(tee,'w') if tee else None
+        alive = True
+        for line in lines:
+            if alive:
+                try:
+                    P.stdin.write(line)
+                except IOError:
+                    # The child gave up early; its exit status will say why.
+                    alive = False
+            if f: f.write(line)
+            elif not alive: break
+        if f: f.close()
+        try:
+            P.stdin.close()
+        except IOError:
+            pass
+        rv = P.wait()
+        
+        name = os.path.basename(command[0])
+        err.seek(0)
+        for line in err.read().splitlines():
+            debug( 1 if rv else -1, '[{0}] {1}'.format(name, line) )
+        err.close()
+        
+        if rv:
+            debug( 1, '[{0}] exited with status {1}.'.format(name, rv) )
+        else:
+            debug( -1, '[{0}] done.'.format(name) )
+        return rv
     
 
 
 if __name__ == '__main__':
     import doctest
+    AddressSet.cache_dir = None
     fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE )
     
     import os,sys
     os.unlink('/tmp/doctest_IP_addresses_from_files')
     os.unlink('/tmp/doctest_create_filter')
+    os.unlink('/tmp/doctest_create_filter_exclude')
+    os.unlink('/tmp/doctest_create_filter_range')
     os.unlink('/tmp/doctest_output_chains')
+    os.unlink('/tmp/doctest_output_sets')
+    os.unlink('/tmp/doctest_apply_chains')
+    os.unlink('/tmp/doctest_apply_sets')
+    os.unlink('/tmp/doctest_import_saved')
+    os.unlink('/tmp/doctest_import_saved_sets')
+    os.unlink('/tmp/doctest_apply_diff')
+    os.unlink('/tmp/doctest_output_nft')
+    os.unlink('/tmp/doctest_apply_nft')
     
     sys.exit( fail )
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+import os, marshal
+from getpass import getuser
+import loader
+from loader import private
+from output import debug, span
+
+# Keeps everything the loader parsed and listed in a single file, so the
+# next run can read that one file instead of every file in networks/,
+# ports/ and if-config. Every entry keeps the modification time and size
+# of its file or directory, and only counts as long as they still match:
+# the loader checks each one before using it, and reads whatever changed
+# again, so a change to one host only costs reading that one host.
+#
+# The file is written with marshal rather than json: it holds nothing but
+# strings, numbers, tuples and dicts, and marshal reads those back as they
+# were, an order of magnitude faster, where json would turn every string
+# into unicode. marshal is not meant for data anyone else could have
+# written, though, and neither is a snapshot, which decides what the
+# configuration looks like: it is only ever read from, and written to, a
+# directory and a file of the user's own that nobody else can write to.
+
+# Bumped whenever the format changes; a snapshot of another version is
+# ignored.
+version = 1
+
+# The snapshot as it was loaded, so it is only written back if it changed.
+loaded = None
+
+
+def default_file():
+    """Return where the snapshot is kept: next to the rest of the build state
+    for root, and in ~/.cache/berlin for anyone else."""
+    
+    return '/etc/berlin/config-snapshot' if getuser() == 'root' \
+            else os.path.expanduser( '~/.cache/berlin/config-snapshot' )
+
+def current():
+    """Return everything the loader has parsed, read and listed, in the
+    form it is saved in."""
+    
+    return dict({
+        'version': version,
+        'parsed': dict( loader.parsed ),
+        'contents': dict( loader.contents ),
+        'listed': dict( loader.listed ),
+    })
+
+def load( filename ):
+    """Read the snapshot in {filename} into the loader, and return the
+    number of entries in it. A missing, damaged or outdated snapshot
+    counts as empty.
+    
+    Examples:
+    
+    >>> f = open( D + '/file', 'w' )
+    >>> f.write('policies: adblock\\n')
+    >>> f.close()
+    >>> P = loader.parse_path( D + '/file' )
+    >>> save( D + '/snapshot' )
+    True
+    >>> loader.parsed.clear()
+    >>> load( D + '/snapshot' )
+    1
+    >>> loader.parsed[ D + '/file' ][2]
+    {'policies': ['adblock']}
+    >>> load('/nonexistent')
+    0
+    
+    Anything that someone else could have written is ignored:
+    
+    >>> loader.parsed.clear()
+    >>> os.chmod( D + '/snapshot', 0666 )
+    >>> load( D + '/snapshot' )
+    0
+    >>> os.chmod( D + '/snapshot', 0600 )
+    >>> load( D + '/snapshot' )
+    1
+    
+    """
+    
+    global loaded
+    with span( 'load snapshot' ):
+        try:
+            if not private( os.stat( os.path.dirname(filename) or '.' ) ):
+                return 0
+            fd = os.open( filename, os.O_RDONLY | os.O_NOFOLLOW )
+            f = os.fdopen( fd, 'rb' )
+            try:
+                if not private( os.fstat(fd) ):
+                    return 0
+                data = marshal.load( f )
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return 0
+        if not isinstance( data, dict ) or data.get( 'version' ) != version:
+            return 0
+        
+        n = 0
+        for name in ['parsed', 'contents', 'listed']:
+            table = getattr( loader, name )
+            for path, entry in data.get( name, dict() ).items():
+                table.setdefault( path, entry )
+                n += 1
+        loaded = data
+    return n
+
+def save( filename ):
+    """Write everything the loader has parsed, read and listed so far to
+    {filename}, unless nothing changed since it was loaded. Entries for
+    files that are gone are left out. Returns whether it was written.
+    
+    The directory of {filename} is created if it doesn't exist yet, and
+    nothing is written if it isn't private().
+    
+    Examples:
+    
+    >>> save( D + '/snapshot' )
+    False
+    >>> os.unlink( D + '/file' )
+    >>> P = loader.parse_path( D + '/snapshot' )
+    >>> save( D + '/snapshot' )
+    True
+    >>> sorted( marshal.load( open( D + '/snapshot' ) )['parsed'] ) == [ D + '/snapshot' ]
+    True
+    >>> os.stat( D + '/snapshot' ).st_mode & 0777 == 0600
+    True
+    >>> open( D + '/other', 'w' ).close()
+    >>> P = loader.parse_path( D + '/other' )
+    >>> save( D + '/new/snapshot' ), oct( os.stat( D + '/new' ).st_mode & 0777 )
+    (True, '0700')
+    >>> os.unlink( D + '/other' )
+    >>> save('/tmp/snapshot'), os.path.exists('/tmp/snapshot')
+    (False, False)
+    
+    """
+    
+    global loaded
+    with span( 'save snapshot' ):
+        data = current()
+        if data == loaded:
+            return False
+        for name in ['parsed', 'contents', 'listed']:
+            for path in data[ name ].keys():
+                if not os.path.exists( path ):
+                    del data[ name ][ path ]
+                    del getattr( loader, name )[ path ]
+        
+        try:
+            directory = os.path.dirname( filename ) or '.'
+            if not os.path.isdir( directory ):
+                os.makedirs( directory, 0700 )
+            if not private( os.stat( directory ) ):
+                raise OSError( "{0} can be written by others".format( directory ) )
+            # Whatever is left of an earlier attempt, be it a file or a link,
+            # goes, and the new file is only ever created from scratch.
+            if os.path.lexists( filename + '.new' ):
+                os.unlink( filename + '.new' )
+            fd = os.open( filename + '.new',
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600 )
+            f = os.fdopen( fd, 'wb' )
+            marshal.dump( data, f )
+            f.close()
+            os.rename( filename + '.new', filename )
+        except (IOError, OSError), e:
+            debug( 1, "Could not save the configuration snapshot: {0}".format( e ) )
+            return False
+        loaded = data
+    return True
+
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys, tempfile, shutil
+    D = tempfile.mkdtemp()
+    fail, total = doctest.testmod( optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE,
+            extraglobs = dict( D=D ) )
+    shutil.rmtree( D )
+    sys.exit( fail )
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+
+    Copyright (C) 2011  Thijs van Dijk
+
+    This file is part of berlin.
+
+    Berlin is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Berlin is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    file "COPYING" for details.
+
+"""
+
+from berlin import Config, debug, Berlin
+from berlin.analyze import Analyzer, routing, possible, saved_ruleset
+from berlin.evaluate import Evaluator, read_csv, read_conntrack, batches, tally, hits, \
+        columns
+from berlin.snapshot import default_file
+from berlin.addresses import AddressSet, default_cache_dir
+import csv, sys, time
+
+# Decide the fate of a list of flows, read from a CSV file (--flows) or a
+# conntrack dump (--conntrack), without touching the live firewall.
+
+def option( name, default=None ):
+    """Return the argument following {name} on the command line."""
+    
+    if name in sys.argv:
+        return sys.argv[ sys.argv.index(name)+1 ]
+    return default
+
+def describe( decision ):
+    """Describe the rule or policy that made a decision."""
+    
+    if decision is None:
+        return 'no decision'
+    tb, ch, n, r = decision
+    if n is None:
+        return '{0} {1} policy'.format( tb, ch )
+    return '{0} {1} #{2}: {3}'.format( tb, ch, n, r )
+
+
+debug( 0, "Detecting configuration... ", False )
+AddressSet.cache_dir = default_cache_dir()
+C = Config( snapshot_file=default_file() )
+debug( 0, "done." )
+local, routes = routing( C )
+
+if '--rules' in sys.argv:
+    V = saved_ruleset( option('--rules'), option('--sets') )
+else:
+    V = Berlin()
+    V.use_ipset = '--ipset' in sys.argv
+    V.subnet_sets = '--subnet-sets' in sys.argv
+    V.classify_flows = '--classify' in sys.argv
+    V.fast_path = '--fast-path' in sys.argv
+    if '--tree' in sys.argv:
+        V.tree_fanout = int( option('--tree') )
+    V.import_config( C )
+    if '--no-optimize' not in sys.argv:
+        V.optimize()
+    if '--interface-chains' in sys.argv:
+        V.split_interfaces()
+
+E = Evaluator( Analyzer( V, local, routes ) )
+O = None
+if '--compare' in sys.argv:
+    O = Evaluator( Analyzer( saved_ruleset( option('--compare'),
+            option('--compare-sets') ), local, routes ) )
+
+if '--conntrack' in sys.argv:
+    filename, reader = option('--conntrack'), read_conntrack
+else:
+    filename, reader = option('--flows', '-'), read_csv
+f = sys.stdin if filename == '-' else open( filename )
+
+out = None
+if '--output' in sys.argv:
+    out = csv.writer( open( option('--output'), 'w' ) )
+    out.writerow( columns + [ 'verdict', 'table', 'chain', 'rule', 'text' ] )
+
+start = time.time()
+counts = dict()
+total = 0
+differences = []
+for batch in batches( reader( f, E.analyzer ) ):
+    verdicts = E.evaluate( batch )
+    total += tally( verdicts, counts )
+    if O is not None:
+        for P, a, b in zip( batch, verdicts, O.evaluate(batch) ):
+            if a[0] != b[0] and possible( O.analyzer, P ):
+                differences.append( (P, a, b) )
+    if out is not None:
+        for P, (verdict, decision) in zip( batch, verdicts ):
+            out.writerow([ P.source, P.destination, P.protocol, P.sport, P.dport,
+                    P.iface_in, P.iface_out, P.state, verdict ] +
+                    list( decision or (None, None, None, None) ) )
+
+debug( 0, "Evaluated {0} flows in {1:.2f}s, in {2} classes.".format(
+        total, time.time() - start, len(E.results) ) )
+
+print 'Flows per rule:'
+if not total:
+    print '  (no flows)'
+for n, verdict, decision in hits( counts )[: int( option('--top', 20) ) ]:
+    print '{0:9d} {1:6.2f}%  {2:<6s}  {3}'.format( n,
+            100.0 * n / total, verdict, describe(decision) )
+
+if O is not None:
+    print ''
+    print '{0} flows would be treated differently than by {1}.'.format(
+            len(differences), option('--compare') )
+    for P, a, b in differences[:10]:
+        print '  flow {0}: {1} -> {2}:{3}, {4} instead of {5}'.format( P.name,
+                P.source, P.destination, P.dport, a[0], b[0] )
@@ -18,10 +18,11 @@
 """
 
 import berlin
+from berlin.snapshot import default_file
 import sys
 
 
-C = berlin.Config()
+C = berlin.Config( snapshot_file=default_file() )
 
 if '--print' in sys.argv:
     C.Display()
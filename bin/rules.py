@@ -19,9 +19,94 @@
 
 from getpass import getuser
 from berlin import Config, debug, Berlin
-import subprocess
+from berlin.output import span, count, report
+from berlin.rule import Rule
+from berlin.build import BuildGraph, config_files, host_list_files, interface_addresses, \
+        live_state
+from berlin.snapshot import default_file
+from berlin.addresses import AddressSet, default_cache_dir
+import glob, os, subprocess, sys
 
-if getuser() == 'root':
+root = getuser() == 'root'
+rules_file = '/etc/berlin/rules' if root else '/tmp/rules'
+sets_file = '/etc/berlin/ipsets' if root else '/tmp/ipsets'
+nft_file = '/etc/berlin/rules.nft' if root else '/tmp/rules.nft'
+state_file = '/etc/berlin/build-state' if root else '/tmp/berlin-build-state'
+snapshot_file = default_file()
+AddressSet.cache_dir = default_cache_dir()
+profile_file = '/etc/berlin/profile' if root else '/tmp/berlin-profile'
+
+# Which backend to load the rules with: iptables, nft, or both, which loads
+# them with iptables, and only writes the nftables version.
+backend = 'iptables'
+if '--backend' in sys.argv:
+    backend = sys.argv[ sys.argv.index('--backend')+1 ]
+use_ipset = '--ipset' in sys.argv
+subnet_sets = '--subnet-sets' in sys.argv
+apply = '--apply' in sys.argv or '--diff' in sys.argv
+
+
+# Find out which outputs are out of date, before doing anything else.
+G = BuildGraph( state_file )
+here = os.path.dirname( os.path.abspath(__file__) )
+options = [ t for t in sys.argv[1:] if t not in ['--force', '--profile'] ]
+if '--silence' in options:
+    del options[ options.index('--silence') : options.index('--silence')+2 ]
+
+with span( 'hash inputs' ):
+    common = dict({
+        'code': G.hash_value( G.hash_files( [ os.path.abspath(__file__) ] +
+                sorted(glob.glob( here + '/berlin/*.py' )) ) ),
+        'options': G.hash_value( options ),
+        'config': G.hash_value( G.hash_files( config_files() ) ),
+        'interfaces': G.hash_value( interface_addresses() )
+    })
+    hosts = G.hash_value( G.hash_files( host_list_files() ) )
+
+outputs = dict()
+if backend != 'nft':
+    # With ipset, the host lists only end up in the sets.
+    outputs['rules'] = ( rules_file, dict( common ) if use_ipset else
+            dict( common, hosts=hosts ) )
+    if use_ipset or subnet_sets:
+        outputs['ipsets'] = ( sets_file, dict( code=common['code'],
+                options=common['options'], config=common['config'], hosts=hosts ) )
+if backend != 'iptables':
+    outputs['nft'] = ( nft_file, dict( common, hosts=hosts ) )
+
+# Whatever is loaded into the kernel is an input as well: its rules and sets
+# may have been flushed by a reboot or by hand, or edited, since they were
+# last loaded, and then have to be loaded again.
+live_commands = dict()
+if apply and backend == 'nft':
+    live_commands['nft'] = [ '/usr/sbin/nft', 'list', 'ruleset' ]
+elif apply:
+    live_commands['rules'] = [ '/sbin/iptables-save' ]
+    live_commands['ipsets'] = [ '/sbin/ipset', 'save' ]
+for o in outputs:
+    if o in live_commands:
+        with span( 'hash live state' ):
+            outputs[o][1]['live'] = live_state( live_commands[o] )
+
+# Anything depending on the live counters is out of date by definition.
+force = '--force' in sys.argv or '--reorder' in sys.argv or \
+        '--keep-counters' in sys.argv
+stale = sorted([ o for o in outputs
+        if force or G.stale( o, outputs[o][1], outputs[o][0] ) ])
+
+for o in stale:
+    debug( -1, "{0} is out of date: {1}".format( o,
+            ', '.join( G.changed_inputs( o, outputs[o][1] ) ) or
+            ( 'forced' if force else 'the output itself' ) ) )
+if not stale and not apply:
+    debug( 0, "Nothing changed." )
+    report( profile_file )
+    sys.exit( 0 )
+
+
+# The kernel setup is cheap, and undone by a reboot, so it is always done
+# when loading, even if the rules themselves are still loaded.
+if root:
     debug( -1, "Restarting BIND" )
     subprocess.call([ 'service', 'bind9', 'start' ])
     
@@ -34,12 +119,78 @@ if getuser() == 'root':
 else:
     debug( 1, "Note: you are not root." )
 
+if not stale:
+    debug( 0, "Nothing changed." )
+    report( profile_file )
+    sys.exit( 0 )
+
 debug( 0, "Detecting configuration... ", False )
-C = Config()
+with span( 'config' ):
+    C = Config( snapshot_file=snapshot_file )
 debug( 0, "done." )
 
 debug( 0, "Constructing iptables rules..." )
 V = Berlin()
-V.import_config( C )
-V.output_chains( '/etc/berlin/rules' if getuser() == 'root' else '/tmp/rules' )
-debug( 0, "Done." )
+V.use_ipset = use_ipset
+V.subnet_sets = subnet_sets
+V.classify_flows = '--classify' in sys.argv
+V.fast_path = '--fast-path' in sys.argv
+if '--tree' in sys.argv:
+    V.tree_fanout = int( sys.argv[ sys.argv.index('--tree')+1 ] )
+with span( 'import_config' ):
+    V.import_config( C )
+if '--no-optimize' not in sys.argv:
+    V.optimize()
+if '--interface-chains' in sys.argv:
+    V.split_interfaces()
+
+V.keep_counters = '--keep-counters' in sys.argv
+if '--reorder' in sys.argv or V.keep_counters:
+    live = V.live_ruleset([ '/sbin/iptables-save', '-c' ])
+    if live is not None and '--reorder' in sys.argv:
+        V.reorder( live )
+    elif live is not None:
+        V.take_counters( live )
+
+rv = 0
+if apply and backend == 'nft':
+    debug( 0, "Applying nftables rules..." )
+    rv = V.apply_nft( tee=nft_file )
+
+elif apply:
+    debug( 0, "Applying iptables rules..." )
+    # Sets have to exist before any rule can refer to them.
+    if 'ipsets' in stale:
+        rv = V.apply_sets( tee=sets_file )
+    if rv == 0 and 'rules' in stale and '--diff' in sys.argv:
+        rv = V.apply_diff()
+        V.output_chains( rules_file )
+    elif rv == 0 and 'rules' in stale:
+        rv = V.apply_chains( tee=rules_file )
+    if 'nft' in stale:
+        V.output_nft( nft_file )
+
+else:
+    if 'rules' in stale:
+        V.output_chains( rules_file )
+    if 'rules' in stale or 'ipsets' in stale:
+        V.output_sets( sets_file )
+    if 'nft' in stale:
+        V.output_nft( nft_file )
+
+if rv == 0:
+    for o in stale:
+        # What is loaded now, rather than what was loaded before.
+        if o in live_commands:
+            outputs[o][1]['live'] = live_state( live_commands[o] )
+        G.done( o, outputs[o][1], outputs[o][0] )
+    G.save()
+
+for tb in V.all_chains:
+    for ch in V.all_chains[tb]:
+        count( 'rules {0} {1}'.format( tb, ch ), len([ t for t in
+                V.all_chains[tb][ch]['rules'] if isinstance( t, Rule ) ]) )
+
+debug( 0, "Done." if rv == 0 else "Failed." )
+report( profile_file )
+sys.exit( rv )
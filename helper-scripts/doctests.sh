@@ -3,7 +3,13 @@
 cd $(dirname $0)/../bin
 
 for F in  berlin/config_ui.py  berlin/network_config.py \
-          berlin/ruleset.py    berlin/berlin.py
+          berlin/addresses.py  berlin/rule.py \
+          berlin/diff.py       berlin/ruleset.py \
+          berlin/optimize.py   berlin/nftables.py \
+          berlin/build.py      berlin/output.py \
+          berlin/analyze.py    berlin/evaluate.py \
+          berlin/netlink.py    berlin/loader.py \
+          berlin/snapshot.py   berlin/berlin.py
 do
     echo -n "Running doctests from file [$F]... "
     python $F $@
@@ -18,9 +18,12 @@
 
 
 cd /usr/share/berlin/bin
-python rules.py
+python rules.py --apply "$@" || exit $?
 
 
-/sbin/iptables-restore < /etc/berlin/rules
+# Only keep a copy if the rules actually changed since the last one.
 mkdir -p /etc/berlin/old.rules
-cp /etc/berlin/rules "/etc/berlin/old.rules/rules-$(date '+%F %T')"
+LAST="$(ls -t /etc/berlin/old.rules | head -n 1)"
+if [ -z "$LAST" ] || ! cmp -s /etc/berlin/rules "/etc/berlin/old.rules/$LAST"; then
+    cp /etc/berlin/rules "/etc/berlin/old.rules/rules-$(date '+%F %T')"
+fi
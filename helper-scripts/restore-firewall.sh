@@ -24,4 +24,13 @@ service bind9 restart
 echo 1 > /proc/sys/net/ipv4/ip_forward
 
 
-iptables-restore /etc/berlin/rules
+# Sets have to exist before any rule can refer to them.
+if grep -q '^create' /etc/berlin/ipsets 2>/dev/null; then
+    ipset restore < /etc/berlin/ipsets
+fi
+# Rules saved with --keep-counters carry their counters along.
+if grep -q '^\[' /etc/berlin/rules; then
+    iptables-restore -c /etc/berlin/rules
+else
+    iptables-restore /etc/berlin/rules
+fi